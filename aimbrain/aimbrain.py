@@ -2,14 +2,19 @@
 aimbrain-cli
 
 Usage:
-  aimbrain-cli auth (face|voice) <biometrics> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--token=<token>] [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli behavioural-submit <data> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli compare (face) <biometric1> <biometric2> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli enroll (face|voice) <biometrics>... --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli score --api-key=<api_key> --secret=<secret> --session=<session_id> [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli token (face|voice) --user-id=<uid> --api-key=<api_key> --secret=<secret> [--token=<token>] [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli session --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>]
-  aimbrain-cli videoconv (blur|brighten|sharpen|contrast) <factor> --in=<input_file> --out=<output_file> --avconv=<avconv> --ffprobe=<ffprobe>
+  aimbrain-cli auth (face|voice) <biometrics> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--token=<token>] [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--session-cache=<file>] [--session-ttl=<seconds>] [--biometric-cache=<dir>] [--biometric-cache-size=<bytes>] [--optimize-media] [--avconv=<avconv>] [--compress=<encoding>] [--compress-threshold=<bytes>] [--trace=<file>]
+  aimbrain-cli behavioural-submit <data> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--batch-events=<n>] [--batch-bytes=<n>] [--in-flight=<n>] [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--session-cache=<file>] [--session-ttl=<seconds>] [--compress=<encoding>] [--compress-threshold=<bytes>] [--trace=<file>]
+  aimbrain-cli behavioural-replay <recordings>... --api-key=<api_key> --secret=<secret> [--sessions=<n>] [--speed=<speed>] [--window=<seconds>] [--score-interval=<seconds>] [--user-id=<uid>] [--report=<file>] [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--hedge=<seconds>] [--trace=<file>]
+  aimbrain-cli compare (face) <biometric1> <biometric2> --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--biometric-cache=<dir>] [--biometric-cache-size=<bytes>] [--optimize-media] [--avconv=<avconv>] [--trace=<file>]
+  aimbrain-cli enroll (face|voice) <biometrics>... --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--session-cache=<file>] [--session-ttl=<seconds>] [--biometric-cache=<dir>] [--biometric-cache-size=<bytes>] [--optimize-media] [--avconv=<avconv>] [--compress=<encoding>] [--compress-threshold=<bytes>] [--trace=<file>]
+  aimbrain-cli enroll-batch (face|voice) <manifest> --api-key=<api_key> --secret=<secret> [--results=<results>] [--concurrency=<n>] [--rate=<rps>] [--async] [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--biometric-cache=<dir>] [--biometric-cache-size=<bytes>] [--optimize-media] [--avconv=<avconv>] [--compress=<encoding>] [--compress-threshold=<bytes>] [--trace=<file>]
+  aimbrain-cli score --api-key=<api_key> --secret=<secret> --session=<session_id> [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--hedge=<seconds>] [--trace=<file>]
+  aimbrain-cli token (face|voice) --user-id=<uid> --api-key=<api_key> --secret=<secret> [--token=<token>] [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--session-cache=<file>] [--session-ttl=<seconds>] [--trace=<file>]
+  aimbrain-cli session --user-id=<uid> --api-key=<api_key> --secret=<secret> [--api-url=<api_url>] [--device=<device>] [--system=<system>] [--pool-size=<n>] [--retries=<n>] [--backoff=<seconds>] [--retry-on=<statuses>] [--trace=<file>]
+  aimbrain-cli videoconv (blur|brighten|sharpen|contrast) <factor> --in=<input_file> --out=<output_file> --avconv=<avconv> --ffprobe=<ffprobe> [--queue-depth=<n>] [--workers=<n>] [--chunk-size=<n>] [--engine=<engine>] [--direct] [--variant=<variant>...]
+  aimbrain-cli videoconv-batch (<manifest> | --glob=<pattern> (blur|brighten|sharpen|contrast) <factor> --out-dir=<out_dir>) --avconv=<avconv> --ffprobe=<ffprobe> [--jobs=<n>] [--force] [--queue-depth=<n>] [--chunk-size=<n>] [--engine=<engine>] [--direct]
+  aimbrain-cli serve [--socket=<path>] [--concurrency=<n>] [--session-ttl=<seconds>] [--trace=<file>]
+  aimbrain-cli bench [--requests=<n> | --duration=<seconds>] [--rps=<rps>] [--concurrency=<n>] [--reuse-session] [--cache-biometrics] [--report=<file>] <command> [<args>...]
   aimbrain-cli -h | --help
   aimbrain-cli --version
 
@@ -22,10 +27,64 @@ Options:
     --device=<device>                       Device you are using [default: Generic Phone]
     --system=<system>                       OS of device [default: Generic OS]
     --api-url=<api_url>                     URL to send requests to [default: https://api.aimbrain.com]
+    --pool-size=<n>                         Kept-alive connections per host [default: 10]
+    --session-cache=<file>                  Reuse sessions from earlier runs, stored in this file
+    --session-ttl=<seconds>                 How long to reuse a cached session for [default: 600]
+    --retries=<n>                           Times to retry a request that failed to connect or got a --retry-on status [default: 0]
+    --backoff=<seconds>                     Delay before the first retry, doubling for each one, with jitter [default: 0.5]
+    --retry-on=<statuses>                   Comma separated statuses to retry [default: 429,502,503,504]
+    --hedge=<seconds>                       Send a duplicate request if there's no response within this time
+    --compress=<encoding>                   Compress request bodies with gzip or deflate
+    --compress-threshold=<bytes>            Smallest body to compress [default: 1024]
+    --trace=<file>                          Write the timings of each request's phases here, in Chrome's trace format for a *.json file and as JSON lines otherwise
+    --optimize-media                        Shrink face images to 480px JPEGs and voices to 16kHz mono before sending
+    --biometric-cache=<dir>                 Keep base64 encoded biometrics here for later runs to reuse
+    --biometric-cache-size=<bytes>          Most bytes of encodings to keep in --biometric-cache [default: 1073741824]
+
+  Batches:
+    <manifest>                              CSV or JSON lines of user_id and biometrics to enroll
+    --results=<results>                     Results file to resume from, defaults to <manifest>.results.jsonl
+    --concurrency=<n>                       Requests in flight at once [default: 4]
+    --rate=<rps>                            Maximum requests per second to start
+    --async                                 Send requests from one thread on non-blocking sockets instead of a thread per request
+
+  Behavioural:
+    <data>                                  JSON, JSON lines or a JSON array of objects of event lists
+    --batch-events=<n>                      Most events to submit in one request [default: 1000]
+    --batch-bytes=<n>                       Most bytes of events to submit in one request [default: 1048576]
+    --in-flight=<n>                         Batches submitted at once [default: 1]
+
+  Behavioural replay:
+    <recordings>...                         Recorded behavioural data, in any format <data> can be
+    --sessions=<n>                          Sessions replayed at once, by users <uid>-0, <uid>-1... (replay-0... by default) [default: 1]
+    --speed=<speed>                         How many times faster than recorded to replay, or max [default: 1]
+    --window=<seconds>                      Recorded time to submit the events of in one request [default: 1]
+    --score-interval=<seconds>              Recorded time between score requests of a session [default: 5]
 
   VideoConv:
     --in=<input_file>/--out=<output_file>   Input/Output file for videoconv
     --avconv=<avconv>/--ffprobe=<ffprobe>   Path to avconv/ffprobe
+    --queue-depth=<n>                       Max decoded frames held in memory [default: 8]
+    --workers=<n>                           Filter processes, 1 filters in-process [default: 1]
+    --chunk-size=<n>                        Frames filtered together as one chunk [default: 8]
+    --engine=<engine>                       Filter engine, numpy or pil [default: pil]
+    --direct                                Pipe frames straight into avconv, with no temporary files
+    --variant=<variant>                     Extra output from the same decode, as operation:factor:output
+
+  VideoConv batch:
+    <manifest>                              CSV or JSON lines with input, operation, factor and output
+    --glob=<pattern>/--out-dir=<out_dir>    Convert all matching files into a directory instead
+    --jobs=<n>                              Jobs to run at once, defaults to the number of CPUs
+    --force                                 Convert even if the output is newer than the input
+
+  Serve:
+    --socket=<path>                         Take commands from connections to this Unix socket instead of stdin
+
+  Bench:
+    <command> [<args>...]                   API command to replay, with its usual arguments
+    --requests=<n>/--duration=<seconds>     Times to run the command (100 by default), or for how long
+    --rps=<rps>                             Maximum runs of the command to start per second
+    --report=<file>                         Write the JSON report here, instead of to stdout for bench
 
   Generic:
     -h --help                               Show this screen.
@@ -34,6 +93,12 @@ Options:
 Examples:
   aimbrain-cli auth face /path/to/face_image.png --user-id=user --token=enroll-6 --api-key=key --secret=secret --dev
   aimbrain-cli videoconv blur 1.5 --in=/home/aimbrain/auth.mov --out=/home/aimbrain/auth_blur.mov --avconv=/path/to/avconv --ffprobe=/path/to/ffprobe
+  aimbrain-cli videoconv blur 0.5 --in=/home/aimbrain/auth.mov --out=/home/aimbrain/auth_blur0.5.mov --variant=blur:1.5:/home/aimbrain/auth_blur1.5.mov --variant=brighten:1.5:/home/aimbrain/auth_brighten1.5.mov --avconv=/path/to/avconv --ffprobe=/path/to/ffprobe
+  aimbrain-cli behavioural-replay recordings/*.jsonl --sessions=50 --speed=10 --api-key=key --secret=secret
+  aimbrain-cli enroll-batch face users.csv --async --concurrency=500 --api-key=key --secret=secret
+  aimbrain-cli serve --socket=/tmp/aimbrain.sock --concurrency=16
+  aimbrain-cli bench --duration=60 --rps=20 --concurrency=8 session --user-id=user --api-key=key --secret=secret
+  aimbrain-cli videoconv-batch --glob='/home/aimbrain/*.mov' blur 1.5 --out-dir=/home/aimbrain/blurred --avconv=/path/to/avconv --ffprobe=/path/to/ffprobe
 
 Help:
   For help using this tool, please open an issue on the repository:
@@ -43,36 +108,99 @@ Help:
 
 from docopt import docopt
 
+import importlib
+import sys
+
 from . import __version__ as VERSION
-from commands.api import Auth
-from commands.api import Compare
-from commands.api import Enroll
-from commands.api import Session
-from commands.api import Score
-from commands.api import Token
-from commands.api import BehaviouralSubmit
-from commands.videoconv import VideoConv
+from .commands.utils import trace
+
+
+# Command modules are only imported once a command is picked, so API
+# commands don't pay for importing cv2, numpy and scipy for videoconv
+COMMANDS = (
+    ('videoconv', 'aimbrain.commands.videoconv', 'VideoConv'),
+    ('videoconv-batch', 'aimbrain.commands.videoconv', 'VideoConvBatch'),
+    ('auth', 'aimbrain.commands.api', 'Auth'),
+    ('compare', 'aimbrain.commands.api', 'Compare'),
+    ('enroll', 'aimbrain.commands.api', 'Enroll'),
+    ('enroll-batch', 'aimbrain.commands.api', 'EnrollBatch'),
+    ('score', 'aimbrain.commands.api', 'Score'),
+    ('token', 'aimbrain.commands.api', 'Token'),
+    ('session', 'aimbrain.commands.api', 'Session'),
+    ('behavioural-submit', 'aimbrain.commands.api', 'BehaviouralSubmit'),
+    ('behavioural-replay', 'aimbrain.commands.replay', 'BehaviouralReplay'),
+    ('serve', 'aimbrain.commands.serve', 'Serve'),
+)
+
+
+def get_command(options):
+    """
+    Class of the command chosen on the command line, importing its module
+
+    Arguments:
+    options <dict> --- Options parsed by docopt
+    """
+
+    for name, module, cls in COMMANDS:
+        if options.get(name):
+            return getattr(importlib.import_module(module), cls)
+
+    return None
+
+
+# Usages of single commands, by command
+command_usages = {}
+
+
+def get_usage(argv):
+    """
+    Usage to parse a command's arguments with, holding only the command's
+    own pattern besides the options. docopt takes time in the number of
+    patterns, so this saves most of the time parsing takes. The full usage
+    is given for arguments that don't start with a command.
+
+    Arguments:
+    argv <list> --- Command line arguments, starting with the command
+    """
+
+    command = argv[0] if argv else None
+    usage = command_usages.get(command)
+    if usage is not None:
+        return usage
+
+    head, _, rest = __doc__.partition('Usage:\n')
+    patterns, _, rest = rest.partition('\n\n')
+    patterns = [
+        pattern for pattern in patterns.split('\n')
+        if pattern.split()[1:2] == [command]
+    ]
+    if not patterns:
+        return __doc__
+
+    usage = '%sUsage:\n%s\n\n%s' % (head, '\n'.join(patterns), rest)
+    command_usages[command] = usage
+    return usage
 
 
 def main():
-    options = docopt(__doc__, version=VERSION)
-
-    cmd = None
-    if options.get('videoconv'):
-        cmd = VideoConv(options)
-    elif options.get('auth'):
-        cmd = Auth(options)
-    elif options.get('compare'):
-        cmd = Compare(options)
-    elif options.get('enroll'):
-        cmd = Enroll(options)
-    elif options.get('score'):
-        cmd = Score(options)
-    elif options.get('token'):
-        cmd = Token(options)
-    elif options.get('session'):
-        cmd = Session(options)
-    elif options.get('behavioural-submit'):
-        cmd = BehaviouralSubmit(options)
-
-    cmd.run()
+    argv = sys.argv[1:]
+    if argv[:1] == ['bench']:
+        from aimbrain.commands import bench
+
+        # Everything from the benched command on belongs to it, so parse it
+        # separately with the usual usage patterns
+        bench_argv, command_argv = bench.split_argv(argv)
+        options = docopt(bench.__doc__, argv=bench_argv, version=VERSION)
+        command_options = docopt(
+            get_usage(command_argv),
+            argv=command_argv,
+            version=VERSION,
+        )
+        bench.Bench(options, command_options).run()
+        return
+
+    options = docopt(get_usage(argv), argv=argv, version=VERSION)
+
+    cmd = get_command(options)(options)
+    with trace.span('command', command=cmd.__class__.__name__):
+        cmd.run()
@@ -1,15 +1,38 @@
 import base64
-import hashlib
-import hmac
+import csv
+import itertools
 import json
 import os
 import os.path
+import Queue
+import threading
 import time
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
 import requests
 
 from aimbrain.commands.base import BaseCommand
+from aimbrain.commands.utils import behavioural
+from aimbrain.commands.utils import biometric_cache
+from aimbrain.commands.utils import compression
+from aimbrain.commands.utils import serializer
+from aimbrain.commands.utils import connection
+from aimbrain.commands.utils import signing
+from aimbrain.commands.utils import trace
+from aimbrain.commands.utils.async_http import Future
+from aimbrain.commands.utils.async_http import HTTPLoop
+from aimbrain.commands.utils.output import inherit_output
+from aimbrain.commands.utils.pipeline import ordered_imap
+from aimbrain.commands.utils.retry import DEFAULT_STATUSES
+from aimbrain.commands.utils.retry import RetryPolicy
+from aimbrain.commands.utils.retry import parse_statuses
+from aimbrain.commands.utils.session_cache import DEFAULT_TTL
+from aimbrain.commands.utils.session_cache import SessionCache
+from aimbrain.commands.utils.streaming import Base64File
+from aimbrain.commands.utils.streaming import JSONStream
+from aimbrain.commands.utils.throttle import parse_rate
 
 V1_SESSIONS_ENDPOINT = '/v1/sessions'
 V1_SCORE_ENDPOINT = '/v1/score'
@@ -25,6 +48,21 @@ V1_VOICE_TOKEN_ENDPOINT = '/v1/voice/token'
 
 V1_BEHAVIOURAL_SUBMIT = '/v1/behavioural/submit'
 
+# Endpoints that are safe to send twice, so can be hedged
+HEDGED_ENDPOINTS = (V1_SCORE_ENDPOINT,)
+
+# Users enrolled at once by enroll-batch, as in the usage
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# Endpoint and body key of each kind of enrollment
+ENROLL_ENDPOINTS = {
+    'face': (V1_FACE_ENROLL_ENDPOINT, 'faces'),
+    'voice': (V1_VOICE_ENROLL_ENDPOINT, 'voices'),
+}
+
+# Effectively no timeout, but one that Ctrl-C can interrupt
+HEDGE_WAIT = 60 * 60 * 24
+
 
 class AbstractRequestGenerator(BaseCommand):
     """
@@ -54,6 +92,112 @@ class AbstractRequestGenerator(BaseCommand):
         self.auth_method = 'face' if options.get('face') else 'voice'
         self.session = None
 
+        pool_size = int(
+            options.get('--pool-size') or connection.DEFAULT_POOL_SIZE
+        )
+        if pool_size < 1:
+            raise SystemExit('--pool-size must be at least 1')
+
+        # Kept-alive connections are shared by every request in the process
+        self.http = connection.get_http_session(pool_size)
+
+        retries = int(options.get('--retries') or 0)
+        if retries < 0:
+            raise SystemExit('--retries must not be negative')
+
+        backoff = float(options.get('--backoff') or 0.5)
+        if backoff < 0:
+            raise SystemExit('--backoff must not be negative')
+
+        statuses = DEFAULT_STATUSES
+        if options.get('--retry-on'):
+            statuses = parse_statuses(options.get('--retry-on'))
+
+        self.retry_policy = RetryPolicy(
+            attempts=retries + 1,
+            backoff=backoff,
+            statuses=statuses,
+        )
+
+        self.hedge = None
+        if options.get('--hedge'):
+            self.hedge = float(options.get('--hedge'))
+            if self.hedge < 0:
+                raise SystemExit('--hedge must not be negative')
+
+        # Commands driving many requests read outcomes from here rather than
+        # the printed output
+        self.quiet = False
+        self.responses = []
+
+        # Sessions can be shared between invocations through a file
+        self.session_cache = None
+        self.session_cached = False
+        cache_path = options.get('--session-cache')
+        if cache_path:
+            ttl = float(options.get('--session-ttl') or DEFAULT_TTL)
+            if ttl <= 0:
+                raise SystemExit('--session-ttl must be positive')
+
+            self.session_cache = SessionCache(cache_path, ttl)
+            if not os.path.isdir(os.path.dirname(self.session_cache.path)):
+                raise SystemExit(
+                    'Session cache directory does not exist - "%s"' % (
+                        cache_path
+                    )
+                )
+
+        # Phases of each request can be timed to a trace file
+        if options.get('--trace'):
+            trace.start(options.get('--trace'))
+
+        # Bodies can be compressed once they're large enough to gain from it
+        self.compress = options.get('--compress')
+        if self.compress and self.compress not in compression.ENCODINGS:
+            raise SystemExit('--compress must be one of %s' % ', '.join(
+                compression.ENCODINGS
+            ))
+
+        self.compress_threshold = int(
+            options.get('--compress-threshold') or
+            compression.DEFAULT_THRESHOLD
+        )
+        if self.compress_threshold < 0:
+            raise SystemExit('--compress-threshold must not be negative')
+
+        # Biometrics can be shrunk before they're sent, recording the bytes
+        # saved on each
+        self.optimize_media = bool(options.get('--optimize-media'))
+        self.avconv = options.get('--avconv') or 'avconv'
+        self.optimized = []
+
+        # Encoded assets can be kept between requests and invocations
+        self.biometric_cache = None
+        cache_dir = options.get('--biometric-cache')
+        if cache_dir:
+            max_disk = int(
+                options.get('--biometric-cache-size') or
+                biometric_cache.DEFAULT_MAX_DISK
+            )
+            if max_disk < 1:
+                raise SystemExit('--biometric-cache-size must be at least 1')
+
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError as e:
+                    raise SystemExit(
+                        'Unable to create biometric cache "%s": %s' % (
+                            cache_dir,
+                            e.strerror,
+                        )
+                    )
+
+            self.biometric_cache = biometric_cache.get_cache(
+                cache_dir,
+                max_disk,
+            )
+
     def get_hmac(self, method, endpoint, payload):
         """
         Generate a HMAC signature
@@ -61,16 +205,19 @@ class AbstractRequestGenerator(BaseCommand):
         Arguments:
         method <string> -- HTTP method e.g. GET, POST
         endpoint <string> -- HTTP endpoint request is being sent to
-        payload <string> -- JSON encoded body of request
+        payload <string|JSONStream> -- JSON encoded body of request
         """
 
-        message = '%s\n%s\n%s' % (method.upper(), endpoint.lower(), payload)
+        if isinstance(payload, JSONStream):
+            # Sign the body a chunk at a time rather than building it whole
+            payload = payload.chunks()
 
-        return base64.b64encode(hmac.new(
-            self.secret.encode('utf-8'),
-            bytes(message).encode('utf-8'),
-            digestmod=hashlib.sha256,
-        ).digest())
+        with trace.span('sign', endpoint=endpoint):
+            return signing.get_signer(self.secret).sign(
+                method,
+                endpoint,
+                payload,
+            )
 
     def get_aimbrain_headers(self, method, endpoint, payload):
         """
@@ -79,7 +226,7 @@ class AbstractRequestGenerator(BaseCommand):
         Arguments:
         method <string> -- HTTP method e.g. GET, POST
         endpoint <string> -- HTTP endpoint request is being sent to
-        payload <string> -- JSON encoded body of request
+        payload <string|JSONStream> -- JSON encoded body of request
         """
 
         headers = {
@@ -91,6 +238,36 @@ class AbstractRequestGenerator(BaseCommand):
 
         return headers
 
+    def compress_payload(self, payload, headers):
+        """
+        Compress a body if --compress was given and it is large enough,
+        returning the body to send. Headers are given the Content-Encoding,
+        while the signature stays that of the uncompressed JSON, as the API
+        checks it once it has decompressed the body.
+
+        Arguments:
+        payload <string|JSONStream> -- JSON encoded body of request
+        headers <dict> -- Dictionary of header keys to values
+        """
+
+        if not self.compress or len(payload) < self.compress_threshold:
+            return payload
+
+        chunks = payload.chunks() if isinstance(payload, JSONStream) else [
+            payload
+        ]
+        with trace.span('compress', encoding=self.compress) as args:
+            compressed = compression.compress(chunks, self.compress)
+            args['bytes'] = len(payload)
+            args['compressed'] = len(compressed)
+
+        # e.g. media that was compressed already
+        if len(compressed) >= len(payload):
+            return payload
+
+        headers['Content-Encoding'] = self.compress
+        return compressed
+
     def get_url(self, endpoint):
         """
         Generate a full URL for a particular endpoint
@@ -112,30 +289,152 @@ class AbstractRequestGenerator(BaseCommand):
             '',
         ))
 
-    def post(self, url, payload, headers):
+    def send(self, url, payload, headers):
         """
-        POST a request to a URL
+        POST a request once, returning the response, or None and the
+        connection error, and the time spent opening connections
 
         Arguments:
-        url <string> -- HTTP method e.g. GET, POST
-        endpoint <string> -- HTTP endpoint request is being sent to
+        url <string> -- URL to send the request to
+        payload <string|JSONStream> -- JSON encoded body of request
         headers <dict> -- Dictionary of header keys to values
         """
 
+        connection.reset_handshake_time()
         start = time.time()
-        resp = None
         try:
-            resp = requests.post(url, payload, headers=headers)
-        except requests.exceptions.ConnectionError:
+            resp = self.http.post(url, payload, headers=headers)
+        except requests.exceptions.ConnectionError as e:
+            return None, e, connection.get_handshake_time()
+
+        if trace.is_enabled():
+            # requests times up to the response's headers, which includes
+            # connecting and uploading the body, then reads the rest
+            end = time.time()
+            ttfb = resp.elapsed.total_seconds()
+            trace.record('ttfb', start, ttfb, url=url, status=resp.status_code)
+            trace.record(
+                'download',
+                start + ttfb,
+                max(end - start - ttfb, 0.0),
+                bytes=len(resp.content),
+            )
+
+        return resp, None, connection.get_handshake_time()
+
+    def send_hedged(self, url, payload, headers):
+        """
+        POST a request, sending a duplicate if there's no response within
+        the hedge delay, and return the first response to arrive as send
+        does, plus whether a duplicate was sent
+
+        Arguments:
+        url <string> -- URL to send the request to
+        payload <string|JSONStream> -- JSON encoded body of request
+        headers <dict> -- Dictionary of header keys to values
+        """
+
+        if isinstance(payload, JSONStream):
+            # Both requests may read the body at once, so they can't share
+            # a stream
+            payload = ''.join(payload.chunks())
+
+        results = Queue.Queue()
+
+        def send():
+            results.put(self.send(url, payload, headers))
+
+        def start():
+            thread = threading.Thread(target=send)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        try:
+            return results.get(timeout=self.hedge) + (False,)
+        except Queue.Empty:
+            pass
+
+        # The slower request is left to finish in the background. Waits are
+        # given a timeout so that Ctrl-C still interrupts them.
+        start()
+        resp, error, handshake = results.get(timeout=HEDGE_WAIT)
+        if resp is None:
+            # Failed to connect, the other request may still succeed
+            resp, error, handshake = results.get(timeout=HEDGE_WAIT)
+
+        return resp, error, handshake, True
+
+    def post(self, url, payload, headers, hedge=False):
+        """
+        POST a request to a URL, retrying as the retry policy allows
+
+        Arguments:
+        url <string> -- URL to send the request to
+        payload <string|JSONStream> -- JSON encoded body of request
+        headers <dict> -- Dictionary of header keys to values
+
+        Optional Arguments:
+        hedge <bool> -- Whether the request can safely be sent twice, to be
+            hedged if --hedge was given
+        """
+
+        start = time.time()
+        attempts = []
+        handshake = 0.0
+        while True:
+            attempt_start = time.time()
+            if hedge and self.hedge is not None:
+                resp, error, attempt_handshake, hedged = self.send_hedged(
+                    url,
+                    payload,
+                    headers,
+                )
+            else:
+                resp, error, attempt_handshake = self.send(
+                    url,
+                    payload,
+                    headers,
+                )
+                hedged = False
+
+            handshake += attempt_handshake
+            status = resp.status_code if resp is not None else None
+            attempts.append({
+                'status': status,
+                'time': time.time() - attempt_start,
+                'hedged': hedged,
+            })
+
+            if not self.retry_policy.should_retry(len(attempts), status):
+                break
+
+            delay = self.retry_policy.get_delay(
+                len(attempts),
+                resp.headers.get('Retry-After') if resp is not None else None,
+            )
+            if delay is None:
+                break
+
+            time.sleep(delay)
+            if isinstance(payload, JSONStream):
+                payload.seek(0)
+
+        if resp is None:
             raise SystemExit('Unable to connect to url "%s"' % url)
 
         end = time.time() - start
 
+        # Time spent opening new connections, 0 if pooled ones were reused
+        resp.handshake_time = handshake
+        resp.attempts = attempts
+
         return resp, end
 
-    def get_response_payload(self, endpoint, payload):
+    def get_response(self, endpoint, payload):
         """
-        Send a request to AimBrain API and return JSON response
+        Send a request to AimBrain API and return the response with its
+        JSON, which is '' if it has none
 
         Arguments:
         endpoint <string> -- HTTP endpoint request is being sent to
@@ -149,21 +448,63 @@ class AbstractRequestGenerator(BaseCommand):
             payload
         )
 
-        resp, end = self.post(url, payload, headers)
+        resp, end = self.post(
+            url,
+            self.compress_payload(payload, headers),
+            headers,
+            hedge=endpoint in HEDGED_ENDPOINTS,
+        )
 
         response_payload = ''
-        try:
-            response_payload = resp.json()
-        except ValueError:
-            pass
+        with trace.span('parse', endpoint=endpoint) as args:
+            try:
+                response_payload = resp.json()
+            except ValueError:
+                args['error'] = 'Invalid JSON'
+
+        attempts = getattr(resp, 'attempts', [])
+        self.responses.append({
+            'endpoint': endpoint,
+            'status': resp.status_code,
+            'time': end,
+            'handshake': getattr(resp, 'handshake_time', 0.0),
+            'attempts': attempts,
+            'payload': response_payload,
+        })
 
-        print('\n[%s][%d][%.2fs] %s\n' % (
-            endpoint,
-            resp.status_code,
-            end,
-            response_payload or resp.text
-        ))
+        if not self.quiet:
+            retries = ''
+            if len(attempts) > 1 or any(a['hedged'] for a in attempts):
+                retries = '[attempts %s]' % ', '.join(
+                    '%.2fs %s%s' % (
+                        attempt['time'],
+                        attempt['status'] or 'error',
+                        ' hedged' if attempt['hedged'] else '',
+                    )
+                    for attempt in attempts
+                )
+
+            print('\n[%s][%d][%.2fs][handshake %.2fs]%s %s\n' % (
+                endpoint,
+                resp.status_code,
+                end,
+                getattr(resp, 'handshake_time', 0.0),
+                retries,
+                response_payload or resp.text
+            ))
+
+        return resp, response_payload
 
+    def get_response_payload(self, endpoint, payload):
+        """
+        Send a request to AimBrain API and return JSON response
+
+        Arguments:
+        endpoint <string> -- HTTP endpoint request is being sent to
+        payload <string> -- JSON encoded body of request
+        """
+
+        resp, response_payload = self.get_response(endpoint, payload)
         if not response_payload:
             raise SystemExit('Failed to get session, got: %s' % resp.text)
 
@@ -177,7 +518,27 @@ class AbstractRequestGenerator(BaseCommand):
         if self.session:
             return self.session
 
-        payload = json.dumps({
+        if self.session_cache is None:
+            return self.create_session()
+
+        key = self.get_session_key()
+        with self.session_cache.creating(key):
+            self.session = self.session_cache.get(key)
+            if self.session:
+                self.session_cached = True
+                return self.session
+
+            self.create_session()
+            self.session_cache.put(key, self.session)
+
+        return self.session
+
+    def create_session(self):
+        """
+        Create a new session for this request batch
+        """
+
+        payload = serializer.dumps({
             'userId': self.user_id,
             'device': self.device,
             'system': self.system
@@ -194,6 +555,22 @@ class AbstractRequestGenerator(BaseCommand):
 
         return self.session
 
+    def get_session_key(self, user_id=None):
+        """
+        Key of this command's session in the session cache
+
+        Optional Arguments:
+        user_id <string> -- User of the session, if not the command's
+        """
+
+        return SessionCache.get_key(
+            self.base_url,
+            self.api_key,
+            user_id or self.user_id,
+            self.device,
+            self.system,
+        )
+
     def encode_biometric(self, biometric_path):
         """
         Encode the biometric asset (image, video, audio) to base64
@@ -211,6 +588,77 @@ class AbstractRequestGenerator(BaseCommand):
 
         return encoded
 
+    def stream_biometric(self, biometric_path):
+        """
+        Get the base64 encoding of a biometric asset to put in a request
+        body, read from disk a chunk at a time as the body is sent
+
+        Arguments:
+        biometric_path <string> -- file path to asset
+        """
+        if not os.path.exists(biometric_path):
+            raise SystemExit('"%s" path does not exist' % biometric_path)
+
+        if self.optimize_media:
+            return self.optimize_biometric(biometric_path)
+
+        if self.biometric_cache is not None:
+            return self.biometric_cache.get(biometric_path)
+
+        return Base64File(biometric_path)
+
+    def optimize_biometric(self, biometric_path):
+        """
+        Get the base64 encoding of a biometric asset shrunk to what the API
+        makes use of
+
+        Arguments:
+        biometric_path <string> -- file path to asset
+        """
+
+        # Only imported when needed, as it loads PIL
+        from aimbrain.commands.utils import media
+
+        def optimize(path):
+            return media.optimize(path, self.auth_method, self.avconv)
+
+        start = time.time()
+        if self.biometric_cache is not None:
+            encoded = self.biometric_cache.get(
+                biometric_path,
+                optimize,
+                'optimized-%s' % self.auth_method,
+            )
+        else:
+            encoded = base64.b64encode(optimize(biometric_path))
+
+        record = {
+            'path': biometric_path,
+            'original': (os.path.getsize(biometric_path) + 2) // 3 * 4,
+            'sent': len(encoded),
+            'time': time.time() - start,
+        }
+        self.optimized.append(record)
+        trace.record(
+            'optimize',
+            start,
+            record['time'],
+            path=biometric_path,
+            bytes=record['sent'],
+        )
+
+        if not self.quiet:
+            print('[optimized %s][%d -> %d bytes, %.1f%% smaller][%.2fs]' % (
+                biometric_path,
+                record['original'],
+                record['sent'],
+                100.0 * (record['original'] - record['sent']) /
+                (record['original'] or 1),
+                record['time'],
+            ))
+
+        return encoded
+
     def do_request(self, endpoint, body, require_session=True):
         """
         Send a request to AimBrain API
@@ -220,10 +668,232 @@ class AbstractRequestGenerator(BaseCommand):
         body <dict> -- Body of request
         """
 
+        cached = False
         if require_session and 'session' not in body:
             body['session'] = self.get_session()
+            cached = self.session_cached
 
-        self.get_response_payload(endpoint, json.dumps(body))
+        resp, response_payload = self.get_response(
+            endpoint,
+            JSONStream(body),
+        )
+
+        # A cached session the API rejects may have expired early, so don't
+        # hand it to the next invocation. The status is this request's own,
+        # as other batches in flight share self.responses.
+        if cached and 400 <= resp.status_code < 500:
+            self.session_cache.delete(self.get_session_key())
+
+        if not response_payload:
+            raise SystemExit('Failed to get session, got: %s' % resp.text)
+
+
+class AsyncRequestGenerator(AbstractRequestGenerator):
+    """
+    Counterpart to AbstractRequestGenerator that queues requests instead of
+    sending them one at a time, then runs them all from a single thread with
+    at most --concurrency in flight. Requests are signed, compressed,
+    retried and traced exactly as the synchronous ones are.
+    """
+
+    def __init__(self, options, *args, **kwargs):
+        super(AsyncRequestGenerator, self).__init__(options, args, kwargs)
+
+        concurrency = int(options.get('--concurrency') or 100)
+        if concurrency < 1:
+            raise SystemExit('--concurrency must be at least 1')
+
+        self.loop = HTTPLoop(concurrency)
+        self.sessions = {}
+
+    def submit(self, endpoint, payload, delay=0, responses=None):
+        """
+        Queue a signed request, returning a Future for the JSON response
+
+        Arguments:
+        endpoint <string> -- HTTP endpoint request is being sent to
+        payload <string> -- JSON encoded body of request
+
+        Optional Arguments:
+        delay <float> -- Seconds to wait before sending the request
+        responses <list> -- Also given the record of the response, e.g. to
+            collect those of one user
+        """
+
+        url = self.get_url(endpoint)
+        headers = self.get_aimbrain_headers('POST', endpoint, payload)
+        body = self.compress_payload(payload, headers)
+
+        result = Future()
+        attempts = []
+
+        def send(delay):
+            start = time.time() + delay
+            self.loop.request(
+                'POST',
+                url,
+                body,
+                headers,
+                delay,
+            ).add_done_callback(lambda future: receive(future, start))
+
+        def receive(future, start):
+            resp = future.value if future.error is None else None
+            status = resp.status_code if resp is not None else None
+            attempts.append({
+                'status': status,
+                'time': time.time() - start,
+                'hedged': False,
+            })
+            trace.record(
+                'request',
+                start,
+                time.time() - start,
+                endpoint=endpoint,
+                status=status,
+            )
+
+            if self.retry_policy.should_retry(len(attempts), status):
+                retry_delay = self.retry_policy.get_delay(
+                    len(attempts),
+                    resp.headers.get('retry-after') if resp else None,
+                )
+                if retry_delay is not None:
+                    send(retry_delay)
+                    return
+
+            if resp is None:
+                result.set_error(future.error)
+                return
+
+            try:
+                result.set_result(self.handle_response(
+                    endpoint,
+                    resp,
+                    attempts,
+                    responses,
+                ))
+            except ValueError as e:
+                result.set_error(e)
+
+        send(delay)
+        return result
+
+    def handle_response(self, endpoint, resp, attempts=None, responses=None):
+        response_payload = ''
+        with trace.span('parse', endpoint=endpoint) as args:
+            try:
+                response_payload = resp.json()
+            except ValueError:
+                args['error'] = 'Invalid JSON'
+
+        record = {
+            'endpoint': endpoint,
+            'status': resp.status_code,
+            'time': resp.elapsed,
+            'handshake': resp.handshake_time,
+            'attempts': attempts or [],
+            'payload': response_payload,
+        }
+        self.responses.append(record)
+        if responses is not None:
+            responses.append(record)
+
+        if not self.quiet:
+            print('\n[%s][%d][%.2fs][handshake %.2fs] %s\n' % (
+                endpoint,
+                resp.status_code,
+                resp.elapsed,
+                resp.handshake_time,
+                response_payload or resp.text
+            ))
+
+        if not response_payload:
+            raise ValueError('Failed to get response, got: %s' % resp.text)
+
+        return response_payload
+
+    def submit_session(self, user_id, delay=0, responses=None):
+        """
+        Queue a session request for a user, returning a Future for the
+        session ID. Sessions are created once per user, or taken from the
+        session cache.
+
+        Arguments:
+        user_id <string> -- User to create the session for
+
+        Optional Arguments:
+        delay <float> -- Seconds to wait before sending the request
+        responses <list> -- Also given the record of the response
+        """
+
+        if user_id in self.sessions:
+            return self.sessions[user_id]
+
+        key = self.get_session_key(user_id)
+        if self.session_cache is not None:
+            session = self.session_cache.get(key)
+            if session:
+                self.sessions[user_id] = Future()
+                self.sessions[user_id].set_result(session)
+                return self.sessions[user_id]
+
+        payload = serializer.dumps({
+            'userId': user_id,
+            'device': self.device,
+            'system': self.system
+        })
+
+        def get_session(response_payload):
+            session = response_payload.get('session')
+            if not session:
+                raise ValueError('Failed to get session')
+
+            if self.session_cache is not None:
+                self.session_cache.put(key, session)
+
+            return session
+
+        self.sessions[user_id] = self.submit(
+            V1_SESSIONS_ENDPOINT,
+            payload,
+            delay,
+            responses,
+        ).then(get_session)
+
+        return self.sessions[user_id]
+
+    def submit_request(self, endpoint, body, user_id=None, delay=0,
+                       responses=None):
+        """
+        Queue a request, first creating a session for user_id if the body
+        doesn't already have one, returning a Future for the JSON response
+
+        Arguments:
+        endpoint <string> -- HTTP endpoint request is being sent to
+        body <dict> -- Body of request
+
+        Optional Arguments:
+        user_id <string> -- User to create a session for
+        delay <float> -- Seconds to wait before sending the first request
+        responses <list> -- Also given the records of the responses
+        """
+
+        def send(session=None, delay=0):
+            if session is not None:
+                body['session'] = session
+
+            # Biometrics streamed from disk are read in whole once queued
+            payload = ''.join(JSONStream(body).chunks())
+            return self.submit(endpoint, payload, delay, responses)
+
+        if user_id is None or 'session' in body:
+            return send(delay=delay)
+
+        return self.submit_session(user_id, delay, responses).then(send)
+
+    def run(self):
+        self.loop.run()
 
 
 class Auth(AbstractRequestGenerator):
@@ -235,7 +905,11 @@ class Auth(AbstractRequestGenerator):
         super(Auth, self).__init__(options, args, kwargs)
 
         self.token = options.get('--token')
+
+        # Auth takes a single biometric, unlike enroll
         self.biometrics = options.get('<biometrics>')
+        if isinstance(self.biometrics, basestring):
+            self.biometrics = [self.biometrics]
 
     def run(self):
         token_endpoint = ''
@@ -261,7 +935,7 @@ class Auth(AbstractRequestGenerator):
 
         body = {biometric_key: []}
         for biometric in self.biometrics:
-            body[biometric_key].append(self.encode_biometric(biometric))
+            body[biometric_key].append(self.stream_biometric(biometric))
 
         self.do_request(endpoint, body)
 
@@ -280,8 +954,8 @@ class Compare(AbstractRequestGenerator):
     def run(self):
         if self.auth_method == 'face':
             body = {
-                'faces1': [self.encode_biometric(self.biometric1)],
-                'faces2': [self.encode_biometric(self.biometric2)]
+                'faces1': [self.stream_biometric(self.biometric1)],
+                'faces2': [self.stream_biometric(self.biometric2)]
             }
 
             self.do_request(
@@ -319,11 +993,284 @@ class Enroll(AbstractRequestGenerator):
 
         body = {biometric_key: []}
         for biometric in self.biometrics:
-            body[biometric_key].append(self.encode_biometric(biometric))
+            body[biometric_key].append(self.stream_biometric(biometric))
 
         self.do_request(endpoint, body)
 
 
+class EnrollBatch(BaseCommand):
+    """
+    Enroll many users listed in a manifest, several at a time, recording the
+    outcome of each in a results file that a rerun resumes from.
+    """
+
+    def __init__(self, options, *args, **kwargs):
+        super(EnrollBatch, self).__init__(options, *args, **kwargs)
+
+        self.manifest = options.get('<manifest>')
+        self.results = options.get('--results') or (
+            '%s.results.jsonl' % self.manifest
+        )
+
+        self.concurrency = int(
+            options.get('--concurrency') or DEFAULT_BATCH_CONCURRENCY
+        )
+        if self.concurrency < 1:
+            raise SystemExit('--concurrency must be at least 1')
+
+        # Users are enrolled on --concurrency threads sharing one pool
+        self.options = connection.fit_pool_size(options, self.concurrency)
+
+        self.rate_limiter = parse_rate(options.get('--rate'), '--rate')
+
+        # Requests can instead be sent from one thread on non-blocking
+        # sockets, with --concurrency users enrolling at once
+        self.use_async = bool(options.get('--async'))
+
+    def read_manifest(self):
+        """
+        Read users from a CSV manifest with user_id and biometrics columns,
+        biometrics being ;-separated paths, or from JSON lines with a
+        user_id and a list of biometrics
+        """
+
+        if not os.path.exists(self.manifest):
+            raise SystemExit('Manifest does not exist - "%s"' % self.manifest)
+
+        users = []
+        with open(self.manifest, 'r') as f:
+            if self.manifest.endswith(('.jsonl', '.json')):
+                rows = [serializer.loads(line) for line in f if line.strip()]
+            else:
+                rows = list(csv.DictReader(f))
+
+        for i, row in enumerate(rows):
+            biometrics = row.get('biometrics') or []
+            if not isinstance(biometrics, list):
+                biometrics = [b for b in biometrics.split(';') if b]
+
+            if not row.get('user_id') or not biometrics:
+                raise SystemExit(
+                    'Manifest entry %d needs a user_id and biometrics' % (
+                        i + 1
+                    )
+                )
+
+            users.append((row['user_id'], biometrics))
+
+        return users
+
+    def read_completed(self):
+        """
+        User IDs already enrolled successfully by a previous run
+        """
+
+        completed = set()
+        if not os.path.exists(self.results):
+            return completed
+
+        with open(self.results, 'r') as f:
+            for line in f:
+                try:
+                    result = serializer.loads(line)
+                except ValueError:
+                    # A run killed mid-write leaves a partial last line
+                    continue
+
+                if result.get('status') == 'ok':
+                    completed.add(result.get('user_id'))
+
+        return completed
+
+    def enroll(self, user):
+        """
+        Enroll a single user, run on a worker thread
+
+        Arguments:
+        user <tuple> --- User ID and list of biometric paths
+        """
+
+        user_id, biometrics = user
+        options = dict(self.options)
+        options['--user-id'] = user_id
+        options['<biometrics>'] = biometrics
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        start = time.time()
+        error = None
+        cmd = Enroll(options)
+        cmd.quiet = True
+        if cmd.biometric_cache is None:
+            cmd.biometric_cache = biometric_cache.get_cache()
+        try:
+            cmd.run()
+        except SystemExit as e:
+            error = str(e)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+
+        status_code = None
+        if cmd.responses:
+            status_code = cmd.responses[-1]['status']
+            if error is None and status_code >= 400:
+                error = 'Request failed with status %d' % status_code
+
+        return {
+            'user_id': user_id,
+            'status': 'failed' if error else 'ok',
+            'http_status': status_code,
+            'latency': round(time.time() - start, 4),
+            'error': error,
+        }
+
+    def submit_enrollment(self, api, user, done):
+        """
+        Queue the session and enrollment requests of a user, run on the
+        async engine's thread
+
+        Arguments:
+        api <AsyncRequestGenerator> --- Engine to queue the requests on
+        user <tuple> --- User ID and list of biometric paths
+        done <function> --- Called with the result of the enrollment
+        """
+
+        user_id, biometrics = user
+        endpoint, biometric_key = ENROLL_ENDPOINTS[api.auth_method]
+
+        delay = 0
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.reserve()
+
+        start = time.time()
+        responses = []
+
+        def finish(future):
+            error = None
+            if future.error is not None:
+                error = str(future.error)
+
+            status_code = None
+            if responses:
+                status_code = responses[-1]['status']
+                if error is None and status_code >= 400:
+                    error = 'Request failed with status %d' % status_code
+
+            done({
+                'user_id': user_id,
+                'status': 'failed' if error else 'ok',
+                'http_status': status_code,
+                'latency': round(time.time() - start, 4),
+                'error': error,
+            })
+
+        try:
+            body = {biometric_key: [
+                api.stream_biometric(biometric) for biometric in biometrics
+            ]}
+        except SystemExit as e:
+            failed = Future()
+            failed.set_error(e)
+            finish(failed)
+            return
+
+        api.submit_request(
+            endpoint,
+            body,
+            user_id=user_id,
+            delay=delay,
+            responses=responses,
+        ).add_done_callback(finish)
+
+    def enroll_async(self, pending, record):
+        """
+        Enroll users from one thread, starting the next user as each
+        finishes so that no more than --concurrency are held in memory
+
+        Arguments:
+        pending <list> --- Users to enroll
+        record <function> --- Called with the result of each enrollment
+        """
+
+        options = dict(self.options)
+        options['--concurrency'] = str(self.concurrency)
+        api = AsyncRequestGenerator(options)
+        api.quiet = True
+        if api.biometric_cache is None:
+            api.biometric_cache = biometric_cache.get_cache()
+
+        users = iter(pending)
+
+        def start_next():
+            for user in itertools.islice(users, 1):
+                self.submit_enrollment(api, user, done)
+
+        def done(result):
+            record(result)
+            start_next()
+
+        for _ in range(self.concurrency):
+            start_next()
+
+        try:
+            api.run()
+        finally:
+            api.loop.close()
+
+    def enroll_threaded(self, pending, record):
+        pool = ThreadPool(self.concurrency, inherit_output())
+        try:
+            for result in pool.imap_unordered(self.enroll, pending):
+                record(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self):
+        users = self.read_manifest()
+        completed = self.read_completed()
+        pending = [user for user in users if user[0] not in completed]
+
+        print('Enrolling %d users, %d already enrolled' % (
+            len(pending),
+            len(users) - len(pending),
+        ))
+
+        failures = []
+        start = time.time()
+
+        # Results are appended as they arrive so an interrupted run can be
+        # resumed from the same file
+        with open(self.results, 'a') as f:
+            def record(result):
+                f.write(serializer.dumps(result) + '\n')
+                f.flush()
+
+                if result['error']:
+                    failures.append(result['user_id'])
+                    print('[%s][failed][%.2fs] %s' % (
+                        result['user_id'],
+                        result['latency'],
+                        result['error'],
+                    ))
+
+            if self.use_async:
+                self.enroll_async(pending, record)
+            else:
+                self.enroll_threaded(pending, record)
+
+        print('\n%d enrolled, %d failed in %.2fs, results in %s' % (
+            len(pending) - len(failures),
+            len(failures),
+            time.time() - start,
+            self.results,
+        ))
+
+        if failures:
+            raise SystemExit('%d enrollments failed' % len(failures))
+
+
 class Score(AbstractRequestGenerator):
     """
     Get classification score
@@ -352,13 +1299,102 @@ class BehaviouralSubmit(AbstractRequestGenerator):
 
         self.data = options.get('<data>')
 
+        self.batch_events = int(
+            options.get('--batch-events') or behavioural.DEFAULT_BATCH_EVENTS
+        )
+        self.batch_bytes = int(
+            options.get('--batch-bytes') or behavioural.DEFAULT_BATCH_BYTES
+        )
+        self.in_flight = int(options.get('--in-flight') or 1)
+        if min(self.batch_events, self.batch_bytes, self.in_flight) < 1:
+            raise SystemExit(
+                '--batch-events, --batch-bytes and --in-flight must be at '
+                'least 1'
+            )
+
+    def submit_batch(self, body):
+        """
+        Submit one batch of events, run on a worker thread when several are
+        in flight, returning how many events it held and the error if it
+        failed
+        """
+
+        events = behavioural.count_events(body)
+        try:
+            self.do_request(V1_BEHAVIOURAL_SUBMIT, body)
+        except SystemExit as e:
+            return events, str(e)
+
+        return events, None
+
+    def submit_batches(self, batches):
+        start = time.time()
+        events = 0
+        submitted = 0
+
+        # The first batch creates the session the rest are submitted under,
+        # so it's sent before any others are put in flight
+        batches = iter(batches)
+        first = itertools.imap(self.submit_batch, itertools.islice(batches, 1))
+
+        pool = None
+        if self.in_flight > 1:
+            pool = ThreadPool(self.in_flight, inherit_output())
+            rest = ordered_imap(
+                pool,
+                self.submit_batch,
+                batches,
+                self.in_flight,
+            )
+        else:
+            rest = itertools.imap(self.submit_batch, batches)
+
+        try:
+            for batch_events, error in itertools.chain(first, rest):
+                if error:
+                    raise SystemExit(error)
+
+                events += batch_events
+                submitted += 1
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if not self.quiet:
+            print('Submitted %d events in %d batches in %.2fs' % (
+                events,
+                submitted,
+                time.time() - start,
+            ))
+
     def run(self):
         endpoint = V1_BEHAVIOURAL_SUBMIT
         if not os.path.exists(self.data):
             raise SystemExit('Data file does not exist - "%s"' % self.data)
         with open(self.data, 'r') as f:
-            data = json.load(f)
-            self.do_request(endpoint, data)
+            try:
+                fragments = iter(behavioural.read_fragments(f))
+                head = list(itertools.islice(fragments, 2))
+                if not head:
+                    raise ValueError('No JSON value found')
+
+                if len(head) == 1 and not isinstance(head[0], dict):
+                    # Not made of event lists to batch, so sent as it is
+                    self.do_request(endpoint, head[0])
+                    return
+
+                self.submit_batches(behavioural.batch_events(
+                    itertools.chain(head, fragments),
+                    self.batch_events,
+                    self.batch_bytes,
+                ))
+            except ValueError as e:
+                raise SystemExit('Invalid behavioural data in "%s": %s' % (
+                    self.data,
+                    e,
+                ))
 
 
 class Token(AbstractRequestGenerator):
@@ -386,5 +1422,8 @@ class Session(AbstractRequestGenerator):
     Implements session requests for both face and voice.
     """
 
+    # Run to get a new session, so never handed a cached one
+    creates_session = True
+
     def run(self):
         self.get_session()
@@ -0,0 +1,278 @@
+"""
+aimbrain-cli bench
+
+Usage:
+  aimbrain-cli bench [--requests=<n> | --duration=<seconds>] [--rps=<rps>] [--concurrency=<n>] [--reuse-session] [--cache-biometrics] [--report=<file>] <command> [<args>...]
+
+Options:
+  --requests=<n>          Times to run the command, defaults to 100 unless --duration is given
+  --duration=<seconds>    Run the command repeatedly for this long instead
+  --rps=<rps>             Maximum runs of the command to start per second
+  --concurrency=<n>       Runs of the command in flight at once [default: 1]
+  --reuse-session         Get a session once per thread rather than for every run
+  --cache-biometrics      Read and encode biometrics once rather than for every run
+  --report=<file>         Write the JSON report here instead of to stdout
+
+Commands:
+  auth, behavioural-submit, compare, score, session, token
+
+Examples:
+  aimbrain-cli bench --requests=500 --concurrency=8 session --user-id=user --api-key=key --secret=secret
+  aimbrain-cli bench --duration=60 --rps=20 --report=auth.json auth face /path/to/face_image.png --user-id=user --api-key=key --secret=secret
+"""
+
+import json
+import threading
+import time
+
+from aimbrain.commands.api import Auth
+from aimbrain.commands.api import BehaviouralSubmit
+from aimbrain.commands.api import Compare
+from aimbrain.commands.api import Score
+from aimbrain.commands.api import Session
+from aimbrain.commands.api import Token
+from aimbrain.commands.base import BaseCommand
+from aimbrain.commands.utils import biometric_cache
+from aimbrain.commands.utils import connection
+from aimbrain.commands.utils.histogram import LatencyHistogram
+from aimbrain.commands.utils.throttle import parse_rate
+
+
+DEFAULT_REQUESTS = 100
+
+# Bench options that take a value, which may be given as a separate argument
+VALUE_OPTIONS = (
+    '--requests',
+    '--duration',
+    '--rps',
+    '--concurrency',
+    '--report',
+)
+
+COMMANDS = {
+    'auth': Auth,
+    'behavioural-submit': BehaviouralSubmit,
+    'compare': Compare,
+    'score': Score,
+    'session': Session,
+    'token': Token,
+}
+
+
+def split_argv(argv):
+    """
+    Split `bench [options] <command> [<args>...]` arguments into those for
+    bench itself, ending with the command, and those for the command
+
+    Arguments:
+    argv <list> --- Command line arguments, starting with bench
+    """
+
+    i = 1
+    while i < len(argv) and argv[i].startswith('-'):
+        if argv[i] in VALUE_OPTIONS:
+            i += 1
+        i += 1
+
+    return argv[:i + 1], argv[i:]
+
+
+class Bench(BaseCommand):
+    """
+    Replay an API command many times, from several threads if asked, and
+    report the latency distribution, throughput and errors of its requests.
+    """
+
+    def __init__(self, options, command_options, *args, **kwargs):
+        super(Bench, self).__init__(options, *args, **kwargs)
+
+        self.command = options.get('<command>')
+        if self.command not in COMMANDS:
+            raise SystemExit('Cannot bench "%s", choose from %s' % (
+                self.command,
+                ', '.join(sorted(COMMANDS)),
+            ))
+
+        duration = options.get('--duration')
+        self.duration = float(duration) if duration else None
+        if self.duration is not None and self.duration <= 0:
+            raise SystemExit('--duration must be positive')
+
+        self.requests = None
+        if self.duration is None:
+            self.requests = int(options.get('--requests') or DEFAULT_REQUESTS)
+            if self.requests < 1:
+                raise SystemExit('--requests must be at least 1')
+
+        self.concurrency = int(options.get('--concurrency') or 1)
+        if self.concurrency < 1:
+            raise SystemExit('--concurrency must be at least 1')
+
+        # Each thread runs its own command, all sharing one pool
+        self.command_options = connection.fit_pool_size(
+            command_options,
+            self.concurrency,
+        )
+
+        # Off unless asked for, so that each run pays for what a single
+        # invocation would, and recorded in the report when on
+        self.reuse_session = bool(options.get('--reuse-session'))
+        self.cache_biometrics = bool(options.get('--cache-biometrics'))
+
+        self.rate_limiter = parse_rate(options.get('--rps'), '--rps')
+        self.report = options.get('--report')
+
+        self.started = 0
+        self.lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.endpoints = {}
+        self.statuses = {}
+        self.failures = {}
+        self.media = {'original_bytes': 0, 'sent_bytes': 0}
+
+    def next_run(self, deadline):
+        """
+        Claim the next run of the command, False once there are none left
+        """
+
+        with self.lock:
+            if self.requests is not None:
+                if self.started >= self.requests:
+                    return False
+            elif time.time() >= deadline:
+                return False
+
+            self.started += 1
+            return True
+
+    def count(self, counts, key):
+        with self.lock:
+            counts[key] = counts.get(key, 0) + 1
+
+    def record(self, responses, error):
+        for response in responses:
+            self.latency.record(response['time'])
+
+            with self.lock:
+                histogram = self.endpoints.get(response['endpoint'])
+                if histogram is None:
+                    histogram = LatencyHistogram()
+                    self.endpoints[response['endpoint']] = histogram
+
+            histogram.record(response['time'])
+            self.count(self.statuses, str(response['status']))
+
+        if error is not None:
+            # Failures before any response, e.g. refused connections
+            if not responses:
+                self.count(self.statuses, 'error')
+
+            self.count(self.failures, error)
+
+    def worker(self, cmd, deadline):
+        while True:
+            # Wait for a slot before claiming a run, so no run starts after
+            # the deadline
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            if not self.next_run(deadline):
+                break
+
+            # Session runs always fetch one, as that is what they measure
+            if not self.reuse_session or self.command == 'session':
+                cmd.session = None
+
+            cmd.responses = []
+            cmd.optimized = []
+            error = None
+            try:
+                cmd.run()
+            except SystemExit as e:
+                error = str(e)
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+
+            self.record(cmd.responses, error)
+            with self.lock:
+                for record in cmd.optimized:
+                    self.media['original_bytes'] += record['original']
+                    self.media['sent_bytes'] += record['sent']
+
+    def get_report(self, elapsed):
+        requests = sum(self.statuses.values())
+        errors = sum(
+            count for status, count in self.statuses.items()
+            if status == 'error' or int(status) >= 400
+        )
+
+        return {
+            'command': self.command,
+            'runs': self.started,
+            'requests': requests,
+            'concurrency': self.concurrency,
+            'reuse_session': self.reuse_session,
+            'cache_biometrics': self.cache_biometrics,
+            'elapsed': round(elapsed, 4),
+            'throughput': round(requests / elapsed, 4) if elapsed else None,
+            'error_rate': round(float(errors) / requests, 4)
+            if requests else None,
+            'status_codes': self.statuses,
+            'errors': self.failures,
+            'latency': self.latency.to_dict(),
+            'media': self.media,
+            'endpoints': dict(
+                (endpoint, histogram.to_dict())
+                for endpoint, histogram in self.endpoints.items()
+            ),
+        }
+
+    def run(self):
+        deadline = time.time() + (self.duration or 0)
+
+        # One command per thread, created up front so bad options fail here
+        cmds = []
+        for _ in range(self.concurrency):
+            cmd = COMMANDS[self.command](self.command_options)
+            cmd.quiet = True
+            if self.cache_biometrics and cmd.biometric_cache is None:
+                cmd.biometric_cache = biometric_cache.get_cache()
+            cmds.append(cmd)
+
+        start = time.time()
+        threads = [
+            threading.Thread(target=self.worker, args=(cmd, deadline))
+            for cmd in cmds
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Join with a timeout so that Ctrl-C still interrupts the run
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+        report = self.get_report(time.time() - start)
+        if not self.report:
+            print(json.dumps(report, indent=2, sort_keys=True))
+            return
+
+        with open(self.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        latency = report['latency']
+        if latency['count']:
+            print('%d requests in %.2fs (%.2f/s), %d%% errors, '
+                  'p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs' % (
+                      report['requests'],
+                      report['elapsed'],
+                      report['throughput'],
+                      report['error_rate'] * 100,
+                      latency['p50'],
+                      latency['p90'],
+                      latency['p99'],
+                      latency['max'],
+                  ))
+
+        print('Report written to %s' % self.report)
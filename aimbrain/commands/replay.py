@@ -0,0 +1,219 @@
+import json
+import os
+import threading
+import time
+
+from aimbrain.commands.api import AbstractRequestGenerator
+from aimbrain.commands.api import V1_BEHAVIOURAL_SUBMIT
+from aimbrain.commands.api import V1_SCORE_ENDPOINT
+from aimbrain.commands.base import BaseCommand
+from aimbrain.commands.utils import behavioural
+from aimbrain.commands.utils.histogram import LatencyHistogram
+
+
+DEFAULT_USER_ID = 'replay'
+
+
+class BehaviouralReplay(BaseCommand):
+    """
+    Replay recorded behavioural data against the API as a number of
+    simulated devices would send it, each in its own session.
+
+    Each session submits the events of one recording a window at a time,
+    when that window comes round in the recording's timeline played at
+    --speed, and asks for a score every --score-interval seconds of it.
+    """
+
+    def __init__(self, options, *args, **kwargs):
+        super(BehaviouralReplay, self).__init__(options, *args, **kwargs)
+
+        self.recordings = options.get('<recordings>') or []
+        for recording in self.recordings:
+            if not os.path.exists(recording):
+                raise SystemExit(
+                    'Recording does not exist - "%s"' % recording
+                )
+
+        self.sessions = int(options.get('--sessions') or 1)
+        if self.sessions < 1:
+            raise SystemExit('--sessions must be at least 1')
+
+        # Recorded time passes `speed` times faster, or not at all for max
+        speed = options.get('--speed') or '1'
+        self.speed = None if speed == 'max' else float(speed)
+        if self.speed is not None and self.speed <= 0:
+            raise SystemExit('--speed must be positive or max')
+
+        self.window = float(options.get('--window') or 1)
+        self.score_interval = float(options.get('--score-interval') or 5)
+        if self.window <= 0 or self.score_interval <= 0:
+            raise SystemExit('--window and --score-interval must be positive')
+
+        self.user_id = options.get('--user-id') or DEFAULT_USER_ID
+        self.report = options.get('--report')
+
+        self.lock = threading.Lock()
+        self.events = 0
+        self.windows = 0
+        self.max_lag = 0.0
+        self.latency = {
+            V1_BEHAVIOURAL_SUBMIT: LatencyHistogram(),
+            V1_SCORE_ENDPOINT: LatencyHistogram(),
+        }
+        self.statuses = {}
+        self.failures = {}
+
+    def get_api(self, index):
+        options = dict(self.options)
+        options['--user-id'] = '%s-%d' % (self.user_id, index)
+
+        api = AbstractRequestGenerator(options)
+        api.quiet = True
+        return api
+
+    def request(self, api, endpoint, body):
+        """
+        Send one request of a session, recording its outcome, and return
+        whether it succeeded
+        """
+
+        api.responses = []
+        error = None
+        try:
+            api.do_request(endpoint, body)
+        except SystemExit as e:
+            error = str(e)
+
+        with self.lock:
+            for response in api.responses:
+                status = str(response['status'])
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                if response['endpoint'] in self.latency:
+                    self.latency[response['endpoint']].record(
+                        response['time']
+                    )
+
+                if error is None and response['status'] >= 400:
+                    error = 'Request to %s failed with status %d' % (
+                        response['endpoint'],
+                        response['status'],
+                    )
+
+            if not api.responses:
+                self.statuses['error'] = self.statuses.get('error', 0) + 1
+
+            if error is not None:
+                self.failures[error] = self.failures.get(error, 0) + 1
+
+        return error is None
+
+    def replay_session(self, index, start):
+        """
+        Replay one recording in a session of its own, run on a thread per
+        session
+
+        Arguments:
+        index <int> --- Number of the simulated session
+        start <float> --- Time the replay started
+        """
+
+        api = self.get_api(index)
+        recording = self.recordings[index % len(self.recordings)]
+
+        with open(recording, 'r') as f:
+            last_score = 0.0
+            for offset, body in behavioural.window_events(
+                behavioural.read_fragments(f),
+                self.window,
+            ):
+                if self.speed is not None:
+                    lag = time.time() - (start + offset / self.speed)
+                    if lag < 0:
+                        time.sleep(-lag)
+                    else:
+                        with self.lock:
+                            self.max_lag = max(self.max_lag, lag)
+
+                # Each simulated device submits under its own session
+                body.pop('session', None)
+                if self.request(api, V1_BEHAVIOURAL_SUBMIT, body):
+                    with self.lock:
+                        self.events += behavioural.count_events(body)
+                        self.windows += 1
+
+                if offset - last_score >= self.score_interval:
+                    self.request(api, V1_SCORE_ENDPOINT, {})
+                    last_score = offset
+
+        # Score what the whole recording added up to
+        if api.session:
+            self.request(api, V1_SCORE_ENDPOINT, {})
+
+    def run_session(self, index, start):
+        try:
+            self.replay_session(index, start)
+        except (SystemExit, ValueError) as e:
+            with self.lock:
+                error = 'Session %d stopped: %s' % (index, e)
+                self.failures[error] = self.failures.get(error, 0) + 1
+
+    def get_report(self, elapsed):
+        return {
+            'sessions': self.sessions,
+            'speed': self.speed or 'max',
+            'elapsed': round(elapsed, 4),
+            'events': self.events,
+            'windows': self.windows,
+            'event_rate': round(self.events / elapsed, 4) if elapsed else None,
+            'max_lag': round(self.max_lag, 4),
+            'status_codes': self.statuses,
+            'errors': self.failures,
+            'submit_latency': self.latency[V1_BEHAVIOURAL_SUBMIT].to_dict(),
+            'score_latency': self.latency[V1_SCORE_ENDPOINT].to_dict(),
+        }
+
+    def run(self):
+        start = time.time()
+        threads = [
+            threading.Thread(target=self.run_session, args=(index, start))
+            for index in range(self.sessions)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Join with a timeout so that Ctrl-C still interrupts the replay
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+        report = self.get_report(time.time() - start)
+
+        score = report['score_latency']
+        print('%d events in %d windows from %d sessions in %.2fs (%.1f/s), '
+              'most %.2fs behind schedule' % (
+                  report['events'],
+                  report['windows'],
+                  report['sessions'],
+                  report['elapsed'],
+                  report['event_rate'] or 0,
+                  report['max_lag'],
+              ))
+        if score['count']:
+            print('%d scores, p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs' % (
+                score['count'],
+                score['p50'],
+                score['p90'],
+                score['p99'],
+                score['max'],
+            ))
+
+        for error, count in sorted(report['errors'].items()):
+            print('[%d] %s' % (count, error))
+
+        if self.report:
+            with open(self.report, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        if report['errors']:
+            raise SystemExit('Replay had errors')
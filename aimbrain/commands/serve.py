@@ -0,0 +1,236 @@
+"""
+Long running mode, taking commands as JSON lines.
+
+Each line is a request such as
+
+  {"id": 1, "argv": ["session", "--user-id=user", "--api-key=key",
+                     "--secret=secret"]}
+
+with argv holding the arguments the command would be given on the command
+line. Each gets a JSON line back once it has run, in the order they finish:
+
+  {"id": 1, "ok": true, "error": null, "time": 0.21, "output": "...",
+   "responses": [{"endpoint": "/v1/sessions", "status": 200, ...}]}
+
+Requests are read from stdin, or from any number of connections to a Unix
+socket. Commands share the process's kept-alive connections and encoded
+biometrics, and sessions are reused between commands for --session-ttl
+seconds.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from SocketServer import StreamRequestHandler
+from SocketServer import ThreadingUnixStreamServer
+
+from docopt import docopt
+
+from aimbrain import __version__ as VERSION
+from aimbrain.aimbrain import get_command
+from aimbrain.aimbrain import get_usage
+from aimbrain.commands.base import BaseCommand
+from aimbrain.commands.utils import biometric_cache
+from aimbrain.commands.utils import trace
+from aimbrain.commands.utils.output import ThreadOutput
+from aimbrain.commands.utils.session_cache import DEFAULT_TTL
+from aimbrain.commands.utils.session_cache import MemorySessionCache
+
+
+# Commands that can't be run from within another process's loop
+UNSERVED_COMMANDS = ('serve', 'bench')
+
+# docopt keeps the usage it is parsing against on DocoptExit, so commands
+# parsed against different usages at once must take turns
+parse_lock = threading.Lock()
+
+
+class ServeHandler(StreamRequestHandler):
+
+    def handle(self):
+        def write(line):
+            self.wfile.write(line)
+            self.wfile.flush()
+
+        try:
+            self.server.serve.serve_lines(
+                iter(self.rfile.readline, ''),
+                write,
+            )
+        except socket.error:
+            # The client went away without reading its results
+            pass
+
+
+class ServeServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, serve):
+        ThreadingUnixStreamServer.__init__(self, path, ServeHandler)
+        self.serve = serve
+
+
+class Serve(BaseCommand):
+    """
+    Run CLI commands sent as JSON lines from one warm process
+    """
+
+    def __init__(self, options, *args, **kwargs):
+        super(Serve, self).__init__(options, *args, **kwargs)
+
+        self.socket = options.get('--socket')
+        self.concurrency = int(options.get('--concurrency') or 1)
+        if self.concurrency < 1:
+            raise SystemExit('--concurrency must be at least 1')
+
+        ttl = float(options.get('--session-ttl') or DEFAULT_TTL)
+        if ttl <= 0:
+            raise SystemExit('--session-ttl must be positive')
+
+        self.sessions = MemorySessionCache(ttl)
+
+        # Served commands' requests are traced to the same file
+        if options.get('--trace'):
+            trace.start(options.get('--trace'))
+        self.output = None
+        self.server = None
+
+    def run_command(self, request, result):
+        """
+        Run the command of one request
+
+        Arguments:
+        request <dict> --- Request with the command's argv
+        result <dict> --- Result of the request, given the command's
+            responses whether or not it succeeds
+        """
+
+        argv = request.get('argv')
+        if (not isinstance(argv, list) or not argv or
+                not all(isinstance(arg, basestring) for arg in argv)):
+            raise SystemExit('argv must be a list of arguments')
+
+        if argv[0] in UNSERVED_COMMANDS:
+            raise SystemExit('"%s" can\'t be served' % argv[0])
+
+        with parse_lock:
+            options = docopt(get_usage(argv), argv=argv, version=VERSION)
+        cmd = get_command(options)(options)
+
+        # Commands run without a session cache of their own share sessions
+        # with the rest of the process, except for session commands, which
+        # are run to get a new one
+        if (getattr(cmd, 'session_cache', False) is None and
+                not getattr(cmd, 'creates_session', False)):
+            cmd.session_cache = self.sessions
+        if getattr(cmd, 'biometric_cache', False) is None:
+            cmd.biometric_cache = biometric_cache.get_cache()
+
+        try:
+            cmd.run()
+        finally:
+            result['responses'] = getattr(cmd, 'responses', [])
+
+    def handle_line(self, line):
+        """
+        Parse and run one request line, run on a worker thread, returning
+        the JSON line of its result
+        """
+
+        start = time.time()
+        request = {}
+        result = {'responses': []}
+        error = None
+
+        self.output.capture()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                request = {}
+                raise SystemExit('Requests must be JSON objects')
+
+            self.run_command(request, result)
+        except SystemExit as e:
+            # docopt exits successfully after printing help or the version
+            if isinstance(e.code, basestring):
+                error = e.code
+            elif e.code:
+                error = 'Exited with status %s' % e.code
+        except ValueError as e:
+            error = 'Invalid request: %s' % e
+        except Exception as e:
+            # One failing command mustn't take down the others in flight
+            error = '%s: %s' % (type(e).__name__, e)
+        finally:
+            output = self.output.release()
+
+        result.update({
+            'id': request.get('id'),
+            'ok': error is None,
+            'error': error,
+            'time': round(time.time() - start, 4),
+            'output': output,
+        })
+        return json.dumps(result) + '\n'
+
+    def serve_lines(self, lines, write):
+        """
+        Run the requests in lines, writing their results as they finish
+
+        Arguments:
+        lines <iterable> --- Request JSON lines
+        write <function> --- Called with each result line
+        """
+
+        lines = (line for line in lines if line.strip())
+        pool = ThreadPool(self.concurrency)
+        try:
+            for result in pool.imap_unordered(self.handle_line, lines):
+                write(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def serve_socket(self):
+        if os.path.exists(self.socket):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.socket)
+            except socket.error:
+                # Left behind by a process that is no longer listening
+                os.unlink(self.socket)
+            else:
+                raise SystemExit('Already serving on "%s"' % self.socket)
+            finally:
+                probe.close()
+
+        self.server = ServeServer(self.socket, self)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket)
+
+    def run(self):
+        stdout = sys.stdout
+        self.output = ThreadOutput(stdout)
+        sys.stdout = self.output
+
+        def write(line):
+            stdout.write(line)
+            stdout.flush()
+
+        try:
+            if self.socket:
+                self.serve_socket()
+            else:
+                self.serve_lines(iter(sys.stdin.readline, ''), write)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout = stdout
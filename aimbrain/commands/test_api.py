@@ -1,3 +1,15 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from io import BytesIO
 from tempfile import NamedTemporaryFile
 
 import mock
@@ -5,10 +17,84 @@ import unittest2
 
 from mock import MagicMock
 from mock import patch
+from PIL import Image
 
+from aimbrain.aimbrain import main
 from aimbrain.commands.api import AbstractRequestGenerator
+from aimbrain.commands.api import AsyncRequestGenerator
+from aimbrain.commands.api import Auth
 from aimbrain.commands.api import BehaviouralSubmit
+from aimbrain.commands.api import Enroll
+from aimbrain.commands.api import EnrollBatch
+from aimbrain.commands.api import Score
+from aimbrain.commands.api import Token
 from aimbrain.commands.api import V1_BEHAVIOURAL_SUBMIT
+from aimbrain.commands.api import V1_SESSIONS_ENDPOINT
+from aimbrain.commands.utils import compression
+from aimbrain.commands.utils.async_http import Connection
+from aimbrain.commands.utils.async_http import HTTPLoop
+from aimbrain.commands.utils.async_http import RequestError
+from aimbrain.commands.utils import trace
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the AimBrain API, answering every POST with a
+    session and recording what it received
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.received.append({
+            'path': self.path,
+            'headers': dict(self.headers),
+            'body': body,
+            'client': self.client_address,
+        })
+
+        # respond may also give extra headers
+        result = self.server.respond(self.path, body)
+        status, payload = result[:2]
+        response = json.dumps(payload)
+        self.send_response(status)
+        for name, value in (result[2:] or [{}])[0].items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.received = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def respond(self, path, body):
+        return 200, {'session': 'orange'}
+
+    def handle_error(self, request, client_address):
+        # Clients dropping kept-alive connections is expected
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
 
 
 class TestBaseAPI(unittest2.TestCase):
@@ -97,26 +183,871 @@ class TestBaseAPI(unittest2.TestCase):
             self.api.encode_biometric('ifthisfileexistsyouhaveissuesm8')
 
 
-class TestBehaviouralSubmit(unittest2.TestCase):
-    @patch('os.path.exists', return_value=False)
-    def test_run_non_existent(self, exists):
+class TestConnectionPooling(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connection_reused(self):
         options = {
-            '--api-url': 'https://api.aimbrain.com',
-            '--data': '/tmp/test-data.json',
+            '--api-url': self.server.url,
+            '--secret': 'bannanaman',
+            '--pool-size': '3',
+        }
+        api = AbstractRequestGenerator(options)
+
+        first, _ = api.post(
+            api.get_url(V1_SESSIONS_ENDPOINT),
+            '{}',
+            api.get_aimbrain_headers('POST', V1_SESSIONS_ENDPOINT, '{}'),
+        )
+        second, _ = api.post(
+            api.get_url(V1_SESSIONS_ENDPOINT),
+            '{}',
+            api.get_aimbrain_headers('POST', V1_SESSIONS_ENDPOINT, '{}'),
+        )
+
+        self.assertEquals(first.json(), {'session': 'orange'})
+        self.assertGreater(first.handshake_time, 0)
+        self.assertEquals(second.handshake_time, 0)
+
+        # Both requests arrived over the same kept-alive connection
+        clients = [request['client'] for request in self.server.received]
+        self.assertEquals(clients[0], clients[1])
+
+    def test_invalid_pool_size(self):
+        options = {'--api-url': self.server.url, '--pool-size': '0'}
+        with self.assertRaises(SystemExit):
+            AbstractRequestGenerator(options)
+
+
+class TestAsyncRequestGenerator(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.options = {
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--device': 'golden potato',
+            '--system': 'potato-os',
+            '--concurrency': '8',
         }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_fan_out(self):
+        api = AsyncRequestGenerator(self.options)
+        api.quiet = True
+
+        futures = [
+            api.submit_request('/v1/score', {}, user_id='user%d' % (i % 5))
+            for i in range(40)
+        ]
+        api.run()
+
+        for future in futures:
+            self.assertEquals(future.result(), {'session': 'orange'})
+
+        # One session per user, then every score request
+        paths = [r['path'] for r in self.server.received]
+        self.assertEquals(paths.count(V1_SESSIONS_ENDPOINT), 5)
+        self.assertEquals(paths.count('/v1/score'), 40)
+
+        # Signed the same way as the synchronous client
+        sync = AbstractRequestGenerator(self.options)
+        for request in self.server.received:
+            self.assertEquals(
+                request['headers']['x-aimbrain-signature'],
+                sync.get_hmac('POST', request['path'], request['body']),
+            )
+
+        # Connections were kept alive rather than one per request
+        clients = set(r['client'] for r in self.server.received)
+        self.assertLessEqual(len(clients), 8)
+
+    def test_session_cache(self):
+        directory = tempfile.mkdtemp()
+        self.options['--session-cache'] = os.path.join(directory, 'cache')
+
+        try:
+            for _ in range(2):
+                api = AsyncRequestGenerator(self.options)
+                api.quiet = True
+                future = api.submit_request('/v1/score', {}, user_id='user')
+                api.run()
+                self.assertEquals(future.result(), {'session': 'orange'})
+        finally:
+            shutil.rmtree(directory)
+
+        # The second run reuses the session of the first
+        paths = [r['path'] for r in self.server.received]
+        self.assertEquals(
+            paths,
+            [V1_SESSIONS_ENDPOINT, '/v1/score', '/v1/score'],
+        )
+
+    def test_connection_refused(self):
+        self.server.stop()
+        api = AsyncRequestGenerator(self.options)
+        future = api.submit('/v1/score', '{}')
+        api.run()
+        with self.assertRaises(Exception):
+            future.result()
+
+    def test_error_response(self):
+        self.server.respond = lambda path, body: (500, {})
+        api = AsyncRequestGenerator(self.options)
+        api.quiet = True
+        future = api.submit('/v1/score', '{}')
+        api.run()
+        with self.assertRaises(ValueError):
+            future.result()
+        self.assertEquals(api.responses[0]['status'], 500)
+
+
+class TestHTTPLoop(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.loop = HTTPLoop(concurrency=4)
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.stop()
+
+    def post(self, count):
+        futures = [
+            self.loop.request('POST', self.server.url + '/v1/score', '{}')
+            for _ in range(count)
+        ]
+        self.loop.run()
+        return futures
+
+    def test_reuse(self):
+        self.post(1)
+
+        # An idle connection that can't be checked is replaced rather than
+        # failing the loop
+        with patch.object(Connection, 'closed', side_effect=ValueError()):
+            future, = self.post(1)
+
+        self.assertEquals(future.result().json(), {'session': 'orange'})
+        self.assertEquals(
+            len(set(r['client'] for r in self.server.received)),
+            2,
+        )
+
+    def test_failed_start(self):
+        register = HTTPLoop.register
+        failures = [ValueError('filedescriptor out of range')]
+
+        def flaky_register(loop, conn):
+            if failures:
+                raise failures.pop()
+            return register(loop, conn)
+
+        with patch.object(HTTPLoop, 'register', flaky_register):
+            failed, succeeded = self.post(2)
+
+        # Only the request that couldn't start fails
+        with self.assertRaises(RequestError):
+            failed.result()
+        self.assertEquals(succeeded.result().status_code, 200)
+        self.assertEquals(len(self.server.received), 1)
+
+
+class TestStreamedBody(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+
+        self.voice = os.path.join(self.dir, 'voice.wav')
+        with open(self.voice, 'wb') as f:
+            f.write(os.urandom(100000))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def test_auth(self):
+        options = {
+            'voice': True,
+            '<biometrics>': self.voice,
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+        }
+        api = Auth(options)
+        api.quiet = True
+        api.run()
+
+        request = self.server.received[-1]
+        self.assertEquals(request['path'], '/v1/voice/auth')
+
+        # The single biometric is sent whole, not as one per character
+        with open(self.voice, 'rb') as f:
+            encoded = base64.b64encode(f.read())
+        body = json.loads(request['body'])
+        self.assertEquals(body['voices'], [encoded])
+        self.assertEquals(body['session'], 'orange')
+
+        # Signed the same as the equivalent in-memory body
+        self.assertEquals(
+            request['headers']['x-aimbrain-signature'],
+            api.get_hmac('POST', '/v1/voice/auth', request['body']),
+        )
+        self.assertNotIn('transfer-encoding', request['headers'])
+
+    def test_traced(self):
+        path = os.path.join(self.dir, 'trace.jsonl')
+        options = {
+            'voice': True,
+            '<biometrics>': self.voice,
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--trace': path,
+        }
+
+        with patch.object(trace, 'tracer', trace.NullTracer()):
+            api = Auth(options)
+            api.quiet = True
+            api.run()
+            trace.get_tracer().close()
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        names = set(event['name'] for event in events)
+
+        for name in ('read', 'encode', 'serialize', 'sign', 'connect',
+                     'ttfb', 'download', 'parse'):
+            self.assertIn(name, names)
+
+        # A connection is opened for the session and kept alive for auth
+        self.assertEquals(
+            len([e for e in events if e['name'] == 'connect']),
+            1,
+        )
+        self.assertEquals(
+            [e['args']['endpoint'] for e in events if e['name'] == 'sign'],
+            ['/v1/sessions', '/v1/voice/auth'],
+        )
+
+        # Streamed bodies are read once to sign and again to send
+        self.assertEquals(
+            set(e['args']['path'] for e in events if e['name'] == 'read'),
+            set([self.voice]),
+        )
+
+    def test_cached_biometrics(self):
+        options = {
+            'voice': True,
+            '<biometrics>': [self.voice],
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--biometric-cache': os.path.join(self.dir, 'cache'),
+        }
+        for _ in range(2):
+            api = Enroll(options)
+            api.quiet = True
+            api.run()
+
+        # Cached encodings are sent and signed just like fresh ones
+        first, second = self.server.received[-3], self.server.received[-1]
+        self.assertEquals(second['path'], '/v1/voice/enroll')
+        self.assertEquals(first['body'], second['body'])
+        self.assertEquals(
+            second['headers']['x-aimbrain-signature'],
+            api.get_hmac('POST', '/v1/voice/enroll', second['body']),
+        )
+        self.assertEquals(len(os.listdir(os.path.join(self.dir, 'cache'))), 1)
+
+    def test_optimized_media(self):
+        face = os.path.join(self.dir, 'face.png')
+        Image.frombytes('RGB', (1000, 800), os.urandom(2400000)).save(face)
+
+        options = {
+            'face': True,
+            '<biometrics>': [face],
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--optimize-media': True,
+        }
+        api = Enroll(options)
+        api.quiet = True
+        api.run()
+
+        body = json.loads(self.server.received[-1]['body'])
+        image = Image.open(BytesIO(base64.b64decode(body['faces'][0])))
+        self.assertEquals(image.size, (480, 384))
+
+        record = api.optimized[0]
+        self.assertEquals(record['sent'], len(body['faces'][0]))
+        self.assertLess(record['sent'], record['original'] / 10)
+
+
+class TestCompressedBody(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+
+        self.data = os.path.join(self.dir, 'data.jsonl')
+        with open(self.data, 'w') as f:
+            for i in range(200):
+                f.write(json.dumps({'mouseEvents': [
+                    {'t': i * 10 + j, 'x': j, 'y': 100, 'type': 'move'}
+                    for j in range(10)
+                ]}) + '\n')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def submit(self, **options):
+        options.update({
+            '<data>': self.data,
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+        })
         api = BehaviouralSubmit(options)
+        api.quiet = True
+        api.run()
+        return api
+
+    def test_round_trip(self):
+        for encoding in ('gzip', 'deflate'):
+            self.server.received = []
+            api = self.submit(**{'--compress': encoding})
+
+            request = self.server.received[-1]
+            self.assertEquals(
+                request['headers']['content-encoding'],
+                encoding,
+            )
+            body = compression.decompress(request['body'], encoding)
+            self.assertLess(len(request['body']) * 5, len(body))
+
+            # Decompressed, it's the body sent without compression, signed
+            # as that
+            self.assertEquals(len(json.loads(body)['mouseEvents']), 1000)
+            self.assertEquals(
+                request['headers']['x-aimbrain-signature'],
+                api.get_hmac('POST', V1_BEHAVIOURAL_SUBMIT, body),
+            )
+
+            # The session request is below the threshold
+            session = self.server.received[0]
+            self.assertEquals(session['path'], V1_SESSIONS_ENDPOINT)
+            self.assertNotIn('content-encoding', session['headers'])
+
+    def test_retried(self):
+        self.server.respond = self.respond_with(
+            (503, {'error': 'busy'}),
+            (200, {'session': 'orange'}),
+        )
+        self.submit(**{'--compress': 'gzip', '--retries': '1',
+                       '--backoff': '0', '--batch-events': '2000'})
+
+        # Each attempt is sent the whole compressed body
+        submits = [
+            r for r in self.server.received
+            if r['path'] == V1_BEHAVIOURAL_SUBMIT
+        ]
+        self.assertEquals(len(submits), 2)
+        self.assertEquals(submits[0]['body'], submits[1]['body'])
+
+    def respond_with(self, *responses):
+        responses = list(responses)
+
+        def respond(path, body):
+            if path == V1_SESSIONS_ENDPOINT:
+                return 200, {'session': 'orange'}
+
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+        return respond
+
+    def test_threshold(self):
+        self.submit(**{
+            '--compress': 'gzip',
+            '--compress-threshold': '1000000',
+        })
+        self.assertNotIn(
+            'content-encoding',
+            self.server.received[-1]['headers'],
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(SystemExit):
+            self.submit(**{'--compress': 'br'})
+
+
+class TestCachedSessions(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+        self.options = {
+            'face': True,
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--token': 'enroll-6',
+            '--session-cache': os.path.join(self.dir, 'sessions.json'),
+            '--session-ttl': '60',
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def run_token(self, **options):
+        api = Token(dict(self.options, **options))
+        api.quiet = True
+        api.run()
+
+    def get_paths(self):
+        return [request['path'] for request in self.server.received]
+
+    def test_reused_across_commands(self):
+        self.run_token()
+        self.run_token()
+        self.assertEquals(self.get_paths(), [
+            '/v1/sessions', '/v1/face/token', '/v1/face/token',
+        ])
+
+        # Sessions are per user
+        self.run_token(**{'--user-id': 'tomato'})
+        self.assertEquals(self.get_paths()[-2:], [
+            '/v1/sessions', '/v1/face/token',
+        ])
+
+    def test_rejected_session_dropped(self):
+        self.run_token()
+
+        self.server.respond = lambda path, body: (401, {'error': 'expired'})
+        self.run_token()
+
+        self.server.respond = lambda path, body: (200, {'session': 'orange'})
+        self.run_token()
+        self.assertEquals(self.get_paths(), [
+            '/v1/sessions', '/v1/face/token', '/v1/face/token',
+            '/v1/sessions', '/v1/face/token',
+        ])
+
+    def test_status_of_own_request(self):
+        self.run_token()
+
+        # A rejection recorded by another batch in flight doesn't drop the
+        # session when this one never got a response
+        api = Token(self.options)
+        api.quiet = True
+        api.responses = [{'endpoint': '/v1/face/token', 'status': 401}]
+        with patch.object(api, 'post', side_effect=SystemExit('refused')):
+            with self.assertRaises(SystemExit):
+                api.run()
+
+        self.run_token()
+        self.assertEquals(self.get_paths().count('/v1/sessions'), 1)
+
+        # Rejected without a JSON body, it's still dropped
+        self.server.respond = lambda path, body: (401, None)
+        with self.assertRaises(SystemExit):
+            self.run_token()
+
+        self.server.respond = lambda path, body: (200, {'session': 'orange'})
+        self.run_token()
+        self.assertEquals(self.get_paths().count('/v1/sessions'), 2)
+
+    def test_not_cached_by_default(self):
+        del self.options['--session-cache']
+        self.run_token()
+        self.run_token()
+        self.assertEquals(self.get_paths().count('/v1/sessions'), 2)
+
+    def test_invalid_options(self):
+        with self.assertRaises(SystemExit):
+            Token(dict(self.options, **{'--session-ttl': '0'}))
+
+        with self.assertRaises(SystemExit):
+            Token(dict(self.options, **{
+                '--session-cache': os.path.join(self.dir, 'nope', 'x.json'),
+            }))
+
+
+class TestRetries(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.options = {
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--session': 'orange',
+            '--retries': '2',
+            '--backoff': '0.01',
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def respond_with(self, *responses):
+        # Respond with each in turn, then with the last one
+        responses = list(responses)
+
+        def respond(path, body):
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+        self.server.respond = respond
+
+    def run_score(self, **options):
+        api = Score(dict(self.options, **options))
+        api.quiet = True
+        api.run()
+        return api.responses[-1]
+
+    def test_retried_until_success(self):
+        self.respond_with(
+            (503, {}),
+            (429, {}, {'Retry-After': '0'}),
+            (200, {'score': 1}),
+        )
+
+        response = self.run_score()
+        self.assertEquals(response['status'], 200)
+        self.assertEquals(
+            [attempt['status'] for attempt in response['attempts']],
+            [503, 429, 200],
+        )
+
+        # Every attempt carried the whole signed body
+        bodies = set(request['body'] for request in self.server.received)
+        self.assertEquals(len(bodies), 1)
+
+    def test_gives_up(self):
+        self.respond_with((503, {'error': 'busy'}))
+        response = self.run_score()
+        self.assertEquals(response['status'], 503)
+        self.assertEquals(len(self.server.received), 3)
+
+    def test_status_not_retried(self):
+        self.respond_with((500, {'error': 'broken'}))
+        response = self.run_score(**{'--retry-on': '503'})
+        self.assertEquals(response['status'], 500)
+        self.assertEquals(len(self.server.received), 1)
+
+    def test_long_retry_after_not_waited_for(self):
+        self.respond_with((429, {'error': 'busy'}, {'Retry-After': '3600'}))
+        response = self.run_score()
+        self.assertEquals(len(response['attempts']), 1)
+
+    def test_connection_refused(self):
+        with self.assertRaises(SystemExit):
+            self.run_score(**{'--api-url': 'http://127.0.0.1:1'})
+
+    def test_hedged(self):
+        calls = []
+
+        def respond(path, body):
+            calls.append(path)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return 200, {'score': len(calls)}
+
+        self.server.respond = respond
+
+        start = time.time()
+        response = self.run_score(**{'--hedge': '0.05'})
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEquals(len(calls), 2)
+        self.assertTrue(response['attempts'][0]['hedged'])
+
+    def test_not_hedged_when_fast(self):
+        response = self.run_score(**{'--hedge': '1'})
+        self.assertFalse(response['attempts'][0]['hedged'])
+        self.assertEquals(len(self.server.received), 1)
+
+
+class TestEnrollBatch(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+
+        self.face = os.path.join(self.dir, 'face.png')
+        with open(self.face, 'wb') as f:
+            f.write('boop')
+
+        self.manifest = os.path.join(self.dir, 'users.csv')
+        with open(self.manifest, 'w') as f:
+            f.write('user_id,biometrics\n')
+            f.write('alice,%s;%s\n' % (self.face, self.face))
+            f.write('bob,%s\n' % os.path.join(self.dir, 'missing.png'))
+            f.write('carol,%s\n' % self.face)
+
+        self.options = {
+            'face': True,
+            '<manifest>': self.manifest,
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--concurrency': '2',
+            '--rate': '100',
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def read_results(self):
+        with open(self.manifest + '.results.jsonl') as f:
+            return dict(
+                (r['user_id'], r) for r in (json.loads(l) for l in f)
+            )
+
+    def test_pool_size(self):
+        # Every user enrolling at once keeps a connection alive
+        self.options['--concurrency'] = '16'
+        batch = EnrollBatch(self.options)
+        self.assertEquals(batch.options['--pool-size'], '16')
+
+        # A larger pool is kept
+        self.options['--pool-size'] = '32'
+        batch = EnrollBatch(self.options)
+        self.assertEquals(batch.options['--pool-size'], '32')
+
+    def test_run_and_resume(self):
+        with self.assertRaises(SystemExit):
+            EnrollBatch(self.options).run()
+
+        results = self.read_results()
+        self.assertEquals(results['alice']['status'], 'ok')
+        self.assertEquals(results['alice']['http_status'], 200)
+        self.assertEquals(results['bob']['status'], 'failed')
+        self.assertIn('does not exist', results['bob']['error'])
+        self.assertEquals(results['carol']['status'], 'ok')
+
+        enrolls = [
+            r for r in self.server.received if r['path'] == '/v1/face/enroll'
+        ]
+        self.assertEquals(len(enrolls), 2)
+
+        # Only bob is retried when resuming, failing before any request
+        self.server.received = []
+        with self.assertRaises(SystemExit):
+            EnrollBatch(self.options).run()
+
+        self.assertEquals(self.server.received, [])
+        self.assertEquals(self.read_results()['bob']['status'], 'failed')
+
+    def test_options(self):
+        for rate in ('0', '-1', 'fast', 'nan'):
+            self.options['--rate'] = rate
+            with self.assertRaisesRegexp(SystemExit, 'positive number'):
+                EnrollBatch(self.options)
+
+        # Without --concurrency, as many as the usage says
+        del self.options['--concurrency']
+        del self.options['--rate']
+        self.assertEquals(EnrollBatch(self.options).concurrency, 4)
+
+    def test_async(self):
+        trace_path = os.path.join(self.dir, 'trace.jsonl')
+        with open(self.face, 'wb') as f:
+            f.write('boop' * 1000)
+        busy = []
+
+        def respond(path, body):
+            # The first enrollment is turned away once, to be retried
+            if path == '/v1/face/enroll' and not busy:
+                busy.append(path)
+                return 503, {'error': 'busy'}
+
+            return 200, {'session': 'orange'}
+
+        self.server.respond = respond
+        argv = [
+            'aimbrain-cli', 'enroll-batch', 'face', self.manifest,
+            '--api-key=key', '--secret=bannanaman',
+            '--api-url=%s' % self.server.url, '--async', '--concurrency=2',
+            '--retries=1', '--backoff=0', '--compress=gzip',
+            '--compress-threshold=1', '--trace=%s' % trace_path,
+        ]
+        with patch('sys.argv', argv), \
+                patch.object(trace, 'tracer', trace.NullTracer()):
+            with self.assertRaises(SystemExit):
+                main()
+            trace.get_tracer().close()
+
+        results = self.read_results()
+        self.assertEquals(results['alice']['status'], 'ok')
+        self.assertEquals(results['alice']['http_status'], 200)
+        self.assertIn('does not exist', results['bob']['error'])
+        self.assertEquals(results['carol']['status'], 'ok')
+
+        enrolls = [
+            r for r in self.server.received if r['path'] == '/v1/face/enroll'
+        ]
+        self.assertEquals(len(enrolls), 3)
+
+        # Compressed, and signed as the JSON it decompresses to
+        api = AbstractRequestGenerator(self.options)
+        for request in enrolls:
+            self.assertEquals(request['headers']['content-encoding'], 'gzip')
+            body = compression.decompress(request['body'], 'gzip')
+            self.assertEquals(json.loads(body)['session'], 'orange')
+            self.assertEquals(
+                request['headers']['x-aimbrain-signature'],
+                api.get_hmac('POST', '/v1/face/enroll', body),
+            )
+
+        with open(trace_path) as f:
+            statuses = [
+                event['args']['status'] for event in map(json.loads, f)
+                if event['name'] == 'request' and
+                event['args']['endpoint'] == '/v1/face/enroll'
+            ]
+        self.assertEquals(sorted(statuses), [200, 200, 503])
+
+    def test_async_rate(self):
+        options = dict(self.options, **{'--async': True, '--rate': '10'})
+        start = time.time()
+        with self.assertRaises(SystemExit):
+            EnrollBatch(options).run()
+
+        # Three users started a tenth of a second apart
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEquals(self.read_results()['carol']['status'], 'ok')
+
+
+class TestBehaviouralSubmitBatches(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+        self.data = os.path.join(self.dir, 'events.jsonl')
+        with open(self.data, 'w') as f:
+            for i in range(10):
+                f.write(json.dumps({
+                    'touches': [{'t': i}],
+                    'mouseEvents': [{'t': i}, {'t': i + 0.5}],
+                }) + '\n')
+
+        self.options = {
+            '<data>': self.data,
+            '--user-id': 'potato',
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--batch-events': '7',
+            '--in-flight': '3',
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def test_batches(self):
+        api = BehaviouralSubmit(self.options)
+        api.quiet = True
+        api.run()
+
+        paths = [request['path'] for request in self.server.received]
+        self.assertEquals(paths[0], V1_SESSIONS_ENDPOINT)
+        self.assertEquals(paths[1:], [V1_BEHAVIOURAL_SUBMIT] * 5)
+
+        bodies = [json.loads(r['body']) for r in self.server.received[1:]]
+        touches = []
+        for body in bodies:
+            self.assertEquals(body['session'], 'orange')
+            self.assertLessEqual(
+                len(body.get('touches', [])) +
+                len(body.get('mouseEvents', [])),
+                7,
+            )
+            touches.extend(body.get('touches', []))
+
+        self.assertEquals(
+            sorted(touch['t'] for touch in touches),
+            range(10),
+        )
+
+    def test_failed_batch(self):
+        self.server.respond = lambda path, body: (
+            (200, {'session': 'orange'}) if path == V1_SESSIONS_ENDPOINT
+            else (500, '')
+        )
+
+        api = BehaviouralSubmit(self.options)
+        api.quiet = True
         with self.assertRaises(SystemExit):
             api.run()
 
-    @patch('os.path.exists', return_value=True)
-    @patch('__builtin__.open')
-    @patch('json.load', return_value='test-data')
-    def test_run_exists(self, exists, mopen, jl):
+    def test_long_lines(self):
+        # Lines longer than a megabyte are still read as JSON lines
+        with open(self.data, 'w') as f:
+            for i in range(2):
+                f.write(json.dumps({
+                    'touches': [{'t': i, 'x': 'x' * (1024 * 1024)}],
+                }) + '\n')
+
+        self.options['--batch-events'] = '1'
+        api = BehaviouralSubmit(self.options)
+        api.quiet = True
+        api.run()
+
+        paths = [request['path'] for request in self.server.received]
+        self.assertEquals(paths[1:], [V1_BEHAVIOURAL_SUBMIT] * 2)
+
+    def test_invalid(self):
+        for data in ('', '{"touches": [}\n', '{"touches": []}\n{'):
+            with open(self.data, 'w') as f:
+                f.write(data)
+
+            api = BehaviouralSubmit(self.options)
+            api.quiet = True
+            with self.assertRaises(SystemExit) as raised:
+                api.run()
+            self.assertIn('Invalid behavioural data', str(raised.exception))
+
+
+class TestBehaviouralSubmit(unittest2.TestCase):
+    @patch('os.path.exists', return_value=False)
+    def test_run_non_existent(self, exists):
         options = {
             '--api-url': 'https://api.aimbrain.com',
             '--data': '/tmp/test-data.json',
         }
         api = BehaviouralSubmit(options)
-        api.do_request = MagicMock()
-        api.run()
+        with self.assertRaises(SystemExit):
+            api.run()
+
+    def test_run_exists(self):
+        with NamedTemporaryFile() as f:
+            f.write(json.dumps('test-data'))
+            f.flush()
+
+            options = {
+                '--api-url': 'https://api.aimbrain.com',
+                '<data>': f.name,
+            }
+            api = BehaviouralSubmit(options)
+            api.do_request = MagicMock()
+            api.run()
         api.do_request.assert_called_with(V1_BEHAVIOURAL_SUBMIT, 'test-data')
@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.bench import Bench
+from aimbrain.commands.bench import split_argv
+from aimbrain.commands.test_api import StandInServer
+from aimbrain.commands.utils.histogram import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest2.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+
+        summary = histogram.to_dict()
+        self.assertEquals(summary['count'], 1000)
+        self.assertEquals(summary['min'], 0.001)
+        self.assertEquals(summary['max'], 1.0)
+        self.assertAlmostEquals(summary['mean'], 0.5005)
+
+        # Reported values are within the bucket precision of the true ones
+        for percentile, expected in ((50, 0.5), (90, 0.9), (99, 0.99)):
+            self.assertAlmostEquals(
+                histogram.percentile(percentile),
+                expected,
+                delta=expected * 2 / 128.0,
+            )
+
+        self.assertEquals(
+            sum(count for _, count in summary['buckets']),
+            1000,
+        )
+
+    def test_small_values_exact(self):
+        histogram = LatencyHistogram()
+        for value in (0.000003, 0.000005, 0.000005):
+            histogram.record(value)
+
+        self.assertEquals(histogram.to_dict()['buckets'], [[3, 1], [5, 2]])
+        self.assertEquals(histogram.percentile(50), 0.000005)
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertEquals(histogram.to_dict(), {'count': 0})
+        self.assertIsNone(histogram.percentile(50))
+
+
+class TestBench(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+        self.report = os.path.join(self.dir, 'report.json')
+
+        self.options = {
+            '<command>': 'score',
+            '--requests': '20',
+            '--duration': None,
+            '--rps': None,
+            '--concurrency': '4',
+            '--report': self.report,
+        }
+        self.command_options = {
+            'score': True,
+            '--api-url': self.server.url,
+            '--api-key': 'key',
+            '--secret': 'bannanaman',
+            '--user-id': 'user',
+            '--session': None,
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def read_report(self):
+        with open(self.report) as f:
+            return json.load(f)
+
+    def test_requests(self):
+        Bench(self.options, self.command_options).run()
+
+        report = self.read_report()
+        self.assertEquals(report['runs'], 20)
+
+        # Every run fetches a session of its own, as one invocation would
+        scores = report['endpoints']['/v1/score']
+        sessions = report['endpoints']['/v1/sessions']
+        self.assertEquals(scores['count'], 20)
+        self.assertEquals(sessions['count'], 20)
+        self.assertEquals(report['requests'], 40)
+        self.assertEquals(report['status_codes'], {'200': 40})
+        self.assertFalse(report['reuse_session'])
+        self.assertFalse(report['cache_biometrics'])
+        self.assertEquals(report['error_rate'], 0)
+        self.assertLessEqual(
+            report['latency']['p50'],
+            report['latency']['max'],
+        )
+
+    def test_pool_size(self):
+        self.options['--concurrency'] = '16'
+        bench = Bench(self.options, self.command_options)
+        self.assertEquals(bench.command_options['--pool-size'], '16')
+        self.assertNotIn('--pool-size', self.command_options)
+
+        self.options['--concurrency'] = '2'
+        bench = Bench(self.options, self.command_options)
+        self.assertIs(bench.command_options, self.command_options)
+
+    def test_reuse_session(self):
+        self.options['--reuse-session'] = True
+        Bench(self.options, self.command_options).run()
+
+        # Each thread fetches a session once, then reuses it
+        report = self.read_report()
+        self.assertTrue(report['reuse_session'])
+        self.assertEquals(report['endpoints']['/v1/score']['count'], 20)
+        self.assertEquals(report['endpoints']['/v1/sessions']['count'], 4)
+
+    def test_cache_biometrics(self):
+        face = os.path.join(self.dir, 'face.png')
+        with open(face, 'wb') as f:
+            f.write('boop')
+
+        self.options['<command>'] = 'auth'
+        self.options['--requests'] = '2'
+        self.command_options.update({
+            'auth': True,
+            'face': True,
+            '<biometrics>': face,
+        })
+
+        # Encodings are only shared between runs when asked for
+        for cache_biometrics in (False, True):
+            self.options['--cache-biometrics'] = cache_biometrics
+            with patch('aimbrain.commands.bench.biometric_cache') as cache:
+                cache.get_cache.return_value = None
+                Bench(self.options, self.command_options).run()
+
+            self.assertEquals(cache.get_cache.called, cache_biometrics)
+            self.assertEquals(
+                self.read_report()['cache_biometrics'],
+                cache_biometrics,
+            )
+
+    def test_error_statuses(self):
+        self.server.respond = lambda path, body: (503, {})
+        self.options['<command>'] = 'session'
+        self.options['--requests'] = '5'
+
+        Bench(self.options, self.command_options).run()
+
+        report = self.read_report()
+        self.assertEquals(report['status_codes'], {'503': 5})
+        self.assertEquals(report['error_rate'], 1)
+        self.assertEquals(sum(report['errors'].values()), 5)
+
+    def test_connection_refused(self):
+        self.command_options['--api-url'] = 'http://127.0.0.1:1'
+        self.options['--requests'] = '3'
+        self.options['--concurrency'] = '1'
+
+        Bench(self.options, self.command_options).run()
+
+        report = self.read_report()
+        self.assertEquals(report['status_codes'], {'error': 3})
+        self.assertEquals(report['latency'], {'count': 0})
+
+    def test_duration(self):
+        self.options['--requests'] = None
+        self.options['--duration'] = '0.3'
+        self.options['--rps'] = '20'
+
+        Bench(self.options, self.command_options).run()
+
+        report = self.read_report()
+        self.assertGreater(report['runs'], 0)
+        self.assertLessEqual(report['runs'], 8)
+
+    def test_invalid_rps(self):
+        for rps in ('0', '-1', 'fast'):
+            self.options['--rps'] = rps
+            with self.assertRaisesRegexp(SystemExit, 'positive number'):
+                Bench(self.options, self.command_options)
+
+    def test_unsupported_command(self):
+        self.options['<command>'] = 'videoconv'
+        with self.assertRaises(SystemExit):
+            Bench(self.options, self.command_options)
+
+    def test_split_argv(self):
+        bench_argv, command_argv = split_argv([
+            'bench', '--requests=5', '--report', 'out.json', 'score',
+            '--session=x', '--api-key=key',
+        ])
+
+        self.assertEquals(
+            bench_argv,
+            ['bench', '--requests=5', '--report', 'out.json', 'score'],
+        )
+        self.assertEquals(
+            command_argv,
+            ['score', '--session=x', '--api-key=key'],
+        )
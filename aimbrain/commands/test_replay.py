@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import unittest2
+
+from aimbrain.commands.replay import BehaviouralReplay
+from aimbrain.commands.test_api import StandInServer
+
+
+def get_recording(seconds):
+    return [
+        {'touches': [{'t': 1000 * second + 250 * i} for i in range(4)]}
+        for second in range(seconds)
+    ]
+
+
+class TestBehaviouralReplay(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.dir = tempfile.mkdtemp()
+
+        self.recordings = []
+        for i, seconds in enumerate((4, 2)):
+            path = os.path.join(self.dir, 'recording%d.jsonl' % i)
+            with open(path, 'w') as f:
+                for fragment in get_recording(seconds):
+                    f.write(json.dumps(fragment) + '\n')
+
+            self.recordings.append(path)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def get_replay(self, **options):
+        defaults = {
+            '<recordings>': self.recordings,
+            '--api-key': 'key',
+            '--secret': 'secret',
+            '--api-url': self.server.url,
+            '--sessions': '4',
+            '--speed': 'max',
+            '--window': '1',
+            '--score-interval': '2',
+            '--report': os.path.join(self.dir, 'report.json'),
+        }
+        defaults.update(options)
+        return BehaviouralReplay(defaults)
+
+    def get_received(self, path):
+        return [r for r in self.server.received if r['path'] == path]
+
+    def test_max_speed(self):
+        self.get_replay().run()
+
+        with open(os.path.join(self.dir, 'report.json')) as f:
+            report = json.load(f)
+
+        # Sessions take turns at the recordings, each as its own user
+        self.assertEquals(report['events'], 2 * 4 * 4 + 2 * 2 * 4)
+        self.assertEquals(report['windows'], 2 * 4 + 2 * 2)
+        self.assertEquals(report['errors'], {})
+        self.assertGreater(report['event_rate'], 0)
+
+        sessions = self.get_received('/v1/sessions')
+        self.assertEquals(
+            sorted(json.loads(r['body'])['userId'] for r in sessions),
+            ['replay-0', 'replay-1', 'replay-2', 'replay-3'],
+        )
+
+        # Sessions replaying the longer recording are also scored two
+        # seconds in, before every session is scored at the end
+        self.assertEquals(len(self.get_received('/v1/score')), 2 + 2 + 1 + 1)
+        self.assertEquals(report['score_latency']['count'], 6)
+        self.assertEquals(report['submit_latency']['count'], 12)
+
+        for received in self.get_received('/v1/behavioural/submit'):
+            body = json.loads(received['body'])
+            self.assertEquals(body['session'], 'orange')
+            self.assertEquals(len(body['touches']), 4)
+
+    def test_speed(self):
+        start = time.time()
+        self.get_replay(**{'--speed': '10', '--sessions': '1'}).run()
+
+        # The last window starts three recorded seconds in
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertLess(time.time() - start, 2)
+
+    def test_errors(self):
+        self.server.respond = lambda path, body: (
+            (500, {'error': 'potato'}) if path == '/v1/score'
+            else (200, {'session': 'orange'})
+        )
+
+        with self.assertRaises(SystemExit):
+            self.get_replay(**{'--sessions': '1'}).run()
+
+        with open(os.path.join(self.dir, 'report.json')) as f:
+            report = json.load(f)
+
+        self.assertEquals(report['status_codes']['500'], 2)
+        self.assertEquals(sum(report['errors'].values()), 2)
+
+    def test_missing_recording(self):
+        with self.assertRaises(SystemExit):
+            self.get_replay(**{'<recordings>': ['/no/such/recording']})
@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from StringIO import StringIO
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.serve import Serve
+from aimbrain.commands.serve import ThreadOutput
+from aimbrain.commands.test_api import StandInServer
+from aimbrain.commands.utils.session_cache import MemorySessionCache
+
+
+class TestMemorySessionCache(unittest2.TestCase):
+
+    def test_put_get_delete(self):
+        cache = MemorySessionCache(ttl=60, max_entries=2)
+        cache.put('potato', 'orange')
+        self.assertEquals(cache.get('potato'), 'orange')
+
+        cache.delete('potato')
+        self.assertIsNone(cache.get('potato'))
+
+        for i in range(3):
+            cache.put('user%d' % i, 'session%d' % i)
+            time.sleep(0.01)
+        self.assertIsNone(cache.get('user0'))
+        self.assertEquals(cache.get('user2'), 'session2')
+
+    def test_ttl(self):
+        cache = MemorySessionCache(ttl=0.01)
+        cache.put('potato', 'orange')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('potato'))
+
+    def test_creating(self):
+        cache = MemorySessionCache()
+        order = []
+
+        def create(name):
+            with cache.creating('potato'):
+                order.append(name)
+                time.sleep(0.05)
+                order.append(name)
+
+        threads = [
+            threading.Thread(target=create, args=(name,))
+            for name in ('a', 'b')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # One at a time for a key, and forgotten once nobody is creating
+        self.assertIn(order, (['a', 'a', 'b', 'b'], ['b', 'b', 'a', 'a']))
+        self.assertEquals(cache.creators, {})
+
+
+class TestServe(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.serve = Serve({'--concurrency': '4'})
+        self.serve.output = ThreadOutput(sys.stdout)
+        self.stdout = patch('sys.stdout', self.serve.output)
+        self.stdout.start()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.stdout.stop()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def get_request(self, request_id, *argv):
+        return json.dumps({'id': request_id, 'argv': list(argv) + [
+            '--api-key=key',
+            '--secret=secret',
+            '--api-url=%s' % self.server.url,
+        ]}) + '\n'
+
+    def serve_lines(self, lines):
+        results = []
+        self.serve.serve_lines(lines, results.append)
+        return dict(
+            (result['id'], result)
+            for result in (json.loads(line) for line in results)
+        )
+
+    def test_commands(self):
+        results = self.serve_lines([
+            self.get_request(1, 'session', '--user-id=user'),
+            '\n',
+            self.get_request(2, 'score', '--session=orange'),
+            self.get_request(3, 'token', 'face', '--user-id=user'),
+        ])
+
+        self.assertEquals(sorted(results), [1, 2, 3])
+        self.assertTrue(all(result['ok'] for result in results.values()))
+
+        response = results[2]['responses'][0]
+        self.assertEquals(response['endpoint'], '/v1/score')
+        self.assertEquals(response['status'], 200)
+        self.assertEquals(response['payload'], {'session': 'orange'})
+
+        # What the command printed comes back with it rather than mixed
+        # into the results
+        self.assertIn('[/v1/score][200]', results[2]['output'])
+        self.assertEquals(
+            [r['endpoint'] for r in results[3]['responses']],
+            ['/v1/sessions', '/v1/face/token'],
+        )
+
+    def test_session_commands(self):
+        results = self.serve_lines([
+            self.get_request(1, 'session', '--user-id=user'),
+        ])
+        results.update(self.serve_lines([
+            self.get_request(2, 'session', '--user-id=user'),
+        ]))
+
+        # Each is run for a session of its own, rather than given the
+        # session of the first
+        for result in results.values():
+            self.assertTrue(result['ok'])
+            self.assertEquals(
+                [r['endpoint'] for r in result['responses']],
+                ['/v1/sessions'],
+            )
+            self.assertIn('orange', result['output'])
+
+    def test_worker_output(self):
+        data = os.path.join(self.dir, 'data.jsonl')
+        with open(data, 'w') as f:
+            for i in range(4):
+                f.write(json.dumps({'mouseEvents': [
+                    {'t': i, 'x': 1, 'y': 1, 'type': 'move'},
+                ]}) + '\n')
+
+        stdout = StringIO()
+        self.serve.output.stdout = stdout
+        results = self.serve_lines([self.get_request(
+            1,
+            'behavioural-submit',
+            data,
+            '--user-id=user',
+            '--batch-events=1',
+            '--in-flight=2',
+        )])
+
+        # What the command's workers print is captured with it, and none of
+        # it ends up among the results
+        self.assertTrue(results[1]['ok'])
+        self.assertEquals(
+            results[1]['output'].count('[/v1/behavioural/submit][200]'),
+            4,
+        )
+        self.assertEquals(stdout.getvalue(), '')
+
+    def test_errors(self):
+        results = self.serve_lines([
+            'potato\n',
+            json.dumps({'id': 1, 'argv': 'session'}) + '\n',
+            json.dumps({'id': 2, 'argv': ['bench', 'session']}) + '\n',
+            json.dumps({'id': 3, 'argv': ['session']}) + '\n',
+            json.dumps({'id': 4, 'argv': ['--version']}) + '\n',
+        ])
+
+        self.assertIn('Invalid request', results[None]['error'])
+        self.assertIn('argv', results[1]['error'])
+        self.assertIn('served', results[2]['error'])
+        self.assertIn('Usage:', results[3]['error'])
+        self.assertTrue(results[4]['ok'])
+        self.assertEquals(results[4]['output'].strip(), '0.3.2')
+
+    def test_shared_sessions(self):
+        self.serve_lines([
+            self.get_request(i, 'token', 'face', '--user-id=user')
+            for i in range(3)
+        ] + [self.get_request(3, 'token', 'face', '--user-id=other')])
+
+        # Concurrent commands for a user wait for the first to create the
+        # session and reuse it
+        sessions = [
+            json.loads(r['body'])['userId'] for r in self.server.received
+            if r['path'] == '/v1/sessions'
+        ]
+        self.assertEquals(sorted(sessions), ['other', 'user'])
+        self.assertEquals(len(self.server.received) - len(sessions), 4)
+
+    def test_socket(self):
+        directory = tempfile.mkdtemp()
+        self.serve.socket = os.path.join(directory, 'serve.sock')
+        thread = threading.Thread(target=self.serve.serve_socket)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while not os.path.exists(self.serve.socket):
+                time.sleep(0.01)
+
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(self.serve.socket)
+            client.sendall(
+                self.get_request(1, 'session', '--user-id=user') +
+                self.get_request(2, 'score', '--session=orange')
+            )
+            client.shutdown(socket.SHUT_WR)
+
+            results = [json.loads(line) for line in client.makefile()]
+            client.close()
+
+            self.assertEquals(sorted(r['id'] for r in results), [1, 2])
+            self.assertTrue(all(r['ok'] for r in results))
+
+            # A second server can't take over the socket
+            with self.assertRaises(SystemExit):
+                Serve({'--socket': self.serve.socket}).serve_socket()
+        finally:
+            self.serve.server.shutdown()
+            thread.join()
+            shutil.rmtree(directory)
+
+        self.assertFalse(os.path.exists(self.serve.socket))
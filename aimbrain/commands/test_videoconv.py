@@ -0,0 +1,313 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy
+import unittest2
+
+from mock import MagicMock
+from mock import patch
+from PIL import Image
+
+from aimbrain.commands.utils import filters
+from aimbrain.commands import videoconv
+from aimbrain.commands.utils.pipeline import BufferedIterator
+from aimbrain.commands.videoconv import OPERATIONS
+from aimbrain.commands.videoconv import VideoConv
+from aimbrain.commands.videoconv import VideoConvBatch
+
+
+def get_options(operation='brighten', factor='1.5'):
+    options = {
+        '--in': '/tmp/in.mov',
+        '--out': '/tmp/out.mov',
+        '--avconv': 'avconv',
+        '--ffprobe': 'ffprobe',
+        '<factor>': factor,
+    }
+    options[operation] = True
+    return options
+
+
+class TestBufferedIterator(unittest2.TestCase):
+
+    def test_preserves_order(self):
+        with BufferedIterator(iter(range(100)), 4) as items:
+            self.assertEquals(list(items), range(100))
+
+    def test_bounded_depth(self):
+        produced = []
+
+        def source():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        with BufferedIterator(source(), 2) as items:
+            self.assertEquals(next(items), 0)
+            # Give the producer time to fill the queue
+            items.thread.join(0.2)
+            # One taken, two queued and one waiting to be queued at most
+            self.assertLessEqual(len(produced), 4)
+
+    def test_propagates_errors(self):
+        def source():
+            yield 1
+            raise ValueError('decode failed')
+
+        with BufferedIterator(source(), 2) as items:
+            with self.assertRaises(ValueError):
+                list(items)
+
+    def test_invalid_depth(self):
+        with self.assertRaises(ValueError):
+            BufferedIterator(iter([]), 0)
+
+
+class TestVideoConv(unittest2.TestCase):
+
+    def test_filter_is_lazy(self):
+        def source():
+            yield Image.new('RGB', (4, 4), (100, 100, 100))
+            raise AssertionError('Read more frames than needed')
+
+        options = get_options()
+        options['--chunk-size'] = '1'
+        cmd = VideoConv(options)
+
+        frames = cmd.filter_video(source())
+        frame, = next(frames)
+        self.assertEquals(frame.getpixel((0, 0)), (150, 150, 150))
+
+    def test_parallel_matches_serial(self):
+        frames = [
+            Image.new('RGB', (8, 8), (i, 255 - i, 128)) for i in range(20)
+        ]
+        options = get_options('blur', '1.0')
+        options['--workers'] = '2'
+        options['--chunk-size'] = '3'
+        cmd = VideoConv(options)
+
+        pool = multiprocessing.Pool(cmd.workers)
+        try:
+            parallel = list(cmd.filter_video(iter(frames), pool))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        serial = list(cmd.filter_video(iter(frames)))
+        self.assertEquals(
+            [frame.tobytes() for frame, in parallel],
+            [frame.tobytes() for frame, in serial],
+        )
+
+    def test_variants(self):
+        options = get_options('blur', '1.0')
+        options['--variant'] = [
+            'brighten:1.5:/tmp/brighter.mov',
+            'contrast:0.5:/tmp/with:colon.mov',
+        ]
+        options['--engine'] = 'numpy'
+        cmd = VideoConv(options)
+        self.assertEquals(cmd.variants, [
+            ('blur', 1.0, '/tmp/out.mov'),
+            ('brighten', 1.5, '/tmp/brighter.mov'),
+            ('contrast', 0.5, '/tmp/with:colon.mov'),
+        ])
+
+        frame = numpy.full((4, 4, 3), 100, dtype='uint8')
+        blurred, brightened, contrasted = next(cmd.filter_video(iter([frame])))
+        self.assertEquals(blurred[0, 0, 0], 100)
+        self.assertEquals(brightened[0, 0, 0], 150)
+        self.assertEquals(contrasted[0, 0, 0], 100)
+
+    def test_invalid_variant(self):
+        for variant in ('blur:1.5', 'melt:1:/tmp/out.mov', 'blur:x:out.mov'):
+            options = get_options()
+            options['--variant'] = [variant]
+            with self.assertRaises(SystemExit):
+                VideoConv(options)
+
+    def test_invalid_workers(self):
+        options = get_options()
+        options['--workers'] = '0'
+        with self.assertRaises(SystemExit):
+            VideoConv(options)
+
+    def test_watch_audio_stops_on_failure(self):
+        cmd = VideoConv(get_options())
+        audio = MagicMock()
+        audio.check = MagicMock(side_effect=[None, SystemExit('failed')])
+
+        frames = cmd.watch_audio(iter(range(10)), audio)
+        self.assertEquals(next(frames), 0)
+        with self.assertRaises(SystemExit):
+            next(frames)
+
+
+class TestOutputs(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.options = get_options()
+        self.options['--out'] = os.path.join(self.dir, 'out.mov')
+        self.options['--direct'] = True
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, error=None):
+        def convert_video(pool, audio, work_dir, outputs):
+            for output in outputs:
+                with open(output, 'w') as f:
+                    f.write('video')
+
+            if error is not None:
+                raise error
+
+        return patch.object(
+            VideoConv,
+            'convert_video',
+            side_effect=convert_video,
+        )
+
+    def test_complete(self):
+        with self.convert():
+            VideoConv(self.options).run()
+
+        self.assertEquals(os.listdir(self.dir), ['out.mov'])
+
+    def test_failed(self):
+        with self.convert(SystemExit('Failed to encode video')):
+            with self.assertRaises(SystemExit):
+                VideoConv(self.options).run()
+
+        # Neither the output nor what was written of it is left behind
+        self.assertEquals(os.listdir(self.dir), [])
+
+    def test_failed_combine(self):
+        cmd = VideoConv(self.options)
+        with patch.object(videoconv.subprocess, 'Popen') as Popen:
+            Popen.return_value.wait.return_value = 1
+            with self.assertRaises(SystemExit):
+                cmd.combine_video_and_audio('video.avi', 'audio.wav')
+
+    def test_failed_batch_job(self):
+        def run(cmd):
+            with open(cmd.output, 'w') as f:
+                f.write('half a video')
+            raise ValueError('interrupted')
+
+        with patch.object(VideoConv, 'run', run):
+            job, error, _ = videoconv.run_batch_job(self.options)
+
+        self.assertIn('interrupted', error)
+        self.assertFalse(os.path.exists(self.options['--out']))
+
+
+class TestVideoConvBatch(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def touch(self, name, mtime):
+        path = os.path.join(self.dir, name)
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_manifest(self):
+        manifest = os.path.join(self.dir, 'jobs.csv')
+        with open(manifest, 'w') as f:
+            f.write('input,operation,factor,output\n')
+            f.write('in.mov,blur,1.5,out.mov\n')
+
+        batch = VideoConvBatch({'<manifest>': manifest, '--jobs': '1'})
+        job = batch.get_job(batch.read_manifest()[0])
+        self.assertEquals(job['--in'], 'in.mov')
+        self.assertEquals(job['--out'], 'out.mov')
+        self.assertEquals(job['<factor>'], '1.5')
+        self.assertTrue(job['blur'])
+
+    def test_manifest_unknown_operation(self):
+        manifest = os.path.join(self.dir, 'jobs.jsonl')
+        with open(manifest, 'w') as f:
+            f.write('{"input": "a", "operation": "melt", "factor": 1, '
+                    '"output": "b"}\n')
+
+        batch = VideoConvBatch({'<manifest>': manifest, '--jobs': '1'})
+        with self.assertRaises(SystemExit):
+            batch.read_manifest()
+
+    def test_glob_and_up_to_date(self):
+        self.touch('a.mov', 100)
+        self.touch('a_blur1.5.mov', 200)
+        self.touch('b.mov', 300)
+        self.touch('b_blur1.5.mov', 200)
+
+        batch = VideoConvBatch({
+            '--glob': os.path.join(self.dir, '?.mov'),
+            '--out-dir': self.dir,
+            'blur': True,
+            '<factor>': '1.5',
+            '--jobs': '1',
+        })
+
+        rows = batch.glob_manifest()
+        self.assertEquals(
+            [os.path.basename(row['output']) for row in rows],
+            ['a_blur1.5.mov', 'b_blur1.5.mov'],
+        )
+        self.assertTrue(batch.is_up_to_date(rows[0]))
+        self.assertFalse(batch.is_up_to_date(rows[1]))
+
+
+class TestFilters(unittest2.TestCase):
+
+    def setUp(self):
+        # Upscaled noise, smooth like real footage rather than pure noise
+        random = numpy.random.RandomState(0)
+        self.frames = numpy.stack([
+            cv2.resize(
+                random.randint(0, 256, (6, 9, 3)).astype('uint8'),
+                (34, 21),
+                interpolation=cv2.INTER_CUBIC,
+            )
+            for _ in range(2)
+        ])
+
+    def assertMatchesPIL(self, operation, max_error, mean_error):
+        for factor in (0.5, 1.5):
+            batch = filters.OPERATIONS[operation](self.frames, factor)
+            for frame, filtered in zip(self.frames, batch):
+                image = Image.fromarray(frame)
+                expected = OPERATIONS[operation](image, factor)
+                error = numpy.abs(
+                    numpy.asarray(expected, dtype=int) - filtered
+                )
+                self.assertLessEqual(error.max(), max_error)
+                self.assertLessEqual(error.mean(), mean_error)
+
+    def test_brighten(self):
+        self.assertMatchesPIL('brighten', 0, 0)
+
+    def test_contrast(self):
+        self.assertMatchesPIL('contrast', 1, 1)
+
+    def test_sharpen(self):
+        self.assertMatchesPIL('sharpen', 1, 1)
+
+    def test_blur(self):
+        self.assertMatchesPIL('blur', 8, 1)
+
+    def test_rotate(self):
+        for frame in (self.frames[0], self.frames[0].transpose(1, 0, 2)):
+            expected = Image.fromarray(frame).rotate(90)
+            self.assertTrue(
+                (numpy.asarray(expected) == filters.rotate_frame(frame)).all()
+            )
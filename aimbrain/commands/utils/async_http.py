@@ -0,0 +1,553 @@
+"""
+Single-threaded, non-blocking HTTP/1.1 client.
+
+Requests are multiplexed over non-blocking sockets with select.poll, so
+thousands can be in flight from one thread without a thread per request.
+At most `concurrency` requests are in flight at once and the rest wait in
+a queue, or until their delay is up for retries. Finished connections are
+kept alive and reused for the same host.
+"""
+
+import collections
+import errno
+import heapq
+import json
+import select
+import socket
+import ssl
+import time
+import urlparse
+
+
+POLL_INTERVAL = 0.05
+RECV_SIZE = 65536
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class RequestError(Exception):
+    pass
+
+
+class Future(object):
+    """
+    Result of a request that may not have completed yet
+    """
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_error(self, error):
+        self.error = error
+        self.finish()
+
+    def result(self):
+        if not self.done:
+            raise RequestError('Request has not completed yet')
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+    def then(self, callback):
+        """
+        Return a future for callback(result), where callback may itself
+        return a future to wait on
+
+        Arguments:
+        callback <callable> --- Called with this future's result
+        """
+
+        chained = Future()
+
+        def resolve(future):
+            if future.error is not None:
+                chained.set_error(future.error)
+                return
+
+            try:
+                value = callback(future.value)
+            except Exception as e:
+                chained.set_error(e)
+                return
+
+            if isinstance(value, Future):
+                value.add_done_callback(
+                    lambda f: chained.set_error(f.error)
+                    if f.error is not None else chained.set_result(f.value)
+                )
+            else:
+                chained.set_result(value)
+
+        self.add_done_callback(resolve)
+        return chained
+
+
+class Response(object):
+    """
+    The parts of requests.Response the API commands rely on
+    """
+
+    def __init__(self, status_code, headers, content, elapsed,
+                 handshake_time):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.elapsed = elapsed
+        self.handshake_time = handshake_time
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class Request(object):
+
+    def __init__(self, method, url, body, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.key = (self.scheme, self.host, self.port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc]
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body or '')))
+        headers.setdefault('Connection', 'keep-alive')
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+
+        self.data = '\r\n'.join(lines).encode('utf-8') + b'\r\n\r\n'
+        if body:
+            self.data += body if isinstance(body, bytes) else body.encode(
+                'utf-8'
+            )
+
+        self.timeout = timeout
+        self.future = Future()
+        self.start = None
+        self.not_before = None
+
+
+class Connection(object):
+    """
+    One non-blocking connection, carrying one request at a time
+    """
+
+    def __init__(self, key, address_info):
+        self.key = key
+        self.scheme, self.host, self.port = key
+
+        family, socktype, proto, _, address = address_info
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.connected = False
+        self.tls_pending = self.scheme == 'https'
+        self.handshake_start = time.time()
+        self.handshake_time = 0.0
+        self.want_write = True
+
+        code = self.sock.connect_ex(address)
+        if code and code not in WOULD_BLOCK:
+            raise socket.error(code, 'Failed to connect')
+
+        self.request = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def closed(self):
+        """
+        Whether the server has closed the connection while it was idle,
+        which makes it readable. Uses poll, as select can't take
+        descriptors above FD_SETSIZE.
+        """
+
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        return bool(poller.poll(0))
+
+    def start(self, request):
+        self.request = request
+        self.sent = 0
+        self.received = []
+        self.status = None
+        self.headers = None
+        self.body_start = None
+        self.want_write = True
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def handle(self):
+        """
+        Make as much progress as possible without blocking, returning a
+        Response once the whole response has arrived
+        """
+
+        if not self.connected:
+            code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code in WOULD_BLOCK:
+                return None
+
+            if code:
+                raise socket.error(code, 'Failed to connect')
+
+            self.connected = True
+            if self.tls_pending:
+                context = ssl.create_default_context()
+                self.sock = context.wrap_socket(
+                    self.sock,
+                    server_hostname=self.host,
+                    do_handshake_on_connect=False,
+                )
+
+        if self.tls_pending:
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.want_write = False
+                return None
+            except ssl.SSLWantWriteError:
+                self.want_write = True
+                return None
+
+            self.tls_pending = False
+
+        if self.handshake_start is not None:
+            self.handshake_time = time.time() - self.handshake_start
+            self.handshake_start = None
+
+        if self.sent < len(self.request.data):
+            if not self.send():
+                return None
+
+        self.want_write = False
+        return self.receive()
+
+    def send(self):
+        while self.sent < len(self.request.data):
+            try:
+                self.sent += self.sock.send(
+                    buffer(self.request.data, self.sent)
+                )
+            except ssl.SSLWantWriteError:
+                self.want_write = True
+                return False
+            except ssl.SSLWantReadError:
+                self.want_write = False
+                return False
+            except socket.error as e:
+                if e.errno in WOULD_BLOCK:
+                    self.want_write = True
+                    return False
+                raise
+
+        return True
+
+    def receive(self):
+        while True:
+            try:
+                chunk = self.sock.recv(RECV_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.errno in WOULD_BLOCK:
+                    break
+                raise
+
+            if not chunk:
+                # Closed by the server, which ends a body with no length
+                if self.headers is not None and self.expected is None:
+                    return self.response(closing=True)
+
+                raise RequestError('Connection closed before response')
+
+            self.received.append(chunk)
+
+        return self.parse()
+
+    def parse(self):
+        data = b''.join(self.received)
+        self.received = [data]
+
+        if self.headers is None:
+            end = data.find(b'\r\n\r\n')
+            if end < 0:
+                return None
+
+            lines = data[:end].decode('iso-8859-1').split('\r\n')
+            self.version, status = lines[0].split(' ', 2)[:2]
+            self.status = int(status)
+            self.headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+
+            self.body_start = end + 4
+            self.expected = None
+            if 'content-length' in self.headers:
+                self.expected = int(self.headers['content-length'])
+
+        body = data[self.body_start:]
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = decode_chunked(body)
+            if content is None:
+                return None
+
+            return self.response(content=content)
+
+        if self.expected is not None and len(body) >= self.expected:
+            return self.response(content=body[:self.expected])
+
+        return None
+
+    def response(self, content=None, closing=False):
+        if content is None:
+            content = self.received[0][self.body_start:]
+
+        self.reusable = not closing and (
+            self.version == 'HTTP/1.1' and
+            self.headers.get('connection', '').lower() != 'close'
+        )
+
+        return Response(
+            self.status,
+            self.headers,
+            content,
+            time.time() - self.request.start,
+            self.handshake_time,
+        )
+
+
+def decode_chunked(body):
+    """
+    Decode a complete chunked body, or return None if more data is needed
+    """
+
+    content = []
+    position = 0
+    while True:
+        end = body.find(b'\r\n', position)
+        if end < 0:
+            return None
+
+        size = int(body[position:end].split(b';')[0], 16)
+        start = end + 2
+        if size == 0:
+            # Wait for the (usually empty) trailer section to end
+            if body.find(b'\r\n\r\n', position) < 0:
+                return None
+
+            return b''.join(content)
+
+        if len(body) < start + size + 2:
+            return None
+
+        content.append(body[start:start + size])
+        position = start + size + 2
+
+
+class HTTPLoop(object):
+    """
+    Runs queued requests on non-blocking sockets from a single thread,
+    with at most `concurrency` in flight at once.
+    """
+
+    def __init__(self, concurrency=100, timeout=30.0):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self.queue = collections.deque()
+        self.delayed = []
+        self.active = {}
+        self.idle = collections.defaultdict(list)
+        self.addresses = {}
+        self.poller = select.poll()
+
+    def request(self, method, url, body=None, headers=None, delay=0):
+        """
+        Queue a request and return a Future for its Response
+
+        Arguments:
+        method <string> -- HTTP method e.g. GET, POST
+        url <string> -- URL to send the request to
+        body <string> -- Body of request
+        headers <dict> -- Dictionary of header keys to values
+        delay <float> -- Seconds to wait before sending the request
+        """
+
+        request = Request(method, url, body, headers, self.timeout)
+        if delay > 0:
+            request.not_before = time.time() + delay
+            heapq.heappush(
+                self.delayed,
+                (request.not_before, id(request), request),
+            )
+        else:
+            self.queue.append(request)
+
+        return request.future
+
+    def resolve(self, key):
+        # Resolution blocks, so do it once per host
+        if key not in self.addresses:
+            _, host, port = key
+            self.addresses[key] = socket.getaddrinfo(
+                host,
+                port,
+                0,
+                socket.SOCK_STREAM,
+            )[0]
+
+        return self.addresses[key]
+
+    def get_connection(self, key):
+        while self.idle[key]:
+            conn = self.idle[key].pop()
+            try:
+                closed = conn.closed()
+            except (select.error, EnvironmentError, ValueError):
+                closed = True
+
+            if not closed:
+                conn.handshake_time = 0.0
+                return conn
+
+            conn.close()
+
+        return Connection(key, self.resolve(key))
+
+    def start_queued(self):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.queue.append(heapq.heappop(self.delayed)[2])
+
+        while self.queue and len(self.active) < self.concurrency:
+            request = self.queue.popleft()
+            request.start = time.time()
+            conn = None
+            try:
+                conn = self.get_connection(request.key)
+                conn.start(request)
+                self.register(conn)
+            except (select.error, EnvironmentError, ValueError) as e:
+                # Only the request fails, not the requests sharing the loop
+                if conn is not None:
+                    conn.close()
+                request.future.set_error(RequestError(
+                    'Unable to connect to %s: %s' % (request.key[1], e)
+                ))
+                continue
+
+            self.active[conn.fileno()] = conn
+
+    def register(self, conn):
+        mask = select.POLLIN | select.POLLERR | select.POLLHUP
+        if conn.want_write:
+            mask |= select.POLLOUT
+
+        try:
+            self.poller.modify(conn.fileno(), mask)
+        except IOError:
+            self.poller.register(conn.fileno(), mask)
+
+    def finish(self, conn, response=None, error=None):
+        fileno = conn.fileno()
+        self.poller.unregister(fileno)
+        del self.active[fileno]
+
+        if error is not None:
+            conn.close()
+            conn.request.future.set_error(error)
+            return
+
+        if conn.reusable:
+            self.idle[conn.key].append(conn)
+        else:
+            conn.close()
+
+        conn.request.future.set_result(response)
+
+    def handle(self, conn):
+        try:
+            response = conn.handle()
+        except (socket.error, ssl.SSLError, RequestError, ValueError) as e:
+            self.finish(conn, error=RequestError(
+                'Request to %s failed: %s' % (conn.host, e)
+            ))
+            return
+
+        if response is None:
+            self.register(conn)
+        else:
+            self.finish(conn, response)
+
+    def expire(self):
+        now = time.time()
+        for conn in list(self.active.values()):
+            if now - conn.request.start > conn.request.timeout:
+                self.finish(conn, error=RequestError(
+                    'Request to %s timed out after %.2fs' % (
+                        conn.host,
+                        conn.request.timeout,
+                    )
+                ))
+
+    def run(self):
+        """
+        Run until every queued request, including any queued by callbacks
+        while running, has completed
+        """
+
+        self.start_queued()
+        while self.active or self.queue or self.delayed:
+            for fileno, _ in self.poller.poll(POLL_INTERVAL * 1000):
+                conn = self.active.get(fileno)
+                if conn is not None:
+                    self.handle(conn)
+
+            self.expire()
+            self.start_queued()
+
+    def close(self):
+        for connections in self.idle.values():
+            for conn in connections:
+                conn.close()
+
+        self.idle.clear()
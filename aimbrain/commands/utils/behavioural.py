@@ -0,0 +1,264 @@
+"""
+Reading and batching of behavioural data.
+
+Behavioural data is made of fragments of a /v1/behavioural/submit body,
+each an object mapping event types such as "touches" or "mouseEvents" to
+lists of events. A file may hold a single such object, JSON lines of them
+or a JSON array of them. Each is parsed a value at a time, however long
+its lines, so files of any size are read in bounded memory, and the events
+regrouped into batches small enough to submit.
+"""
+
+import json
+
+from aimbrain.commands.utils import serializer
+
+
+DEFAULT_BATCH_EVENTS = 1000
+DEFAULT_BATCH_BYTES = 1024 * 1024
+
+READ_SIZE = 65536
+
+WHITESPACE = ' \t\r\n'
+
+# Events are timestamped in milliseconds, as recorded by the SDKs
+TIMESTAMP_FIELD = 't'
+
+
+class JSONReader(object):
+    """
+    Iterate over the elements of a JSON array, or over whitespace separated
+    JSON values such as JSON lines, parsing them from a file one at a time
+    """
+
+    def __init__(self, f, read_size=READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+
+    def fill(self):
+        """
+        Read more of the file, returning False at the end of it
+        """
+
+        # Read at least as much as is buffered, so a value far larger than
+        # read_size is parsed in a few attempts rather than many
+        data = self.f.read(max(self.read_size, len(self.buffer)))
+        if not data:
+            return False
+
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Next character that isn't whitespace, '' at the end of the file
+        """
+
+        while True:
+            while (self.position < len(self.buffer) and
+                   self.buffer[self.position] in WHITESPACE):
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('Expected one of "%s" but got "%s"' % (
+                characters,
+                character or 'end of file',
+            ))
+
+        self.position += 1
+        return character
+
+    def decode(self):
+        # raw_decode doesn't skip leading whitespace
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(
+                    self.buffer,
+                    self.position,
+                )
+            except ValueError:
+                if not self.fill():
+                    raise
+
+                continue
+
+            # A number ending the buffer may carry on in the next read
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.position = end
+            return value
+
+    def __iter__(self):
+        if self.peek() != '[':
+            while self.peek():
+                yield self.decode()
+
+            return
+
+        self.expect('[')
+        if self.peek() == ']':
+            return
+
+        while True:
+            yield self.decode()
+            if self.expect(',]') == ']':
+                return
+
+
+def count_events(body):
+    return sum(
+        len(value) for value in body.values() if isinstance(value, list)
+    )
+
+
+def batch_events(fragments, max_events=DEFAULT_BATCH_EVENTS,
+                 max_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Regroup the events of body fragments into submission bodies of at most
+    `max_events` events and about `max_bytes` of encoded events each.
+    Values that aren't event lists, e.g. a session, are kept in every body
+    that follows them.
+
+    Arguments:
+    fragments <iterable> --- Objects mapping event types to event lists
+    max_events <int> --- Most events in one body
+    max_bytes <int> --- Most bytes of encoded events in one body
+    """
+
+    extras = {}
+    batch = {}
+    events = 0
+    size = 0
+    batches = 0
+
+    for i, fragment in enumerate(fragments):
+        if not isinstance(fragment, dict):
+            raise SystemExit(
+                'Behavioural data entry %d is not an object' % (i + 1)
+            )
+
+        for key, value in fragment.items():
+            if not isinstance(value, list):
+                extras[key] = value
+                continue
+
+            for event in value:
+                event_size = len(serializer.dumps(event))
+                if events and (
+                    events >= max_events or size + event_size > max_bytes
+                ):
+                    body = dict(extras)
+                    body.update(batch)
+                    yield body
+                    batches += 1
+
+                    batch = {}
+                    events = 0
+                    size = 0
+
+                batch.setdefault(key, []).append(event)
+                events += 1
+                size += event_size
+
+    # Data without any events is still submitted once, as it always was
+    if events or not batches:
+        body = dict(extras)
+        body.update(batch)
+        yield body
+
+
+def read_fragments(f):
+    """
+    Iterate over the body fragments in a behavioural data file in any of
+    the formats it may have
+
+    Arguments:
+    f <file> --- Behavioural data file
+    """
+
+    # A single document is a JSON value followed by no others
+    return JSONReader(f)
+
+
+def window_events(fragments, window, field=TIMESTAMP_FIELD):
+    """
+    Group recorded events into windows of `window` seconds by their
+    timestamps, yielding the start of each window in seconds after the
+    first event, and a submission body of the events in it. Windows without
+    events are skipped.
+
+    Fragments are expected in time order, though the events within one
+    may be in any order. An event earlier than the current window, or
+    without a timestamp, is put in the current window.
+
+    Arguments:
+    fragments <iterable> --- Objects mapping event types to event lists
+    window <float> --- Length of a window in seconds
+    field <string> --- Event field holding its timestamp in milliseconds
+    """
+
+    extras = {}
+    batch = {}
+    first = None
+    current = 0
+
+    for i, fragment in enumerate(fragments):
+        if not isinstance(fragment, dict):
+            raise SystemExit(
+                'Behavioural data entry %d is not an object' % (i + 1)
+            )
+
+        events = []
+        for key, value in fragment.items():
+            if not isinstance(value, list):
+                extras[key] = value
+                continue
+
+            for event in value:
+                timestamp = None
+                if isinstance(event, dict):
+                    timestamp = event.get(field)
+
+                if not isinstance(timestamp, (int, long, float)):
+                    timestamp = None
+
+                events.append((timestamp, key, event))
+
+        # Event types are listed separately, so interleave them in time
+        events.sort(key=lambda event: event[0])
+
+        for timestamp, key, event in events:
+            if timestamp is not None:
+                if first is None:
+                    first = timestamp
+
+                index = int((timestamp - first) / 1000.0 / window)
+                if index > current:
+                    if batch:
+                        body = dict(extras)
+                        body.update(batch)
+                        yield current * window, body
+
+                    batch = {}
+                    current = index
+
+            batch.setdefault(key, []).append(event)
+
+    if batch:
+        body = dict(extras)
+        body.update(batch)
+        yield current * window, body
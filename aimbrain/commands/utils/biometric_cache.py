@@ -0,0 +1,209 @@
+"""
+Cache of base64 encoded biometric assets.
+
+Regression suites submit the same reference images and recordings over and
+over, so their encodings are kept rather than recomputed. Entries are keyed
+by a hash of the asset's path, size and modification time, so an edited
+asset is encoded afresh. Small encodings are kept in memory, least recently
+used first out, for commands that run many requests in one process. They
+can also be kept on disk, shared between invocations, with the least
+recently used evicted once the cache directory outgrows its cap.
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from aimbrain.commands.utils.streaming import Base64File
+from aimbrain.commands.utils.streaming import EncodedFile
+
+
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024
+DEFAULT_MAX_DISK = 1024 * 1024 * 1024
+
+# Larger encodings would push most others out, so they're only kept on disk
+MAX_MEMORY_FRACTION = 8
+
+SUFFIX = '.b64'
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+class BiometricCache(object):
+    """
+    Arguments:
+    max_memory <int> --- Most bytes of encodings to keep in memory
+    directory <string> --- Directory to keep encodings in, None not to
+    max_disk <int> --- Most bytes of encodings to keep in the directory
+    """
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY, directory=None,
+                 max_disk=DEFAULT_MAX_DISK):
+        self.max_memory = max_memory
+        self.directory = directory
+        if directory is not None:
+            self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_disk = max_disk
+
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(path, variant=None):
+        """
+        Cache key of an asset as it is now, or of a variant of it
+        """
+
+        stat = os.stat(path)
+        return hashlib.sha256(json.dumps([
+            os.path.abspath(path),
+            stat.st_size,
+            stat.st_mtime,
+            variant,
+        ])).hexdigest()
+
+    def get_memory(self, key):
+        with self.lock:
+            encoded = self.memory.pop(key, None)
+            if encoded is not None:
+                self.memory[key] = encoded
+
+        return encoded
+
+    def put_memory(self, key, encoded):
+        with self.lock:
+            if key in self.memory:
+                return
+
+            self.memory[key] = encoded
+            self.memory_size += len(encoded)
+            while self.memory_size > self.max_memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get_disk(self, key):
+        path = self.get_path(key)
+        try:
+            # Marks the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+
+        return EncodedFile(path)
+
+    def put_disk(self, key, chunks):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+
+            os.rename(temp_path, self.get_path(key))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        self.evict_disk()
+        return EncodedFile(self.get_path(key))
+
+    def evict_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Evicted by another process
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_disk:
+                break
+
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+            size -= entry_size
+
+    def get(self, path, transform=None, variant=None):
+        """
+        Base64 encoding of an asset to put in a request body, either a
+        string or a file standing in for one
+
+        Arguments:
+        path <string> --- Path to the asset
+        transform <function> --- Called with the path to get the bytes to
+            encode instead of the asset's own, only when not cached
+        variant <string> --- Name of what transform makes of the asset
+        """
+
+        key = self.get_key(path, variant)
+        encoded = self.get_memory(key)
+        if encoded is not None:
+            return encoded
+
+        limit = self.max_memory // MAX_MEMORY_FRACTION
+
+        if self.directory is not None:
+            cached = self.get_disk(key)
+            if cached is not None:
+                if len(cached) > limit:
+                    return cached
+
+                encoded = ''.join(cached)
+                self.put_memory(key, encoded)
+                return encoded
+
+        if transform is None:
+            source = Base64File(path)
+        else:
+            source = base64.b64encode(transform(path))
+
+        if len(source) > limit:
+            if self.directory is None:
+                return source
+
+            chunks = source if transform is None else [source]
+            return self.put_disk(key, chunks)
+
+        encoded = ''.join(source) if transform is None else source
+        self.put_memory(key, encoded)
+        if self.directory is not None:
+            self.put_disk(key, [encoded])
+
+        return encoded
+
+
+def get_cache(directory=None, max_disk=DEFAULT_MAX_DISK):
+    """
+    Get the process-wide BiometricCache for a cache directory, or the one
+    only kept in memory
+
+    Arguments:
+    directory <string> --- Directory to keep encodings in, None not to
+    max_disk <int> --- Most bytes of encodings to keep in the directory
+    """
+
+    with caches_lock:
+        cache = caches.get((directory, max_disk))
+        if cache is None:
+            cache = BiometricCache(directory=directory, max_disk=max_disk)
+            caches[(directory, max_disk)] = cache
+
+    return cache
@@ -0,0 +1,65 @@
+"""
+Compression of request bodies.
+
+Bodies are compressed a chunk at a time as they are produced, so only the
+compressed body is held in memory. Behavioural data, being repetitive JSON,
+shrinks around tenfold; base64 encoded media much less.
+"""
+
+import zlib
+
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+ENCODINGS = (GZIP, DEFLATE)
+
+# Smaller bodies gain less from compression than it costs the API to undo
+DEFAULT_THRESHOLD = 1024
+
+LEVEL = 6
+
+
+def get_compressor(encoding, level=LEVEL):
+    """
+    Compressor producing the Content-Encoding `encoding`
+
+    Arguments:
+    encoding <string> --- gzip, or deflate for the zlib format HTTP means
+    level <int> --- zlib compression level
+    """
+
+    if encoding == GZIP:
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == DEFLATE:
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError('Unknown content encoding "%s"' % encoding)
+
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress(chunks, encoding, level=LEVEL):
+    """
+    Compress a body given as chunks of strings
+
+    Arguments:
+    chunks <iterable> --- Chunks of the body
+    encoding <string> --- gzip or deflate
+    level <int> --- zlib compression level
+    """
+
+    compressor = get_compressor(encoding, level)
+    compressed = [compressor.compress(chunk) for chunk in chunks]
+    compressed.append(compressor.flush())
+    return ''.join(compressed)
+
+
+def decompress(data, encoding):
+    """
+    Undo compress, e.g. as the API does on receiving a body
+    """
+
+    if encoding == GZIP:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    return zlib.decompress(data)
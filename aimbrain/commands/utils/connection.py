@@ -0,0 +1,156 @@
+"""
+Shared HTTP connection pooling for the API commands.
+
+All requests go through one requests.Session per pool size, so consecutive
+requests to the API reuse kept-alive TCP/TLS connections instead of paying
+for a new handshake each time. Time spent establishing new connections is
+recorded per thread so it can be reported separately from request time.
+"""
+
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connection import VerifiedHTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+
+from aimbrain.commands.utils import trace
+
+
+DEFAULT_POOL_SIZE = 10
+
+timings = threading.local()
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def reset_handshake_time():
+    """
+    Start measuring connection setup time for the current thread
+    """
+
+    timings.handshake = 0.0
+
+
+def get_handshake_time():
+    """
+    Seconds spent establishing connections (DNS, TCP and TLS) by the current
+    thread since reset_handshake_time, 0 if every connection was reused
+    """
+
+    return getattr(timings, 'handshake', 0.0)
+
+
+def record_handshake(start):
+    timings.handshake = get_handshake_time() + time.time() - start
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    def _new_conn(self):
+        # urllib3 resolves the host and connects in one go, so the traced
+        # connect includes the DNS lookup
+        with trace.span('connect', host=self.host, port=self.port):
+            return super(TimedHTTPConnection, self)._new_conn()
+
+    def connect(self):
+        start = time.time()
+        try:
+            super(TimedHTTPConnection, self).connect()
+        finally:
+            record_handshake(start)
+
+
+class TimedHTTPSConnection(VerifiedHTTPSConnection):
+
+    def _new_conn(self):
+        with trace.span('connect', host=self.host, port=self.port):
+            conn = super(TimedHTTPSConnection, self)._new_conn()
+
+        self.connected_at = time.time()
+        return conn
+
+    def connect(self):
+        start = time.time()
+        self.connected_at = None
+        try:
+            super(TimedHTTPSConnection, self).connect()
+        finally:
+            record_handshake(start)
+
+            # What follows connecting is the TLS handshake
+            if self.connected_at is not None:
+                trace.record(
+                    'tls',
+                    self.connected_at,
+                    time.time() - self.connected_at,
+                    host=self.host,
+                )
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connections record how long they took to establish
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+def fit_pool_size(options, concurrency):
+    """
+    Options for commands run on `concurrency` threads at once, with
+    --pool-size raised to at least `concurrency` so that each thread can
+    keep a connection alive in the pool they share
+
+    Arguments:
+    options <dict> --- Options the commands are run with
+    concurrency <int> --- Number of commands run at once
+    """
+
+    pool_size = int(options.get('--pool-size') or DEFAULT_POOL_SIZE)
+    if pool_size >= concurrency:
+        return options
+
+    options = dict(options)
+    options['--pool-size'] = str(concurrency)
+    return options
+
+
+def get_http_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Get the process-wide requests.Session for a connection pool size
+
+    Optional Arguments:
+    pool_size <int> --- Maximum number of kept-alive connections per host
+    """
+
+    with sessions_lock:
+        session = sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = TimedHTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[pool_size] = session
+
+    return session
@@ -0,0 +1,155 @@
+"""
+Frame filters operating directly on uint8 RGB NumPy arrays.
+
+Each filter accepts a single frame of shape (height, width, 3) or a batch of
+frames stacked as (frames, height, width, 3) and returns an array of the same
+shape. They mirror the PIL enhancers used by videoconv, and match them within:
+
+  brighten  -- exact
+  contrast  -- +/-1 per channel
+  sharpen   -- +/-1 per channel
+  blur      -- mean absolute error below 1, +/-8 per channel worst case
+               (PIL approximates a gaussian with repeated box blurs, OpenCV
+               uses a true gaussian kernel)
+"""
+
+import cv2
+import numpy
+
+
+# Kernel of PIL's ImageFilter.SMOOTH, used by ImageEnhance.Sharpness
+SMOOTH_KERNEL = numpy.array(
+    [[1, 1, 1], [1, 5, 1], [1, 1, 1]],
+    dtype=numpy.float32,
+) / 13
+
+
+def blend(degenerate, frames, factor):
+    """
+    Blend frames away from a degenerate version of them, as
+    PIL.ImageEnhance does
+
+    Arguments:
+    degenerate <ndarray|float> --- Frames (or a scalar) to blend from
+    frames <ndarray> --- Original frames
+    factor <float> --- 0.0 gives the degenerate, 1.0 the original frames
+    """
+
+    out = frames.astype(numpy.float32)
+    out -= degenerate
+    out *= factor
+    out += degenerate
+
+    return numpy.clip(out, 0, 255, out=out).astype(numpy.uint8)
+
+
+def per_frame(func, frames, *args):
+    """
+    Apply a single-frame function to a frame or to each frame of a batch
+    """
+
+    if frames.ndim == 3:
+        return func(frames, *args)
+
+    out = numpy.empty_like(frames)
+    for i, frame in enumerate(frames):
+        out[i] = func(frame, *args)
+
+    return out
+
+
+def brighten_frames(frames, factor):
+    return blend(0.0, frames, factor)
+
+
+def contrast_frames(frames, factor):
+    # PIL blends towards the mean luma of each frame, using the ITU-R 601-2
+    # transform of Image.convert('L')
+    rgb = frames.astype(numpy.uint32)
+    luma = (
+        rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 +
+        0x8000
+    ) >> 16
+
+    mean = numpy.floor(luma.mean(axis=(-2, -1)) + 0.5)
+    mean = mean.astype(numpy.float32).reshape(mean.shape + (1, 1, 1))
+
+    return blend(mean, frames, factor)
+
+
+def smooth_frame(frame):
+    smoothed = cv2.filter2D(frame.astype(numpy.float32), -1, SMOOTH_KERNEL)
+    smoothed += 0.5
+
+    # PIL leaves the one pixel border untouched
+    smoothed[0, :] = frame[0, :]
+    smoothed[-1, :] = frame[-1, :]
+    smoothed[:, 0] = frame[:, 0]
+    smoothed[:, -1] = frame[:, -1]
+
+    return numpy.clip(smoothed, 0, 255, out=smoothed).astype(numpy.uint8)
+
+
+def sharpen_frames(frames, factor):
+    degenerate = per_frame(smooth_frame, frames).astype(numpy.float32)
+    return blend(degenerate, frames, factor)
+
+
+def blur_frame(frame, radius):
+    return cv2.GaussianBlur(
+        frame,
+        (0, 0),
+        radius,
+        borderType=cv2.BORDER_REPLICATE,
+    )
+
+
+def blur_frames(frames, factor):
+    if factor <= 0:
+        return frames.copy()
+
+    return per_frame(blur_frame, frames, factor)
+
+
+def rotate_frame(frame):
+    """
+    Rotate a frame 90 degrees anticlockwise about its centre without
+    changing its size, matching PIL's Image.rotate(90)
+
+    Arguments:
+    frame <ndarray> --- Frame of shape (height, width, 3)
+    """
+
+    height, width = frame.shape[:2]
+    if height == width:
+        return numpy.rot90(frame)
+
+    rotated = numpy.rot90(frame)
+    out = numpy.zeros_like(frame)
+
+    # Centre the rotated frame, cropping along one axis and padding with
+    # black along the other. PIL rounds odd offsets up for portrait frames
+    # and down for landscape ones.
+    rounding = 1 if height > width else 0
+    rotated_height, rotated_width = rotated.shape[:2]
+    crop_height = min(height, rotated_height)
+    crop_width = min(width, rotated_width)
+    src_y = (rotated_height - crop_height + rounding) // 2
+    src_x = (rotated_width - crop_width + rounding) // 2
+    dst_y = (height - crop_height + rounding) // 2
+    dst_x = (width - crop_width + rounding) // 2
+
+    out[dst_y:dst_y + crop_height, dst_x:dst_x + crop_width] = rotated[
+        src_y:src_y + crop_height,
+        src_x:src_x + crop_width,
+    ]
+
+    return out
+
+
+OPERATIONS = {
+    'sharpen': sharpen_frames,
+    'brighten': brighten_frames,
+    'contrast': contrast_frames,
+    'blur': blur_frames,
+}
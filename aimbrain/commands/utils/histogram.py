@@ -0,0 +1,82 @@
+import threading
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Latencies are recorded in microseconds. Values below `sub_buckets` are
+    counted exactly, and every power-of-two range above that is split into
+    `sub_buckets` / 2 equal buckets, so any reported value is within
+    2 / `sub_buckets` of the true one however wide the range recorded.
+    """
+
+    def __init__(self, sub_buckets=128):
+        if sub_buckets & (sub_buckets - 1):
+            raise ValueError('sub_buckets must be a power of two')
+
+        self.sub_bucket_bits = sub_buckets.bit_length() - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def bucket(self, value):
+        """
+        Lowest value of the bucket a value in microseconds falls into, and
+        the bucket's width
+        """
+
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (value >> shift) << shift, 1 << shift
+
+    def record(self, seconds):
+        value = int(round(seconds * 1e6))
+        lowest, _ = self.bucket(value)
+
+        with self.lock:
+            self.counts[lowest] = self.counts.get(lowest, 0) + 1
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """
+        Value in seconds at or below which `percentile` percent of recorded
+        values fall, reported as the highest value of its bucket
+        """
+
+        if not self.count:
+            return None
+
+        threshold = max(self.count * percentile / 100.0, 1)
+        seen = 0
+        for lowest in sorted(self.counts):
+            seen += self.counts[lowest]
+            if seen >= threshold:
+                _, width = self.bucket(lowest)
+                return min(lowest + width - 1, self.max) / 1e6
+
+        return self.max / 1e6
+
+    def to_dict(self):
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'min': self.min / 1e6,
+            'mean': self.total / 1e6 / self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max / 1e6,
+            # Lowest value of each bucket in microseconds, and its count
+            'buckets': [
+                [lowest, self.counts[lowest]] for lowest in sorted(self.counts)
+            ],
+        }
@@ -0,0 +1,171 @@
+"""
+Shrinking biometric assets before they are uploaded.
+
+Face images are scaled down to the size videos are processed at and saved
+as JPEG, and voice recordings resampled to 16 kHz mono, as the API has no
+use for more detail. Whatever comes out larger than it went in is sent
+unchanged.
+"""
+
+import os
+import shutil
+import tempfile
+import wave
+
+from io import BytesIO
+
+from PIL import Image
+
+from aimbrain.commands.utils.video_reader import AudioExtractor
+from aimbrain.commands.utils.video_reader import MAX_DIMENSION
+from aimbrain.commands.utils.video_reader import scale_dimensions
+
+
+JPEG_QUALITY = 90
+VOICE_RATE = 16000
+
+# EXIF tag saying which way up a photo was taken, and how to turn each of
+# its values upright. The optimized JPEG is saved without EXIF, so its
+# pixels have to be the right way up themselves.
+ORIENTATION_TAG = 0x0112
+ORIENTATIONS = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+def get_orientation(image):
+    """
+    EXIF orientation of an image, 1 for upright or if it has none
+    """
+
+    # Only JPEGs have _getexif, and Pillow 5 has no public equivalent
+    getexif = getattr(image, '_getexif', None)
+    if getexif is None:
+        return 1
+
+    try:
+        exif = getexif() or {}
+    except Exception:
+        # A broken EXIF block shouldn't stop the image being sent
+        return 1
+
+    return exif.get(ORIENTATION_TAG, 1)
+
+
+def optimize_image(path, limit=MAX_DIMENSION):
+    """
+    JPEG of a face image no larger than `limit` both ways, None if the
+    file isn't an image
+
+    Arguments:
+    path <string> --- Path to the image
+    limit <int> --- Longest side to scale a large image down to
+    """
+
+    try:
+        image = Image.open(path)
+        image.load()
+    except IOError:
+        # e.g. a face video, sent as it is
+        return None
+
+    orientation = get_orientation(image)
+    if orientation in ORIENTATIONS:
+        image = image.transpose(ORIENTATIONS[orientation])
+
+    width, height, resize = scale_dimensions(
+        image.size[0],
+        image.size[1],
+        limit,
+    )
+
+    # Videos keep square frames as they are, but still photos needn't
+    if not resize and width == height > limit:
+        width = height = limit
+        resize = True
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    if resize:
+        image = image.resize((width, height), Image.ANTIALIAS)
+
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=JPEG_QUALITY)
+    return output.getvalue()
+
+
+def is_voice_rate(path, rate=VOICE_RATE):
+    """
+    Whether a file is already a mono WAV at `rate`
+    """
+
+    try:
+        f = wave.open(path, 'rb')
+    except (wave.Error, EOFError):
+        return False
+
+    try:
+        return f.getnchannels() == 1 and f.getframerate() == rate
+    finally:
+        f.close()
+
+
+def optimize_voice(path, avconv, rate=VOICE_RATE):
+    """
+    Mono WAV of a voice recording resampled to `rate`, None if it already
+    is one
+
+    Arguments:
+    path <string> --- Path to the recording, audio or video
+    avconv <string> --- Path to avconv or ffmpeg
+    rate <int> --- Sample rate to resample to
+    """
+
+    if is_voice_rate(path, rate):
+        return None
+
+    directory = tempfile.mkdtemp()
+    try:
+        out_path = os.path.join(directory, 'voice.wav')
+        with AudioExtractor(path, out_path, avconv) as extractor:
+            try:
+                extractor.extract(rate)
+            except OSError as e:
+                raise SystemExit('Unable to run "%s": %s' % (
+                    avconv,
+                    e.strerror,
+                ))
+
+            return extractor.read_binary()
+    finally:
+        shutil.rmtree(directory)
+
+
+def optimize(path, kind, avconv='avconv'):
+    """
+    Bytes to upload for a biometric asset, the optimized version if that
+    is smaller and the asset's own otherwise
+
+    Arguments:
+    path <string> --- Path to the asset
+    kind <string> --- face or voice
+    avconv <string> --- Path to avconv or ffmpeg, for voices
+    """
+
+    if kind == 'face':
+        optimized = optimize_image(path)
+    else:
+        optimized = optimize_voice(path, avconv)
+
+    if optimized is not None and len(optimized) < os.path.getsize(path):
+        return optimized
+
+    with open(path, 'rb') as f:
+        return f.read()
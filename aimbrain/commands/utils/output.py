@@ -0,0 +1,74 @@
+"""
+Capturing what commands print, per thread, for a process running many
+commands at once.
+
+While a command runs, sys.stdout is a ThreadOutput sending what the
+command's thread prints to a buffer of its own. Worker pools started by
+the command are given inherit_output() as their initializer, so what their
+threads print is captured along with it.
+"""
+
+import sys
+import threading
+
+from StringIO import StringIO
+
+
+class ThreadOutput(object):
+    """
+    Stand-in for sys.stdout sending what a thread prints to its own buffer
+    while it runs a command, and everything else to the real stdout
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+        # Worker threads write to the buffer of the thread that started them
+        self.lock = threading.Lock()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+
+    def release(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def share(self):
+        """
+        Function sending the output of the thread it is run on to the
+        buffer of the current thread, to initialize worker threads with
+        """
+
+        buffer = getattr(self.local, 'buffer', None)
+
+        def inherit():
+            self.local.buffer = buffer
+
+        return inherit
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stdout.write(data)
+            return
+
+        with self.lock:
+            buffer.write(data)
+
+    def flush(self):
+        if not getattr(self.local, 'buffer', None):
+            self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def inherit_output():
+    """
+    Initializer for a worker pool, so that what its threads print goes
+    where the current thread's output does, None outside of serve
+    """
+
+    share = getattr(sys.stdout, 'share', None)
+    return share() if share is not None else None
@@ -0,0 +1,129 @@
+import collections
+import sys
+import threading
+import Queue
+
+
+class BufferedIterator(object):
+    """
+    Pull items from an iterable in a background thread and hand them to the
+    consumer through a bounded queue.
+
+    At most `depth` items are held in the queue at once, so memory stays
+    bounded however long the source is, while the producer (e.g. a video
+    decoder) and the consumer (e.g. a filter and encoder) run concurrently.
+    """
+
+    _done = object()
+
+    def __init__(self, source, depth=8):
+        if depth < 1:
+            raise ValueError('Queue depth must be at least 1, got %d' % depth)
+
+        self.source = source
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def produce(self):
+        try:
+            for item in self.source:
+                if not self.put(item):
+                    return
+
+        except BaseException:
+            self.error = sys.exc_info()
+
+        self.put(self._done)
+
+    def next(self):
+        item = self.queue.get()
+        if item is self._done:
+            self.stopped.set()
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+
+            raise StopIteration
+
+        return item
+
+    __next__ = next
+
+    def close(self):
+        """
+        Stop the producer thread and drop anything still queued
+        """
+
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+
+def chunked(iterable, size):
+    """
+    Group an iterable into lists of at most `size` items
+
+    Arguments:
+    iterable <iterable> --- Items to group
+    size <int> --- Maximum number of items per chunk
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def ordered_imap(pool, func, tasks, max_in_flight):
+    """
+    Like Pool.imap, but only submit a task once fewer than `max_in_flight`
+    results are outstanding, so a long or unbounded `tasks` iterable is not
+    drained into the pool up front. Results are yielded in submission order.
+
+    Arguments:
+    pool <multiprocessing.Pool> --- Pool to run tasks on
+    func <callable> --- Picklable function taking a single task
+    tasks <iterable> --- Arguments for func
+    max_in_flight <int> --- Maximum number of submitted, unconsumed tasks
+    """
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+
+        pending.append(pool.apply_async(func, (task,)))
+
+    while pending:
+        yield pending.popleft().get()
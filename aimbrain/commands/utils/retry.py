@@ -0,0 +1,108 @@
+"""
+Retry policy for API requests.
+
+Failed attempts are retried after an exponentially growing, jittered
+delay, unless the API says how long to wait with a Retry-After header.
+Only connection errors and responses with a retryable status are retried.
+"""
+
+import random
+import time
+
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+
+DEFAULT_STATUSES = (429, 502, 503, 504)
+
+
+def parse_statuses(statuses):
+    """
+    Parse a comma separated list of HTTP status codes
+
+    Arguments:
+    statuses <string> --- e.g. 429,503
+    """
+
+    try:
+        return frozenset(int(s) for s in statuses.split(',') if s.strip())
+    except ValueError:
+        raise SystemExit('Invalid status codes "%s"' % statuses)
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, given either as seconds or
+    as an HTTP date, None if it can't be parsed
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+
+    return max(mktime_tz(date) - time.time(), 0.0)
+
+
+class RetryPolicy(object):
+    """
+    How many times to attempt a request and how long to wait in between
+
+    Arguments:
+    attempts <int> --- Attempts in total, 1 never retries
+    backoff <float> --- Delay before the first retry, doubling each time
+    max_backoff <float> --- Longest delay between attempts
+    statuses <iterable> --- Response statuses to retry
+    """
+
+    def __init__(self, attempts=1, backoff=0.5, max_backoff=30.0,
+                 statuses=DEFAULT_STATUSES):
+        if attempts < 1:
+            raise ValueError('Attempts must be at least 1')
+
+        if backoff < 0:
+            raise ValueError('Backoff must not be negative')
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+
+    def should_retry(self, attempt, status=None):
+        """
+        Whether to retry after an attempt
+
+        Arguments:
+        attempt <int> --- Attempts made so far
+        status <int> --- Status of the response, None for connection errors
+        """
+
+        if attempt >= self.attempts:
+            return False
+
+        return status is None or status in self.statuses
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the next attempt, None not to retry as the
+        API asked for a longer wait than max_backoff
+
+        Arguments:
+        attempt <int> --- Attempts made so far
+        retry_after <string> --- Retry-After header of the last response
+        """
+
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            return delay if delay <= self.max_backoff else None
+
+        # Full jitter, so clients failing together don't retry together
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return random.uniform(0, delay)
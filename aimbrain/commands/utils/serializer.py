@@ -0,0 +1,176 @@
+"""
+JSON serialization of request and response bodies.
+
+The fastest installed backend of orjson, ujson and the standard library's
+json that writes floats exactly is used, unless the AIMBRAIN_JSON
+environment variable names one.
+Backends differ in spacing and escaping, but each always serializes the
+same value to the same bytes, and a request body is only ever serialized
+once, so the bytes signed are the bytes sent whichever is used.
+"""
+
+import json
+import os
+import threading
+
+
+BACKENDS = ('orjson', 'ujson', 'json')
+ENVIRONMENT_VARIABLE = 'AIMBRAIN_JSON'
+
+backends = {}
+backends_lock = threading.Lock()
+default_backend = []
+
+
+class JSONBackend(object):
+    """
+    The standard library's json, always available
+    """
+
+    name = 'json'
+    exact_floats = True
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UJSONBackend(object):
+    """
+    ujson. From version 2 floats are written as the shortest string that
+    reads back as the same double, as json writes them. Earlier versions
+    round them to at most 15 decimal places, losing digits of e.g. event
+    timestamps and coordinates, so they are only used when AIMBRAIN_JSON
+    asks for them.
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+        version = getattr(ujson, '__version__', '0')
+        self.exact_floats = int(version.split('.')[0]) >= 2
+
+    def dumps(self, value):
+        if self.exact_floats:
+            return self.ujson.dumps(value, ensure_ascii=True)
+
+        return self.ujson.dumps(
+            value,
+            ensure_ascii=True,
+            double_precision=15,
+        )
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+
+class ORJSONBackend(object):
+    """
+    orjson, producing UTF-8 bytes
+    """
+
+    name = 'orjson'
+    exact_floats = True
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, value):
+        return self.orjson.dumps(value)
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+BACKEND_CLASSES = {
+    'json': JSONBackend,
+    'ujson': UJSONBackend,
+    'orjson': ORJSONBackend,
+}
+
+
+def get_backend(name=None):
+    """
+    Get a serialization backend, by default the one named by AIMBRAIN_JSON
+    or else the fastest installed that writes floats exactly
+
+    Arguments:
+    name <string> --- orjson, ujson or json
+    """
+
+    if name is None:
+        if not default_backend:
+            name = os.environ.get(ENVIRONMENT_VARIABLE)
+            if name:
+                try:
+                    default_backend.append(get_backend(name))
+                except ImportError:
+                    raise SystemExit(
+                        'JSON backend "%s" is not installed' % name
+                    )
+            else:
+                for name in BACKENDS:
+                    try:
+                        backend = get_backend(name)
+                    except ImportError:
+                        continue
+
+                    if backend.exact_floats:
+                        default_backend.append(backend)
+                        break
+
+        return default_backend[0]
+
+    if name not in BACKEND_CLASSES:
+        raise SystemExit('Unknown JSON backend "%s", expected one of %s' % (
+            name,
+            ', '.join(BACKENDS),
+        ))
+
+    with backends_lock:
+        backend = backends.get(name)
+        if backend is None:
+            backend = BACKEND_CLASSES[name]()
+            backends[name] = backend
+
+    return backend
+
+
+def get_available_backends():
+    """
+    Names of the backends that are installed
+    """
+
+    available = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+
+        available.append(name)
+
+    return available
+
+
+def dumps(value):
+    """
+    Serialize a value to a JSON string with the default backend
+    """
+
+    return get_backend().dumps(value)
+
+
+def loads(data):
+    """
+    Deserialize a JSON string with the default backend, raising ValueError
+    if it isn't valid JSON
+    """
+
+    return get_backend().loads(data)
@@ -0,0 +1,189 @@
+"""
+On-disk cache of API sessions, shared by CLI processes.
+
+Sessions are stored in a small JSON file keyed by a hash of the API URL,
+API key, user, device and system they were created for. Readers hold a
+shared lock and writers an exclusive one on a separate lock file, and
+writes replace the cache file atomically, so concurrent processes never
+see a partially written cache. Once the cache holds `max_entries`
+sessions, the oldest are evicted. Processes running many commands keep
+their sessions in a MemorySessionCache instead.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+DEFAULT_TTL = 600
+MAX_ENTRIES = 1000
+
+
+class SessionCache(object):
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @staticmethod
+    def get_key(*parts):
+        """
+        Cache key for the parts a session depends on, hashed so they don't
+        end up on disk
+        """
+
+        return hashlib.sha256(json.dumps(parts)).hexdigest()
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            # Missing, or damaged in a way the atomic writes should prevent
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def write(self, entries):
+        directory = os.path.dirname(self.path)
+        # Only readable by the current user, as sessions grant access
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.sessions')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def is_fresh(self, entry, now):
+        return now - entry.get('created', 0) < self.ttl
+
+    def get(self, key):
+        """
+        Cached session for a key, None if there is none within the TTL
+        """
+
+        with self.lock():
+            entry = self.read().get(key)
+
+        if entry and self.is_fresh(entry, time.time()):
+            return entry.get('session')
+
+        return None
+
+    def update(self, func):
+        with self.lock(exclusive=True):
+            entries = self.read()
+            func(entries)
+
+            now = time.time()
+            for key, entry in entries.items():
+                if not self.is_fresh(entry, now):
+                    del entries[key]
+
+            oldest = sorted(entries, key=lambda key: entries[key]['created'])
+            for key in oldest[:max(len(entries) - self.max_entries, 0)]:
+                del entries[key]
+
+            self.write(entries)
+
+    def put(self, key, session):
+        def add(entries):
+            entries[key] = {'session': session, 'created': time.time()}
+
+        self.update(add)
+
+    def delete(self, key):
+        self.update(lambda entries: entries.pop(key, None))
+
+    @contextmanager
+    def creating(self, key):
+        """
+        Held while a session for a key is looked up and created. Processes
+        don't wait for each other, so each may create a session of its own.
+        """
+
+        yield
+
+
+class MemorySessionCache(object):
+    """
+    Session cache held in memory, for a process running many commands, with
+    the same interface as SessionCache
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Locks of the keys sessions are being created for, with how many
+        # threads are using each
+        self.creators = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry and time.time() - entry['created'] < self.ttl:
+            return entry['session']
+
+        return None
+
+    def put(self, key, session):
+        with self.lock:
+            self.entries[key] = {'session': session, 'created': time.time()}
+
+            excess = len(self.entries) - self.max_entries
+            if excess > 0:
+                oldest = sorted(
+                    self.entries,
+                    key=lambda key: self.entries[key]['created'],
+                )
+                for key in oldest[:excess]:
+                    del self.entries[key]
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    @contextmanager
+    def creating(self, key):
+        """
+        Held while a session for a key is looked up and created, so that
+        concurrent commands for the same user wait for the first to create
+        its session and then reuse it
+        """
+
+        with self.lock:
+            lock, users = self.creators.get(key, (threading.Lock(), 0))
+            self.creators[key] = (lock, users + 1)
+
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.creators[key]
+                if users > 1:
+                    self.creators[key] = (lock, users - 1)
+                else:
+                    del self.creators[key]
@@ -0,0 +1,69 @@
+"""
+HMAC request signing.
+
+A signature covers the method, endpoint and body of a request, fed into
+the HMAC piece by piece so the body is never copied into one message
+string. The HMAC is keyed once per secret and copied for each signature.
+"""
+
+import base64
+import hashlib
+import hmac
+import threading
+
+
+signers = {}
+signers_lock = threading.Lock()
+
+
+class Signer(object):
+    """
+    Signs requests with one secret
+    """
+
+    def __init__(self, secret):
+        self.keyed = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def sign(self, method, endpoint, payload):
+        """
+        Base64 encoded HMAC-SHA256 signature of a request
+
+        Arguments:
+        method <string> -- HTTP method e.g. GET, POST
+        endpoint <string> -- HTTP endpoint request is being sent to
+        payload <string|memoryview|iterable> -- Body of request, or an
+            iterable of its chunks
+        """
+
+        signature = self.keyed.copy()
+        signature.update(
+            ('%s\n%s\n' % (method.upper(), endpoint.lower())).encode('utf-8')
+        )
+
+        if isinstance(payload, (basestring, bytearray, memoryview, buffer)):
+            payload = [payload]
+
+        for chunk in payload:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+
+            signature.update(chunk)
+
+        return base64.b64encode(signature.digest())
+
+
+def get_signer(secret):
+    """
+    Get the process-wide Signer for a secret
+
+    Arguments:
+    secret <string> --- Secret to sign requests with
+    """
+
+    with signers_lock:
+        signer = signers.get(secret)
+        if signer is None:
+            signer = Signer(secret)
+            signers[secret] = signer
+
+    return signer
@@ -0,0 +1,202 @@
+"""
+JSON request bodies streamed from disk.
+
+Biometric files in a body are base64 encoded a chunk at a time as the body
+is read, so encoding, signing and sending a request holds roughly one chunk
+in memory rather than several copies of the whole payload. The stream is
+byte-for-byte what the serializer would produce for the same body with the
+files already encoded.
+"""
+
+import base64
+import os
+import re
+import time
+import uuid
+
+from aimbrain.commands.utils import serializer
+from aimbrain.commands.utils import trace
+
+
+# A multiple of 3, so each chunk encodes without padding
+CHUNK_SIZE = 3 * 16384
+
+
+class Base64File(object):
+    """
+    Base64 encoding of a file, standing in for a string in a JSON body
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return (os.path.getsize(self.path) + 2) // 3 * 4
+
+    def __iter__(self):
+        # Times are summed over the chunks to trace reading and encoding
+        start = time.time()
+        read_time = 0.0
+        encode_time = 0.0
+
+        with open(self.path, 'rb') as f:
+            while True:
+                read_start = time.time()
+                chunk = f.read(self.chunk_size)
+                encode_start = time.time()
+                read_time += encode_start - read_start
+                if not chunk:
+                    break
+
+                encoded = base64.b64encode(chunk)
+                encode_time += time.time() - encode_start
+                yield encoded
+
+        trace.record('read', start, read_time, path=self.path)
+        trace.record('encode', start, encode_time, path=self.path)
+
+
+class EncodedFile(Base64File):
+    """
+    File already holding a base64 encoding, standing in for a string in a
+    JSON body
+    """
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def __iter__(self):
+        start = time.time()
+        read_time = 0.0
+
+        with open(self.path, 'rb') as f:
+            while True:
+                read_start = time.time()
+                chunk = f.read(self.chunk_size)
+                read_time += time.time() - read_start
+                if not chunk:
+                    break
+
+                yield chunk
+
+        trace.record('read', start, read_time, path=self.path, cached=True)
+
+
+def split_json(value):
+    """
+    JSON encode a value, returning the encoding as a list of strings with
+    the Base64Files it holds in between, unencoded
+
+    Arguments:
+    value <object> --- JSON serialisable value, which may hold Base64Files
+        as values of a top level object or items of lists in one
+    """
+
+    # Files are encoded as numbered placeholders the encoding is then split
+    # on, so everything else is encoded in one go by the serializer
+    prefix = 'base64-file-%s-' % uuid.uuid4().hex
+    files = []
+
+    def replace(o):
+        if isinstance(o, Base64File):
+            files.append(o)
+            return '%s%d' % (prefix, len(files) - 1)
+
+        return o
+
+    # Swapped in place, as a copy may serialize its keys in another order
+    originals = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, list) and any(
+                isinstance(i, Base64File) for i in item
+            ):
+                originals[key] = item
+                value[key] = [replace(i) for i in item]
+            elif isinstance(item, Base64File):
+                originals[key] = item
+                value[key] = replace(item)
+
+    try:
+        with trace.span('serialize') as args:
+            encoded = serializer.dumps(value)
+            args['bytes'] = len(encoded)
+    finally:
+        if originals:
+            value.update(originals)
+
+    parts = re.split('%s(\\d+)' % prefix, encoded) if files else [encoded]
+
+    pieces = [parts[0]]
+    for i in range(1, len(parts), 2):
+        pieces.extend((files[int(parts[i])], parts[i + 1]))
+
+    return pieces
+
+
+class JSONStream(object):
+    """
+    Read-only file-like JSON encoding of a body, produced as it is read.
+
+    The length is known up front, so requests sends it with a
+    Content-Length rather than chunked transfer encoding.
+    """
+
+    def __init__(self, body):
+        self.pieces = split_json(body)
+        self.length = sum(len(piece) for piece in self.pieces)
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), '')
+
+    def chunks(self):
+        """
+        Iterate over the whole encoding from the start, independently of
+        read
+        """
+
+        for piece in self.pieces:
+            if isinstance(piece, Base64File):
+                for chunk in piece:
+                    yield chunk
+            elif piece:
+                yield piece
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+
+        pieces = []
+        while size > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = next(self.remaining, '')
+                self.offset = 0
+                if not self.buffer:
+                    break
+
+            piece = self.buffer[self.offset:self.offset + size]
+            self.offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+
+        data = ''.join(pieces)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Only rewinding is needed, e.g. to resend the body on a redirect
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError('JSONStream can only seek to the start')
+
+        self.remaining = self.chunks()
+        self.buffer = ''
+        self.offset = 0
+        self.position = 0
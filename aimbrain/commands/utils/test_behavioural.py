@@ -0,0 +1,119 @@
+import json
+
+from io import BytesIO
+
+import unittest2
+
+from aimbrain.commands.utils.behavioural import JSONReader
+from aimbrain.commands.utils.behavioural import batch_events
+from aimbrain.commands.utils.behavioural import window_events
+
+
+VALUES = [
+    {'touches': [{'x': 1.25, 'y': -3}], 'session': 'orange'},
+    {'textEvents': [{'text': u'caf\xe9 [1, 2]'}]},
+    {},
+    {'mouseEvents': [{'t': 12345678901234}]},
+]
+
+
+class TestJSONReader(unittest2.TestCase):
+
+    def read(self, data, read_size=3):
+        return list(JSONReader(BytesIO(data), read_size=read_size))
+
+    def test_array(self):
+        for data in (json.dumps(VALUES), json.dumps(VALUES, indent=2)):
+            self.assertEquals(self.read(data), VALUES)
+
+        self.assertEquals(self.read(' [ ] '), [])
+        self.assertEquals(self.read('[1, 23456, 7]'), [1, 23456, 7])
+
+    def test_lines(self):
+        data = '\n'.join(json.dumps(value) for value in VALUES) + '\n\n'
+        self.assertEquals(self.read(data), VALUES)
+
+    def test_invalid(self):
+        for data in ('[{"a": 1} {"b": 2}]', '[{"a": 1},', '{"a": '):
+            with self.assertRaises(ValueError):
+                self.read(data)
+
+    def test_document(self):
+        data = json.dumps(VALUES[0], indent=2) + '\n'
+        self.assertEquals(self.read(data), [VALUES[0]])
+
+        # However far past a read its first line goes
+        value = {'touches': [{'t': i} for i in range(1000)]}
+        self.assertEquals(self.read(json.dumps(value), read_size=64), [value])
+
+
+class TestBatchEvents(unittest2.TestCase):
+
+    def test_max_events(self):
+        fragments = [
+            {'session': 'orange'},
+            {'touches': [1, 2, 3]},
+            {'touches': [4]},
+            {'mouseEvents': [5, 6, 7]},
+        ]
+        batches = list(batch_events(fragments, max_events=3))
+
+        self.assertEquals(batches, [
+            {'session': 'orange', 'touches': [1, 2, 3]},
+            {'session': 'orange', 'touches': [4], 'mouseEvents': [5, 6]},
+            {'session': 'orange', 'mouseEvents': [7]},
+        ])
+
+    def test_max_bytes(self):
+        fragments = [{'touches': ['x' * 10] * 5}]
+        batches = list(batch_events(fragments, max_bytes=30))
+        self.assertEquals([len(b['touches']) for b in batches], [2, 2, 1])
+
+        # An event bigger than the limit still goes, on its own
+        batches = list(batch_events(fragments, max_bytes=5))
+        self.assertEquals(len(batches), 5)
+
+    def test_no_events(self):
+        self.assertEquals(
+            list(batch_events([{'session': 'orange', 'touches': []}])),
+            [{'session': 'orange'}],
+        )
+
+    def test_not_an_object(self):
+        with self.assertRaises(SystemExit):
+            list(batch_events([{'touches': [1]}, [2]]))
+
+
+class TestWindowEvents(unittest2.TestCase):
+
+    def test_windows(self):
+        fragments = [
+            {'session': 'orange', 'touches': [{'t': 1000}, {'t': 1400}]},
+            {'touches': [{'t': 3700}]},
+            {'touches': [{'t': 2000}], 'mouseEvents': [{'t': 1900}]},
+        ]
+
+        windows = list(window_events(fragments, 0.5))
+        self.assertEquals([offset for offset, _ in windows], [0.0, 2.5])
+
+        # Late events join the current window rather than reopening one
+        self.assertEquals(windows[0][1]['touches'], [{'t': 1000}, {'t': 1400}])
+        self.assertEquals(
+            windows[1][1]['touches'],
+            [{'t': 3700}, {'t': 2000}],
+        )
+        self.assertEquals(windows[1][1]['mouseEvents'], [{'t': 1900}])
+        self.assertEquals(windows[1][1]['session'], 'orange')
+
+    def test_untimestamped(self):
+        fragments = [{'touches': [{'x': 1}, {'t': 500}, {'t': 2500}]}]
+
+        windows = list(window_events(fragments, 1))
+        self.assertEquals(windows, [
+            (0, {'touches': [{'x': 1}, {'t': 500}]}),
+            (2, {'touches': [{'t': 2500}]}),
+        ])
+
+    def test_not_an_object(self):
+        with self.assertRaises(SystemExit):
+            list(window_events([{'touches': []}, []], 1))
@@ -0,0 +1,146 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.utils.biometric_cache import BiometricCache
+from aimbrain.commands.utils.biometric_cache import get_cache
+from aimbrain.commands.utils.streaming import Base64File
+from aimbrain.commands.utils.streaming import EncodedFile
+
+
+class TestBiometricCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        os.mkdir(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_asset(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def test_memory(self):
+        path = self.write_asset('face.png', 'potato' * 100)
+        cache = BiometricCache()
+        self.assertEquals(cache.get(path), base64.b64encode('potato' * 100))
+
+        # Repeats don't read or encode the asset again
+        with patch.object(Base64File, '__iter__', side_effect=AssertionError):
+            self.assertEquals(
+                cache.get(path),
+                base64.b64encode('potato' * 100),
+            )
+
+        # An edited asset is encoded afresh
+        time.sleep(0.01)
+        self.write_asset('face.png', 'orange')
+        self.assertEquals(cache.get(path), base64.b64encode('orange'))
+
+    def test_memory_lru(self):
+        # Room for eight encodings of 80 bytes
+        cache = BiometricCache(max_memory=8 * 80)
+        paths = [
+            self.write_asset('face%d.png' % i, str(i) * 60) for i in range(9)
+        ]
+
+        for path in paths[:8]:
+            cache.get(path)
+        cache.get(paths[0])
+        cache.get(paths[8])
+
+        # The least recently used was evicted to make room
+        self.assertEquals(cache.memory_size, cache.max_memory)
+        self.assertEquals(
+            set(cache.memory),
+            set(cache.get_key(path) for path in paths if path != paths[1]),
+        )
+
+    def test_large_not_kept_in_memory(self):
+        path = self.write_asset('voice.wav', 'x' * 3000)
+        cache = BiometricCache(max_memory=1000)
+
+        encoded = cache.get(path)
+        self.assertIsInstance(encoded, Base64File)
+        self.assertEquals(cache.memory_size, 0)
+
+        # It can still be kept on disk
+        cache = BiometricCache(max_memory=1000, directory=self.cache_dir)
+        encoded = cache.get(path)
+        self.assertIsInstance(encoded, EncodedFile)
+        self.assertEquals(len(encoded), 4000)
+        self.assertEquals(''.join(encoded), base64.b64encode('x' * 3000))
+
+    def test_disk(self):
+        path = self.write_asset('face.png', 'potato')
+        BiometricCache(directory=self.cache_dir).get(path)
+
+        # Another invocation reads the encoding rather than the asset
+        with patch.object(Base64File, '__iter__', side_effect=AssertionError):
+            self.assertEquals(
+                BiometricCache(directory=self.cache_dir).get(path),
+                base64.b64encode('potato'),
+            )
+
+        # Neither paths nor contents of assets end up in file names
+        self.assertNotIn('face', ''.join(os.listdir(self.cache_dir)))
+
+    def test_disk_cap(self):
+        cache = BiometricCache(
+            max_memory=0,
+            directory=self.cache_dir,
+            max_disk=10000,
+        )
+        paths = [
+            self.write_asset('voice%d.wav' % i, str(i) * 3000)
+            for i in range(4)
+        ]
+        for i, path in enumerate(paths):
+            cache.get(path)
+            # Entries are evicted least recently used first by mtime
+            os.utime(cache.get_path(cache.get_key(path)), (i, i))
+
+        cache.get(paths[0])
+        cache.evict_disk()
+
+        self.assertEquals(
+            sorted(os.listdir(self.cache_dir)),
+            sorted(
+                cache.get_key(paths[i]) + '.b64' for i in (0, 3)
+            ),
+        )
+
+    def test_transform(self):
+        path = self.write_asset('face.png', 'potato')
+        calls = []
+
+        def transform(path):
+            calls.append(path)
+            return 'orange'
+
+        for _ in range(2):
+            cache = BiometricCache(directory=self.cache_dir)
+            self.assertEquals(
+                cache.get(path, transform, 'optimized'),
+                base64.b64encode('orange'),
+            )
+
+        # Transformed once, and kept apart from the asset's own encoding
+        self.assertEquals(calls, [path])
+        self.assertEquals(cache.get(path), base64.b64encode('potato'))
+
+    def test_get_cache(self):
+        self.assertIs(get_cache(), get_cache())
+        self.assertIs(get_cache(self.cache_dir), get_cache(self.cache_dir))
+        self.assertIsNot(get_cache(), get_cache(self.cache_dir))
@@ -0,0 +1,36 @@
+import gzip
+import zlib
+
+from io import BytesIO
+
+import unittest2
+
+from aimbrain.commands.utils.compression import compress
+from aimbrain.commands.utils.compression import decompress
+from aimbrain.commands.utils.compression import get_compressor
+
+
+class TestCompression(unittest2.TestCase):
+
+    def test_gzip(self):
+        chunks = ['{"touches": [', '{"t": 1}, ' * 1000, '{"t": 2}]}']
+        compressed = compress(chunks, 'gzip')
+
+        # Readable by anything that reads gzip
+        self.assertEquals(
+            gzip.GzipFile(fileobj=BytesIO(compressed)).read(),
+            ''.join(chunks),
+        )
+        self.assertEquals(decompress(compressed, 'gzip'), ''.join(chunks))
+        self.assertLess(len(compressed) * 10, len(''.join(chunks)))
+
+    def test_deflate(self):
+        compressed = compress(['potato' * 100], 'deflate')
+
+        # HTTP deflate is the zlib format rather than a raw deflate stream
+        self.assertEquals(zlib.decompress(compressed), 'potato' * 100)
+        self.assertEquals(decompress(compressed, 'deflate'), 'potato' * 100)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_compressor('br')
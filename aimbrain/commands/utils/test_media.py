@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import tempfile
+import wave
+
+from io import BytesIO
+
+import unittest2
+
+from mock import MagicMock
+from mock import patch
+from PIL import Image
+
+from aimbrain.commands.utils import media
+from aimbrain.commands.utils import video_reader
+
+
+def exif_orientation(orientation):
+    """
+    EXIF block holding only an orientation
+    """
+
+    return 'Exif\x00\x00' + struct.pack(
+        '>2sHIHHHIHHI',
+        'MM', 42, 8,
+        1, media.ORIENTATION_TAG, 3, 1, orientation, 0,
+        0,
+    )
+
+
+def write_wav(path, rate, channels, seconds=1):
+    f = wave.open(path, 'wb')
+    f.setnchannels(channels)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    f.writeframes('\x01\x02' * channels * int(rate * seconds))
+    f.close()
+
+
+class TestOptimizeImage(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_image(self, name, size, mode='RGB'):
+        path = os.path.join(self.dir, name)
+        image = Image.frombytes(mode, size, os.urandom(
+            size[0] * size[1] * len(mode)
+        ))
+        image.save(path)
+        return path
+
+    def test_downscale(self):
+        path = self.write_image('face.png', (1200, 900))
+        optimized = media.optimize(path, 'face')
+
+        image = Image.open(BytesIO(optimized))
+        self.assertEquals(image.format, 'JPEG')
+        self.assertEquals(image.size, (480, 360))
+        self.assertLess(len(optimized), os.path.getsize(path))
+
+    def test_square(self):
+        path = self.write_image('face.png', (1000, 1000), 'RGBA')
+        image = Image.open(BytesIO(media.optimize(path, 'face')))
+        self.assertEquals(image.size, (480, 480))
+        self.assertEquals(image.mode, 'RGB')
+
+    def test_orientation(self):
+        path = os.path.join(self.dir, 'face.jpg')
+        image = Image.new('RGB', (1200, 900))
+        # Marked to be turned a quarter clockwise to be upright
+        image.paste((255, 0, 0), (0, 0, 600, 900))
+        image.save(path, exif=exif_orientation(6))
+
+        image = Image.open(BytesIO(media.optimize_image(path)))
+        self.assertEquals(image.size, (360, 480))
+
+        # What was the left half is now the top
+        red, green, _ = image.getpixel((180, 60))
+        self.assertGreater(red, 200)
+        self.assertLess(green, 50)
+        red, _, _ = image.getpixel((180, 420))
+        self.assertLess(red, 50)
+
+    def test_unchanged(self):
+        # Already smaller than its JPEG would be
+        path = self.write_image('face.gif', (8, 8), 'L')
+        with open(path, 'rb') as f:
+            self.assertEquals(media.optimize(path, 'face'), f.read())
+
+        # Not an image at all, e.g. a video
+        path = os.path.join(self.dir, 'face.mov')
+        with open(path, 'wb') as f:
+            f.write('potato')
+        self.assertEquals(media.optimize(path, 'face'), 'potato')
+
+
+class TestOptimizeVoice(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resample(self):
+        path = os.path.join(self.dir, 'voice.wav')
+        write_wav(path, 44100, 2)
+
+        def extract(extractor, rate):
+            write_wav(extractor.out_filename, rate, 1)
+
+        with patch.object(media.AudioExtractor, 'extract', extract):
+            optimized = media.optimize(path, 'voice', '/usr/bin/avconv')
+
+        f = wave.open(BytesIO(optimized))
+        self.assertEquals(f.getframerate(), 16000)
+        self.assertEquals(f.getnchannels(), 1)
+
+    def test_already_resampled(self):
+        path = os.path.join(self.dir, 'voice.wav')
+        write_wav(path, 16000, 1)
+
+        with patch.object(media.AudioExtractor, 'extract') as extract:
+            with open(path, 'rb') as f:
+                self.assertEquals(media.optimize(path, 'voice'), f.read())
+
+        self.assertFalse(extract.called)
+
+    def test_spaces(self):
+        directory = os.path.join(self.dir, 'voice recordings')
+        os.mkdir(directory)
+        path = os.path.join(directory, 'my voice.wav')
+        write_wav(path, 44100, 2)
+
+        def popen(cmd, **kwargs):
+            write_wav(cmd[cmd.index('-vn') + 1], 16000, 1)
+            proc = MagicMock()
+            proc.poll.return_value = proc.wait.return_value = 0
+            return proc
+
+        with patch.object(video_reader.subprocess, 'Popen') as Popen:
+            Popen.side_effect = popen
+            media.optimize(path, 'voice', '/usr/bin/avconv')
+
+        # Each path is a single argument, spaces and all
+        cmd = Popen.call_args[0][0]
+        self.assertEquals(cmd[:4], ['/usr/bin/avconv', '-y', '-i', path])
+        self.assertIn('-ar', cmd)
+        self.assertEquals(cmd[cmd.index('-ar') + 1], '16000')
+
+    def test_missing_avconv(self):
+        path = os.path.join(self.dir, 'voice.wav')
+        write_wav(path, 44100, 2)
+
+        with self.assertRaises(SystemExit):
+            media.optimize(path, 'voice', os.path.join(self.dir, 'avconv'))
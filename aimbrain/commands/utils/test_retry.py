@@ -0,0 +1,46 @@
+import time
+
+import unittest2
+
+from email.utils import formatdate
+
+from aimbrain.commands.utils.retry import RetryPolicy
+from aimbrain.commands.utils.retry import parse_retry_after
+from aimbrain.commands.utils.retry import parse_statuses
+
+
+class TestRetryPolicy(unittest2.TestCase):
+
+    def test_should_retry(self):
+        policy = RetryPolicy(attempts=3, statuses=(503,))
+        self.assertTrue(policy.should_retry(1, 503))
+        self.assertTrue(policy.should_retry(2, None))
+        self.assertFalse(policy.should_retry(3, 503))
+        self.assertFalse(policy.should_retry(1, 500))
+        self.assertFalse(RetryPolicy().should_retry(1, 503))
+
+    def test_backoff(self):
+        policy = RetryPolicy(attempts=10, backoff=0.5, max_backoff=3.0)
+        for attempt, limit in ((1, 0.5), (2, 1.0), (3, 2.0), (8, 3.0)):
+            delays = [policy.get_delay(attempt) for _ in range(100)]
+            self.assertLessEqual(max(delays), limit)
+            self.assertGreaterEqual(min(delays), 0)
+
+        # Jittered rather than every client waiting the same time
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(attempts=3, max_backoff=30.0)
+        self.assertEquals(policy.get_delay(1, '2'), 2.0)
+        self.assertIsNone(policy.get_delay(1, '120'))
+
+        delay = policy.get_delay(1, formatdate(time.time() + 10, usegmt=True))
+        self.assertAlmostEquals(delay, 10, delta=1.5)
+
+    def test_parse(self):
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEquals(parse_retry_after('-5'), 0)
+        self.assertEquals(parse_statuses('429, 503,'), frozenset([429, 503]))
+
+        with self.assertRaises(SystemExit):
+            parse_statuses('429,five')
@@ -0,0 +1,144 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import types
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.utils import serializer
+from aimbrain.commands.utils.signing import Signer
+from aimbrain.commands.utils.streaming import Base64File
+from aimbrain.commands.utils.streaming import JSONStream
+
+
+class SortedBackend(object):
+    """
+    Stand-in for a backend laying out its output differently to json
+    """
+
+    name = 'sorted'
+
+    def dumps(self, value):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+PAYLOAD = {
+    'session': u'orange \u2603',
+    'mouseEvents': [
+        {'t': 1000 + i, 'x': i * 0.1, 'y': -i, 'type': 'move'}
+        for i in range(100)
+    ],
+    'nested': {'1': 'one', 'null': None, 'list': []},
+}
+
+
+class TestSerializer(unittest2.TestCase):
+
+    def test_backends(self):
+        available = serializer.get_available_backends()
+        self.assertIn('json', available)
+
+        for name in available:
+            backend = serializer.get_backend(name)
+            encoded = backend.dumps(PAYLOAD)
+            self.assertIsInstance(encoded, str)
+
+            # Deterministic, and read back as it was written
+            self.assertEquals(backend.dumps(PAYLOAD), encoded)
+            self.assertEquals(json.loads(encoded), PAYLOAD)
+            self.assertEquals(backend.loads(encoded), PAYLOAD)
+
+        with self.assertRaises(SystemExit):
+            serializer.get_backend('potato')
+
+    def test_exact_floats(self):
+        # Timestamps and coordinates of behavioural events, and doubles
+        # needing all 17 significant digits
+        values = [
+            1535462461.123456,
+            0.1,
+            1e-20,
+            1.0000000000000002,
+            123456789.12345678,
+            -2.5e300,
+        ]
+        expected = serializer.JSONBackend().dumps(values)
+
+        for name in serializer.get_available_backends():
+            backend = serializer.get_backend(name)
+            if not backend.exact_floats:
+                continue
+
+            encoded = backend.dumps(values)
+            self.assertEquals(json.loads(encoded), values)
+            self.assertEquals(json.loads(encoded), json.loads(expected))
+
+    def test_inexact_ujson(self):
+        for version, exact in (('1.35', False), ('2.0.3', True)):
+            ujson = types.ModuleType('ujson')
+            ujson.__version__ = version
+            ujson.dumps = lambda value, **kwargs: json.dumps(value)
+            ujson.loads = json.loads
+
+            with patch.dict(sys.modules, {'ujson': ujson}), \
+                    patch.dict(os.environ, clear=True), \
+                    patch.object(serializer, 'backends', {}), \
+                    patch.object(serializer, 'default_backend', []):
+                self.assertEquals(
+                    serializer.get_backend('ujson').exact_floats,
+                    exact,
+                )
+
+                # Rounding floats, ujson is only used when asked for
+                default = serializer.get_backend()
+                self.assertEquals(default.name == 'ujson', exact)
+
+    def test_environment(self):
+        with patch.object(serializer, 'default_backend', []):
+            with patch.dict(os.environ, {'AIMBRAIN_JSON': 'json'}):
+                self.assertEquals(serializer.get_backend().name, 'json')
+
+        with patch.object(serializer, 'default_backend', []):
+            with patch.dict(os.environ, {'AIMBRAIN_JSON': 'potato'}):
+                with self.assertRaises(SystemExit):
+                    serializer.get_backend()
+
+    def test_streamed_body(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(1000))
+            f.flush()
+            with open(f.name, 'rb') as data:
+                encoded = base64.b64encode(data.read())
+
+            body = dict(PAYLOAD)
+            body['faces1'] = [Base64File(f.name)]
+            body['faces2'] = [Base64File(f.name), Base64File(f.name)]
+
+            backend = SortedBackend()
+            with patch.object(serializer, 'default_backend', [backend]):
+                stream = JSONStream(body)
+
+            # The stream is what the backend makes of the encoded body, and
+            # signs the same as the bytes sent
+            streamed = ''.join(stream.chunks())
+            expected = dict(PAYLOAD)
+            expected['faces1'] = [encoded]
+            expected['faces2'] = [encoded, encoded]
+            self.assertEquals(streamed, backend.dumps(expected))
+            self.assertEquals(len(stream), len(streamed))
+
+            signer = Signer('secret')
+            self.assertEquals(
+                signer.sign('POST', '/v1/face/compare', stream.chunks()),
+                signer.sign('POST', '/v1/face/compare', streamed),
+            )
+
+            # The body is left as it was given
+            self.assertIsInstance(body['faces1'][0], Base64File)
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from multiprocessing import Pool
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.utils.session_cache import SessionCache
+
+
+def put_sessions(args):
+    path, worker = args
+    cache = SessionCache(path)
+    for i in range(20):
+        cache.put('%d-%d' % (worker, i), 'session-%d-%d' % (worker, i))
+
+
+class TestSessionCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sessions.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get_delete(self):
+        cache = SessionCache(self.path)
+        self.assertIsNone(cache.get('potato'))
+
+        cache.put('potato', 'orange')
+        self.assertEquals(SessionCache(self.path).get('potato'), 'orange')
+
+        cache.delete('potato')
+        self.assertIsNone(cache.get('potato'))
+
+        # Nothing sensitive is kept in the clear and the file is private
+        key = SessionCache.get_key('https://api.aimbrain.com', 'key', 'user')
+        cache.put(key, 'orange')
+        with open(self.path) as f:
+            self.assertNotIn('user', f.read())
+        self.assertEquals(os.stat(self.path).st_mode & 0o077, 0)
+
+    def test_ttl(self):
+        cache = SessionCache(self.path, ttl=60)
+        cache.put('potato', 'orange')
+
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('potato'))
+
+            # Expired sessions are dropped on the next write
+            cache.put('apple', 'pear')
+
+        with open(self.path) as f:
+            self.assertEquals(list(json.load(f)), ['apple'])
+
+    def test_evicts_oldest(self):
+        cache = SessionCache(self.path, max_entries=3)
+        for i in range(5):
+            with patch('time.time', return_value=time.time() + i):
+                cache.put('user%d' % i, 'session%d' % i)
+
+        with open(self.path) as f:
+            self.assertEquals(
+                sorted(json.load(f)),
+                ['user2', 'user3', 'user4'],
+            )
+
+    def test_damaged_file(self):
+        with open(self.path, 'w') as f:
+            f.write('{"potato": ')
+
+        cache = SessionCache(self.path)
+        self.assertIsNone(cache.get('potato'))
+        cache.put('potato', 'orange')
+        self.assertEquals(cache.get('potato'), 'orange')
+
+    def test_concurrent_processes(self):
+        pool = Pool(4)
+        try:
+            pool.map(
+                put_sessions,
+                [(self.path, worker) for worker in range(4)],
+            )
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # No process overwrote another's sessions
+        cache = SessionCache(self.path)
+        for worker in range(4):
+            for i in range(20):
+                self.assertEquals(
+                    cache.get('%d-%d' % (worker, i)),
+                    'session-%d-%d' % (worker, i),
+                )
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import hmac
+
+import unittest2
+
+from aimbrain.commands.utils.signing import Signer
+from aimbrain.commands.utils.signing import get_signer
+
+
+def sign_message(secret, method, endpoint, payload):
+    # How requests were signed before Signer, building the whole message
+    message = '%s\n%s\n%s' % (method.upper(), endpoint.lower(), payload)
+
+    return base64.b64encode(hmac.new(
+        secret.encode('utf-8'),
+        bytes(message).encode('utf-8'),
+        digestmod=hashlib.sha256,
+    ).digest())
+
+
+class TestSigner(unittest2.TestCase):
+
+    def setUp(self):
+        self.payload = '{"faces": ["%s"]}' % ('Ym9vcA==' * 1000)
+        self.expected = sign_message(
+            'bannanaman',
+            'post',
+            '/V1/Face/Auth',
+            self.payload,
+        )
+
+    def test_known_signature(self):
+        signer = Signer('bannanaman')
+        self.assertEquals(
+            signer.sign('POST', '/potato', '{"hello": "Mr Blobby"}'),
+            'LtlMaa6CGTMsY5OTqB8fYZGTJTAaQMLjsYBd0eUJrkk=',
+        )
+
+    def test_payload_types(self):
+        signer = Signer('bannanaman')
+        payloads = (
+            self.payload,
+            unicode(self.payload),
+            bytearray(self.payload),
+            memoryview(self.payload),
+            buffer(self.payload),
+            iter([self.payload[:7], memoryview(self.payload)[7:]]),
+            [self.payload[i:i + 99] for i in range(0, len(self.payload), 99)],
+        )
+
+        for payload in payloads:
+            self.assertEquals(
+                signer.sign('post', '/V1/Face/Auth', payload),
+                self.expected,
+            )
+
+    def test_reused(self):
+        signer = get_signer('bannanaman')
+        self.assertIs(get_signer('bannanaman'), signer)
+        self.assertIsNot(get_signer('apple'), signer)
+
+        # Signing doesn't change the keyed state later signatures start from
+        for _ in range(3):
+            self.assertEquals(
+                signer.sign('post', '/V1/Face/Auth', self.payload),
+                self.expected,
+            )
@@ -0,0 +1,69 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from aimbrain.commands.utils.streaming import Base64File
+from aimbrain.commands.utils.streaming import JSONStream
+
+
+class TestJSONStream(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {}
+        # Sizes either side of a chunk boundary and each padding length
+        for size in (0, 1, 2, 3, 10, 2999, 3000, 3001):
+            path = os.path.join(self.dir, '%d.bin' % size)
+            data = os.urandom(size)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            self.files[path] = base64.b64encode(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_stream(self):
+        """
+        Stream of a body holding the files, and json.dumps of the same body
+        with the files encoded in memory
+        """
+
+        paths = sorted(self.files)
+        body = {
+            'voices': [Base64File(path, chunk_size=300) for path in paths],
+            'session': u'orange \u2603',
+            'nested': {'n': [1, 2.5, None, True], 1: 'one', None: []},
+        }
+        stream = JSONStream(body)
+
+        # Same dict, so the same key order, as the stream reads lazily
+        body['voices'] = [self.files[path] for path in paths]
+        expected = json.dumps(body)
+        body['voices'] = [Base64File(path, chunk_size=300) for path in paths]
+
+        return stream, expected
+
+    def test_matches_json_dumps(self):
+        stream, expected = self.get_stream()
+
+        self.assertEquals(len(stream), len(expected))
+        self.assertEquals(''.join(stream.chunks()), expected)
+        self.assertEquals(stream.read(), expected)
+        self.assertEquals(stream.tell(), len(expected))
+        self.assertEquals(stream.read(10), '')
+
+    def test_small_reads_and_rewind(self):
+        stream, expected = self.get_stream()
+
+        self.assertEquals(''.join(iter(lambda: stream.read(7), '')), expected)
+
+        stream.seek(0)
+        self.assertEquals(''.join(stream), expected)
+
+        with self.assertRaises(IOError):
+            stream.seek(5)
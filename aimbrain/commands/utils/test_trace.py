@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import unittest2
+
+from mock import patch
+
+from aimbrain.commands.utils import trace
+
+
+class TestTracer(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_json_lines(self):
+        path = os.path.join(self.dir, 'trace.jsonl')
+        tracer = trace.Tracer(path)
+
+        with tracer.span('sign', endpoint='/v1/sessions') as args:
+            args['bytes'] = 10
+        tracer.record('read', 100.0, 0.5, path='face.jpg')
+        tracer.close()
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+
+        self.assertEquals(
+            [event['name'] for event in events],
+            ['sign', 'read'],
+        )
+        self.assertEquals(
+            events[0]['args'],
+            {'endpoint': '/v1/sessions', 'bytes': 10},
+        )
+        self.assertGreaterEqual(events[0]['duration'], 0)
+        self.assertEquals(events[1]['start'], 100.0)
+        self.assertEquals(events[1]['duration'], 0.5)
+        self.assertEquals(
+            events[1]['thread'],
+            threading.current_thread().ident,
+        )
+
+    def test_chrome(self):
+        path = os.path.join(self.dir, 'trace.json')
+        tracer = trace.Tracer(path)
+
+        tracer.record('ttfb', 100.0, 0.25, status=200)
+        tracer.close()
+
+        # Events after closing are dropped rather than failing
+        tracer.record('late', 101.0, 0.25)
+        tracer.close()
+
+        with open(path) as f:
+            report = json.load(f)
+
+        event, = report['traceEvents']
+        self.assertEquals(event['name'], 'ttfb')
+        self.assertEquals(event['ph'], 'X')
+        self.assertEquals(event['ts'], 100000000.0)
+        self.assertEquals(event['dur'], 250000.0)
+        self.assertEquals(event['pid'], os.getpid())
+        self.assertEquals(event['args'], {'status': 200})
+
+    def test_span_raising(self):
+        path = os.path.join(self.dir, 'trace.jsonl')
+        tracer = trace.Tracer(path)
+
+        with self.assertRaises(ValueError):
+            with tracer.span('parse'):
+                raise ValueError()
+        tracer.close()
+
+        with open(path) as f:
+            self.assertEquals(json.loads(f.readline())['name'], 'parse')
+
+    def test_unwritable(self):
+        with self.assertRaises(SystemExit):
+            trace.Tracer(os.path.join(self.dir, 'missing', 'trace.json'))
+
+    def test_start(self):
+        path = os.path.join(self.dir, 'trace.jsonl')
+
+        with patch.object(trace, 'tracer', trace.NullTracer()):
+            self.assertFalse(trace.is_enabled())
+
+            # Without tracing, spans still hand the block its arguments
+            with trace.span('sign', endpoint='/v1/sessions') as args:
+                self.assertEquals(args, {'endpoint': '/v1/sessions'})
+            trace.record('read', 100.0, 0.5)
+
+            tracer = trace.start(path)
+            self.assertTrue(trace.is_enabled())
+            self.assertIs(trace.start(path), tracer)
+
+            trace.record('read', 100.0, 0.5)
+            tracer.close()
+
+        with open(path) as f:
+            self.assertEquals(len(f.readlines()), 1)
@@ -0,0 +1,90 @@
+from io import BytesIO
+
+import numpy
+import unittest2
+
+from mock import MagicMock
+from mock import patch
+
+from aimbrain.commands.utils import video_reader
+from aimbrain.commands.utils.video_reader import VideoCaptureService
+from aimbrain.commands.utils.video_reader import VideoWriterService
+from aimbrain.commands.utils.video_reader import scale_dimensions
+
+
+class TrickleReader(BytesIO):
+    """
+    Pipe stand-in returning at most a few bytes per read, like a pipe that
+    has only been partially filled
+    """
+
+    def readinto(self, b):
+        return BytesIO.readinto(self, memoryview(b)[:5])
+
+
+def get_capture(data, width=2, height=2, buffers=2):
+    vcs = VideoCaptureService.__new__(VideoCaptureService)
+    vcs.width = width
+    vcs.height = height
+    vcs.depth = 3
+    vcs.frame_size = width * height * 3
+    vcs.buffers = [bytearray(vcs.frame_size) for _ in range(buffers)]
+    vcs.index = 0
+    vcs.proc = MagicMock(returncode=None, stdout=TrickleReader(data))
+    return vcs
+
+
+class TestVideoCaptureService(unittest2.TestCase):
+
+    def test_read_array(self):
+        data = bytes(bytearray(range(36)))
+        vcs = get_capture(data)
+
+        ok, first = vcs.read_array()
+        self.assertTrue(ok)
+        self.assertEquals(first.shape, (2, 2, 3))
+        self.assertEquals(first.tobytes(), data[:12])
+
+        ok, second = vcs.read_array()
+        self.assertEquals(second.tobytes(), data[12:24])
+
+        # The ring wraps, reusing the first frame's buffer
+        ok, third = vcs.read_array()
+        self.assertEquals(third.tobytes(), data[24:])
+        self.assertTrue(numpy.shares_memory(first, third))
+
+        ok, frame = vcs.read_array()
+        self.assertFalse(ok)
+        self.assertIsNone(frame)
+
+    def test_read_image(self):
+        vcs = get_capture(b'\x01\x02\x03' * 4)
+        ok, image = vcs.read()
+        self.assertTrue(ok)
+        self.assertEquals(image.getpixel((1, 1)), (1, 2, 3))
+
+    def test_read_truncated(self):
+        vcs = get_capture(b'\x00' * 7)
+        with self.assertRaises(ValueError):
+            vcs.read()
+
+
+class TestScaleDimensions(unittest2.TestCase):
+
+    def test_even(self):
+        self.assertEquals(scale_dimensions(1366, 768), (480, 268, True))
+        self.assertEquals(scale_dimensions(768, 1366), (268, 480, True))
+        self.assertEquals(scale_dimensions(1920, 1080), (480, 270, True))
+        self.assertEquals(scale_dimensions(479, 269), (479, 269, False))
+
+    def test_odd_writer(self):
+        with patch.object(video_reader.subprocess, 'Popen') as Popen:
+            for width, height in ((480, 270), (479, 269)):
+                VideoWriterService('out.mov', width, height, 'avconv')
+
+        even, odd = [args[0][0] for args in Popen.call_args_list]
+        self.assertNotIn('-vf', even)
+        self.assertEquals(
+            odd[odd.index('-vf') + 1],
+            'crop=trunc(iw/2)*2:trunc(ih/2)*2:0:0',
+        )
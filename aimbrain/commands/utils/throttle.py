@@ -0,0 +1,61 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Space out calls to acquire, from any number of threads, so that no more
+    than `rate` of them return per second on average.
+    """
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('Rate must be positive, got %s' % rate)
+
+        self.interval = 1.0 / rate
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take the next slot, returning how many seconds until it comes
+        round, for callers that can't sleep until then
+        """
+
+        with self.lock:
+            now = time.time()
+
+            # Don't bank unused slots from idle periods into a burst later
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+
+        return slot - now
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_rate(value, option):
+    """
+    RateLimiter for a rate given on the command line, None if none was
+
+    Arguments:
+    value <string> --- Rate per second, e.g. 20 or 0.5
+    option <string> --- Option the rate was given as, e.g. --rate
+    """
+
+    if not value:
+        return None
+
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = None
+
+    # Also rules out nan
+    if not rate > 0:
+        raise SystemExit('%s must be a positive number' % option)
+
+    return RateLimiter(rate)
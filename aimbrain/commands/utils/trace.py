@@ -0,0 +1,178 @@
+"""
+Timings of the phases of each request, for seeing where time goes.
+
+With --trace=<file>, phases such as reading and encoding biometrics,
+serializing and signing bodies, connecting, waiting for and downloading
+responses and parsing them are recorded as events with their start, how
+long they took and the thread they ran on. A file named *.json is written
+in Chrome's trace event format, to open in chrome://tracing or Perfetto,
+and any other as JSON lines of events.
+
+Until tracing is started the process has a tracer that records nothing, so
+instrumented code costs next to nothing without --trace.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class NullTracer(object):
+    """
+    Tracer for when tracing is off, recording nothing
+    """
+
+    enabled = False
+    path = None
+
+    @contextmanager
+    def span(self, name, **args):
+        yield args
+
+    def record(self, name, start, duration, **args):
+        pass
+
+    def close(self):
+        pass
+
+
+class Tracer(object):
+    """
+    Records events to a file, as JSON lines or, for a *.json file, in
+    Chrome's trace event format once the tracer is closed
+
+    Arguments:
+    path <string> --- File to write events to
+    """
+
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.chrome = path.endswith('.json')
+        self.lock = threading.Lock()
+        self.events = []
+        self.pid = os.getpid()
+
+        try:
+            self.f = open(path, 'w')
+        except IOError as e:
+            raise SystemExit('Unable to write trace to "%s": %s' % (
+                path,
+                e.strerror,
+            ))
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Record the time spent in a block as an event. The block is given the
+        event's arguments, to add to as it learns more, e.g. a status.
+        """
+
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.record(name, start, time.time() - start, **args)
+
+    def record(self, name, start, duration, **args):
+        """
+        Record an event
+
+        Arguments:
+        name <string> --- Phase the event is of, e.g. sign
+        start <float> --- Time the event started
+        duration <float> --- Seconds the event took
+        args <dict> --- Details of the event, e.g. the endpoint
+        """
+
+        thread = threading.current_thread().ident
+        with self.lock:
+            if self.f.closed:
+                return
+
+            if self.chrome:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': round(start * 1e6, 1),
+                    'dur': round(duration * 1e6, 1),
+                    'pid': self.pid,
+                    'tid': thread,
+                    'args': args,
+                })
+            else:
+                self.f.write(json.dumps({
+                    'name': name,
+                    'start': start,
+                    'duration': duration,
+                    'thread': thread,
+                    'args': args,
+                }) + '\n')
+
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+
+            if self.chrome:
+                json.dump({
+                    'traceEvents': self.events,
+                    'displayTimeUnit': 'ms',
+                }, self.f)
+
+            self.f.close()
+
+
+tracer = NullTracer()
+tracer_lock = threading.Lock()
+
+
+def start(path):
+    """
+    Start tracing the process to a file, which is written out on exit
+
+    Arguments:
+    path <string> --- File to write events to
+    """
+
+    global tracer
+
+    with tracer_lock:
+        if tracer.path == path:
+            return tracer
+
+        # One trace per process, so the last --trace given wins
+        tracer.close()
+        tracer = Tracer(path)
+        atexit.register(tracer.close)
+
+    return tracer
+
+
+def get_tracer():
+    return tracer
+
+
+def is_enabled():
+    return tracer.enabled
+
+
+def span(name, **args):
+    """
+    Record the time spent in a block with the process's tracer
+    """
+
+    return tracer.span(name, **args)
+
+
+def record(name, start, duration, **args):
+    """
+    Record an event with the process's tracer
+    """
+
+    tracer.record(name, start, duration, **args)
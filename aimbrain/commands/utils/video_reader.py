@@ -2,28 +2,64 @@ import json
 import os
 import subprocess
 
+import numpy
 import scipy.io.wavfile as wav
 
 from PIL import Image
 
 
+# Frames larger than this both ways are scaled down to it, as the API has no
+# use for more detail
+MAX_DIMENSION = 480
+
+
+def scale_dimensions(width, height, limit=MAX_DIMENSION):
+    """
+    Dimensions to scale a frame to, and whether they differ from the
+    original. Scaled dimensions are even, as 4:2:0 video needs.
+
+    Arguments:
+    width <int> --- Width of the frame
+    height <int> --- Height of the frame
+    limit <int> --- Longest side of a frame larger than this both ways
+    """
+
+    resize = False
+    if width > limit and height > limit and width > height:
+        resize = True
+        height = int(limit * ((height * 1.0) / width)) // 2 * 2
+        width = limit
+
+    elif width > limit and height > limit and height > width:
+        resize = True
+        width = int(limit * ((width * 1.0) / height)) // 2 * 2
+        height = limit
+
+    return width, height, resize
+
+
 class VideoCaptureService(object):
     """
     Read video using avconv or ffmpeg in a subprocess.
 
     The API is modelled after cv2.VideoCapture, and in many cases is a drop-in
     replacement.
+
+    Frames are read straight from the pipe into a ring of `buffers`
+    preallocated frame buffers. Arrays returned by read_array are views into
+    that ring, so each one stays valid only until `buffers` more frames have
+    been read; copy it to keep it for longer.
     """
     def __exit__(self, type, value, traceback):
         self.proc.kill()
         self.proc = None
-        self.buf = None
+        self.buffers = None
         self.resize = False
 
     def __enter__(self):
         return self
 
-    def __init__(self, filename, avconv, ffprobe):
+    def __init__(self, filename, avconv, ffprobe, buffers=2):
         self.filename = filename
         self.convert_command = avconv
         self.probe_command = ffprobe
@@ -40,23 +76,12 @@ class VideoCaptureService(object):
 
         self.width, self.height, self.resize = self.get_dimensions(streams[0])
         self.depth = 3  # TODO other depths
+        self.frame_size = self.width * self.height * self.depth
+        self.buffers = [bytearray(self.frame_size) for _ in range(buffers)]
         self.open()
 
     def get_dimensions(self, stream):
-        resize = False
-        width = stream.get('width')
-        height = stream.get('height')
-        if width > 480 and height > 480 and width > height:
-            resize = True
-            height = int(480 * ((height * 1.0) / width))
-            width = 480
-
-        elif width > 480 and height > 480 and height > width:
-            resize = True
-            width = int(480 * ((width * 1.0) / height))
-            height = 480
-
-        return width, height, resize
+        return scale_dimensions(stream.get('width'), stream.get('height'))
 
     def open(self):
         # TODO decide what is best behavior, reopen or leave as it if
@@ -78,13 +103,22 @@ class VideoCaptureService(object):
         cmd += ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
 
         self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        self.buf = b''
+        self.index = 0
 
     def is_opened(self):
         return self.proc is not None
 
-    def read_blocks(self, nbytes):
-        while len(self.buf) < nbytes:
+    def read_blocks(self, view):
+        """
+        Fill a writable buffer from the pipe, returning whether the process
+        is still readable and the number of bytes read
+
+        Arguments:
+        view <memoryview> --- Buffer to read into
+        """
+
+        nbytes = 0
+        while nbytes < len(view):
             # Could poll here, but return code never seems to be set before we
             # fail at reading anyway
             if self.proc.returncode is not None:
@@ -96,51 +130,72 @@ class VideoCaptureService(object):
                         )
                     )
 
-                return False
+                return False, nbytes
 
-            buf = self.proc.stdout.read(nbytes - len(self.buf))
+            count = self.proc.stdout.readinto(view[nbytes:])
 
             # Reading no data seems to be a reliable end-of-file indicator;
             # return code is not.
-            if len(buf) == 0:
+            if not count:
                 break
 
-            self.buf += buf
+            nbytes += count
 
-        return True
+        return True, nbytes
 
-    def read(self):
-        nbytes = self.width * self.height * self.depth
-        retval = self.read_blocks(nbytes)
+    def read_buffer(self):
+        """
+        Read the next frame into the buffer ring and return that buffer
+        """
+
+        buf = self.buffers[self.index]
+        retval, nbytes = self.read_blocks(memoryview(buf))
         if not retval:
             return False, None
 
-        if len(self.buf) < nbytes:
+        if nbytes < self.frame_size:
             # We didn't get any data, assume end-of-file
-            if len(self.buf) == 0:
+            if nbytes == 0:
                 return False, None
 
             # We got some data but not enough, this is an error
             raise ValueError(
                 'Not enough data at end of file, expected %d bytes, '
-                'read %d' % (nbytes, len(self.buf))
+                'read %d' % (self.frame_size, nbytes)
             )
 
-        image = Image.frombytes(
-            'RGB',
-            (self.width, self.height),
-            self.buf[:nbytes]
-        )
-        self.buf = b''
+        self.index = (self.index + 1) % len(self.buffers)
+
+        return retval, buf
+
+    def read(self):
+        retval, buf = self.read_buffer()
+        if not retval:
+            return False, None
 
-        # If there is data left over, move it to beginning of buffer for next
-        # frame
-        if len(self.buf) > nbytes:
-            # TODO this is a relatively slow operation, optimize
-            self.buf = self.buf[nbytes:]
+        # PIL copies the frame into its own storage
+        image = Image.frombytes('RGB', (self.width, self.height), buffer(buf))
 
         return retval, image
 
+    def read_array(self):
+        """
+        Like read, but return the frame as a (height, width, 3) uint8 array
+        viewing the buffer ring, without copying it
+        """
+
+        retval, buf = self.read_buffer()
+        if not retval:
+            return False, None
+
+        frame = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(
+            self.height,
+            self.width,
+            self.depth,
+        )
+
+        return retval, frame
+
     def get_info(self):
         # NOTE requires a fairly recent avprobe/ffprobe, older versions don't
         #      have -of json and only produce INI-like output
@@ -156,13 +211,7 @@ class VideoCaptureService(object):
 class AudioExtractor(object):
 
     def __exit__(self, type, value, traceback):
-        terminated = self.proc.poll()
-        if terminated is None:
-            self.proc.kill()
-
-        self.proc = None
-        self.buf = None
-        self.resize = False
+        self.close()
 
     def __enter__(self):
         return self
@@ -183,15 +232,46 @@ class AudioExtractor(object):
 
         return data
 
-    def extract(self, rate=16000):
-        cmd = '{} -y -i {} -f wav -ar {} -ac 1 -vn {} -loglevel error'.format(
+    def start(self, rate=16000):
+        """
+        Start extracting audio in the background, see wait
+        """
+
+        cmd = [
             self.convert_command,
+            '-y',
+            '-i',
             self.in_filename,
-            int(rate),
-            self.out_filename
-        )
+            '-f',
+            'wav',
+            '-ar',
+            str(int(rate)),
+            '-ac',
+            '1',
+            '-vn',
+            self.out_filename,
+            '-loglevel',
+            'error',
+        ]
+
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def check(self):
+        """
+        Fail early if a started extraction has already exited with an error
+        """
+
+        code = self.proc.poll()
+        if code is not None and code != 0:
+            raise SystemExit(
+                'Failed to extract audio from video, return code %d' % code
+            )
+
+    def wait(self):
+        """
+        Wait for a started extraction to finish
+        """
 
-        self.proc = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE)
         code = self.proc.wait()
         if code != 0:
             raise SystemExit(
@@ -200,3 +280,110 @@ class AudioExtractor(object):
 
         if not os.path.exists(self.out_filename):
             raise SystemExit('Failed to extract audio from video')
+
+    def extract(self, rate=16000):
+        self.start(rate)
+        self.wait()
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+        self.proc = None
+
+
+class VideoWriterService(object):
+    """
+    Write video by piping raw RGB frames into avconv or ffmpeg.
+
+    If an audio source is given its audio track is mapped into the output by
+    the same process, so no intermediate video or audio files are needed.
+    """
+
+    def __exit__(self, type, value, traceback):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __init__(self, filename, width, height, avconv, audio_filename=None,
+                 fps=30.0, audio_rate=16000):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.convert_command = avconv
+        self.audio_filename = audio_filename
+        self.fps = fps
+        self.audio_rate = audio_rate
+
+        self.proc = None
+        self.open()
+
+    def open(self):
+        cmd = [
+            self.convert_command,
+            '-y',
+            '-loglevel',
+            'error',
+            '-f',
+            'rawvideo',
+            '-pix_fmt',
+            'rgb24',
+            '-s',
+            '%dx%d' % (self.width, self.height),
+            '-r',
+            str(self.fps),
+            '-i',
+            '-',
+        ]
+
+        if self.audio_filename:
+            # Audio is optional in the source, hence the trailing '?'
+            cmd += [
+                '-i',
+                self.audio_filename,
+                '-map',
+                '0:v',
+                '-map',
+                '1:a?',
+                '-ar',
+                str(int(self.audio_rate)),
+                '-ac',
+                '1',
+            ]
+
+        # Most players only handle 4:2:0 chroma, which needs even dimensions,
+        # so frames of a small video with odd ones lose their last row or
+        # column
+        if self.width % 2 or self.height % 2:
+            cmd += ['-vf', 'crop=trunc(iw/2)*2:trunc(ih/2)*2:0:0']
+
+        cmd += ['-pix_fmt', 'yuv420p', self.filename]
+
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        """
+        Write a single frame
+
+        Arguments:
+        frame <ndarray> --- (height, width, 3) uint8 RGB frame
+        """
+
+        try:
+            self.proc.stdin.write(numpy.ascontiguousarray(frame))
+        except IOError:
+            # The encoder has gone away, report its exit status instead
+            self.close()
+            raise SystemExit('Encoder stopped accepting frames')
+
+    def close(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+        code = self.proc.wait()
+        if code != 0:
+            raise SystemExit('Failed to encode video, return code %d' % code)
@@ -1,4 +1,14 @@
+import csv
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import os.path
+import shutil
 import subprocess
+import tempfile
+import time
 
 import cv2
 import numpy
@@ -6,8 +16,68 @@ from PIL import ImageEnhance
 from PIL import ImageFilter
 
 from aimbrain.commands.base import BaseCommand
+from aimbrain.commands.utils import filters
+from aimbrain.commands.utils.pipeline import BufferedIterator
+from aimbrain.commands.utils.pipeline import chunked
+from aimbrain.commands.utils.pipeline import ordered_imap
 from aimbrain.commands.utils.video_reader import AudioExtractor
 from aimbrain.commands.utils.video_reader import VideoCaptureService
+from aimbrain.commands.utils.video_reader import VideoWriterService
+
+
+def sharpen_frame(frame, factor):
+    return ImageEnhance.Sharpness(frame).enhance(factor)
+
+
+def brighten_frame(frame, factor):
+    return ImageEnhance.Brightness(frame).enhance(factor)
+
+
+def contrast_frame(frame, factor):
+    return ImageEnhance.Contrast(frame).enhance(factor)
+
+
+def blur_frame(frame, factor):
+    return frame.filter(ImageFilter.GaussianBlur(factor))
+
+
+OPERATIONS = {
+    'sharpen': sharpen_frame,
+    'brighten': brighten_frame,
+    'contrast': contrast_frame,
+    'blur': blur_frame,
+}
+
+
+ENGINES = ('pil', 'numpy')
+
+
+def filter_frames(task):
+    """
+    Apply one or more operations to a chunk of frames, possibly inside a
+    worker process, returning a tuple of filtered frames per input frame
+
+    Arguments:
+    task <tuple> --- (engine, [(operation, factor), ...], frames)
+    """
+
+    engine, operations, frames = task
+
+    if engine == 'numpy':
+        # Filter the whole chunk as one (frames, height, width, 3) batch
+        batch = numpy.stack(frames)
+        return zip(*[
+            filters.OPERATIONS[operation](batch, factor)
+            for operation, factor in operations
+        ])
+
+    return [
+        tuple(
+            OPERATIONS[operation](frame, factor)
+            for operation, factor in operations
+        )
+        for frame in frames
+    ]
 
 
 class VideoConv(BaseCommand):
@@ -26,136 +96,204 @@ class VideoConv(BaseCommand):
         self.contrast = options.get('contrast')
 
         self.factor = float(options.get('<factor>'))
+        self.direct = options.get('--direct')
+        self.queue_depth = int(options.get('--queue-depth') or 8)
+        self.workers = int(options.get('--workers') or 1)
+        self.chunk_size = int(options.get('--chunk-size') or 8)
+        if self.workers < 1 or self.chunk_size < 1:
+            raise SystemExit('--workers and --chunk-size must be at least 1')
+
+        self.engine = options.get('--engine') or 'pil'
+        if self.engine not in ENGINES:
+            raise SystemExit(
+                '--engine must be one of %s' % ', '.join(ENGINES)
+            )
+
+        self.operation = None
+        for operation in OPERATIONS:
+            if options.get(operation):
+                self.operation = operation
 
-    def get_video_data(self):
+        # Every variant is filtered from the same decoded frames and written
+        # to its own output
+        self.variants = [(self.operation, self.factor, self.output)]
+        for variant in options.get('--variant') or []:
+            self.variants.append(self.parse_variant(variant))
+
+    def parse_variant(self, variant):
         """
-        Get frames, width and height of video
+        Parse an extra output given as operation:factor:output
+
+        Arguments:
+        variant <string> --- e.g. blur:1.5:/path/to/out.mov
         """
 
-        frames = []
-        width = None
-        height = None
-        with VideoCaptureService(self.input, self.avconv, self.ffprobe) as vcs:
-            width = vcs.width
-            height = vcs.height
+        try:
+            operation, factor, output = variant.split(':', 2)
+            factor = float(factor)
+        except ValueError:
+            raise SystemExit(
+                'Variant "%s" should be operation:factor:output' % variant
+            )
 
-            while True:
-                ok, image = vcs.read()
-                if not ok:
-                    break
+        if operation not in OPERATIONS or not output:
+            raise SystemExit(
+                'Variant "%s" should be operation:factor:output' % variant
+            )
 
-                frames.append(image)
+        return operation, factor, output
 
-        return frames, width, height
+    def get_video_data(self, vcs):
+        """
+        Yield the frames of the video one at a time
 
-    def get_audio_file(self, audio_file='/tmp/audio.wav'):
+        Arguments:
+        vcs <VideoCaptureService> --- Opened capture of the input video
         """
-        Get audio from input, store it and return location
 
-        Optional Arguments:
-        audio_file <string> --- Path to output audio to
+        read = vcs.read_array if self.engine == 'numpy' else vcs.read
+        while True:
+            ok, image = read()
+            if not ok:
+                break
+
+            yield image
+
+    def get_frame_buffers(self):
+        """
+        Number of frame buffers the capture needs so that no array frame is
+        overwritten while still queued, being chunked or in a worker's inbox
         """
 
-        with AudioExtractor(self.input, audio_file, self.avconv) as ae:
-            ae.extract()
+        buffers = self.queue_depth + self.chunk_size + 2
+        if self.workers > 1:
+            buffers += 2 * self.workers * self.chunk_size
 
-        return audio_file
+        return buffers
 
-    def sharpen_video(self, frames):
+    def start_audio_extraction(self, audio_file='/tmp/audio.wav'):
         """
-        Sharpen the video frames
+        Start extracting audio from input in the background and return the
+        extractor, whose out_filename is ready once wait returns
 
-        Arguments:
-        frames <list> --- List of images
+        Optional Arguments:
+        audio_file <string> --- Path to output audio to
         """
-        sharpened_frames = []
-        for frame in frames:
-            enhancer = ImageEnhance.Sharpness(frame)
-            sharpened_frames.append(enhancer.enhance(self.factor))
 
-        return sharpened_frames
+        audio = AudioExtractor(self.input, audio_file, self.avconv)
+        audio.start()
+
+        return audio
 
-    def brighten_video(self, frames):
+    def watch_audio(self, frames, audio):
         """
-        Brighten the video frames
+        Pass frames through, stopping as soon as the audio extraction running
+        alongside fails
 
         Arguments:
-        frames <list> --- List of images
+        frames <iterable> --- Iterable of images or arrays
+        audio <AudioExtractor> --- Started audio extraction
         """
 
-        brightened_frames = []
         for frame in frames:
-            enhancer = ImageEnhance.Brightness(frame)
-            brightened_frames.append(enhancer.enhance(self.factor))
+            audio.check()
+            yield frame
 
-        return brightened_frames
-
-    def contrast_video(self, frames):
+    def prepare_frame(self, frame):
         """
-        Change the video frames contrast
+        Rotate a filtered frame for output and return it as an RGB array
 
         Arguments:
-        frames <list> --- List of images
+        frame <Image|ndarray> --- Filtered frame
         """
 
-        contrasted_frames = []
-        for frame in frames:
-            enhancer = ImageEnhance.Contrast(frame)
-            contrasted_frames.append(enhancer.enhance(self.factor))
+        if isinstance(frame, numpy.ndarray):
+            return filters.rotate_frame(frame)
 
-        return contrasted_frames
+        return numpy.array(frame.rotate(90))
 
-    def blur_video(self, frames):
+    def build_videos(self, frames, width, height, video_files):
         """
-        Blur the video frames
+        Create one video per variant from the given frames at a certain width
+        and height
 
         Arguments:
-        frames <list> --- List of images
+        frames <iterable> --- Iterable of tuples of images or arrays, one per
+                              variant
+        width <float> --- Width of desired video
+        height <float> --- Height of desired video
+        video_files <list> --- Path to output each variant's video file to
         """
 
-        blurred_frames = []
-        for frame in frames:
-            blurred_frames.append(
-                frame.filter(ImageFilter.GaussianBlur(self.factor))
+        # Create the OpenCV VideoWriters
+        videos = [
+            cv2.VideoWriter(
+                video_file,
+                cv2.VideoWriter_fourcc(*"XVID"),
+                30.0,
+                (width, height),
             )
+            for video_file in video_files
+        ]
+
+        try:
+            for variant_frames in frames:
+                for video, frame in zip(videos, variant_frames):
+                    frame = self.prepare_frame(frame)
+                    video.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
 
-        return blurred_frames
+        finally:
+            for video in videos:
+                video.release()
 
-    def build_video(self, frames, width, height, video_file='/tmp/video.avi'):
+        return video_files
+
+    def stream_videos(self, frames, width, height, outputs):
         """
-        Create a video from the given frames at a certain width and height
+        Pipe the given frames straight into one encoder per variant, each of
+        which maps in the audio from the input video and writes its final
+        output in one pass
 
         Arguments:
-        frames <list> --- List of images
+        frames <iterable> --- Iterable of tuples of images or arrays, one per
+                              variant
         width <float> --- Width of desired video
         height <float> --- Height of desired video
-
-        Optional Arguments:
-        video_file <string> --- Path to output video file to
+        outputs <list> --- Path to output each variant's video to
         """
 
-        # Create the OpenCV VideoWriter
-        video = cv2.VideoWriter(
-            video_file,
-            cv2.VideoWriter_fourcc(*"XVID"),
-            30.0,
-            (width, height),
-        )
-
-        for frame in frames:
-            frame = frame.rotate(90)
-            video.write(cv2.cvtColor(numpy.array(frame), cv2.COLOR_RGB2BGR))
-
-        video.release()
-        return video_file
-
-    def combine_video_and_audio(self, video_file, audio_file):
+        writers = []
+        try:
+            for output in outputs:
+                writers.append(VideoWriterService(
+                    output,
+                    width,
+                    height,
+                    self.avconv,
+                    audio_filename=self.input,
+                ))
+
+            for variant_frames in frames:
+                for vws, frame in zip(writers, variant_frames):
+                    vws.write(self.prepare_frame(frame))
+
+            for vws in writers:
+                vws.close()
+
+        finally:
+            for vws in writers:
+                vws.__exit__(None, None, None)
+
+    def combine_video_and_audio(self, video_file, audio_file, output=None):
         """
         Combine the video and audio files to create the final product
 
         Arguments:
         video_file <string> --- Path to a video file
         audio_file <string> --- Path to a audio file
+
+        Optional Arguments:
+        output <string> --- Path to write to instead of --out
         """
 
         cmd = [
@@ -167,31 +305,356 @@ class VideoConv(BaseCommand):
             audio_file,
             '-c',
             'copy',
-            self.output,
+            output or self.output,
             '-loglevel',
             'error'
         ]
 
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        proc.wait()
+        code = proc.wait()
+        if code != 0:
+            raise SystemExit(
+                'Failed to combine video and audio, return code %d' % code
+            )
 
-    def run(self):
-        frames, width, height = self.get_video_data()
-        audio_file = self.get_audio_file()
+    def get_partial_output(self, output):
+        """
+        Path next to an output to write it to until it is complete, so that
+        a run that fails or is killed never leaves a truncated output that
+        looks up to date. It keeps the output's extension, which picks the
+        container.
 
+        Arguments:
+        output <string> --- Path of the finished output
+        """
+
+        directory, name = os.path.split(output)
+        base, ext = os.path.splitext(name)
+        return os.path.join(
+            directory,
+            '.%s.%d.partial%s' % (base, os.getpid(), ext),
+        )
+
+    def filter_video(self, frames, pool=None):
+        """
+        Apply every variant's operation to chunks of frames, across a process
+        pool if given, yielding a tuple of filtered frames per variant in
+        the original frame order
+
+        Arguments:
+        frames <iterable> --- Iterable of images or arrays
+
+        Optional Arguments:
+        pool <multiprocessing.Pool> --- Pool of filter workers
+        """
+
+        operations = [
+            (operation, factor) for operation, factor, _ in self.variants
+        ]
+        tasks = (
+            (self.engine, operations, chunk)
+            for chunk in chunked(frames, self.chunk_size)
+        )
+
+        if pool is None:
+            chunks = itertools.imap(filter_frames, tasks)
+        else:
+            # Two chunks per worker keeps every worker busy while bounding
+            # the number of frames in flight to 2 * workers * chunk_size
+            chunks = ordered_imap(pool, filter_frames, tasks, 2 * self.workers)
+
+        for chunk in chunks:
+            for variant_frames in chunk:
+                yield variant_frames
+
+    def convert_video(self, pool=None, audio=None, work_dir='/tmp',
+                      outputs=None):
+        """
+        Decode the video once, filter and encode every variant, returning the
+        paths of the intermediate video files or None in direct mode
+
+        Optional Arguments:
+        pool <multiprocessing.Pool> --- Pool of filter workers
+        audio <AudioExtractor> --- Audio extraction running alongside
+        work_dir <string> --- Directory to write intermediate videos to
+        outputs <list> --- Paths to write each variant to in direct mode,
+                           instead of its output
+        """
+
+        if outputs is None:
+            outputs = [output for _, _, output in self.variants]
+
+        with VideoCaptureService(
+            self.input,
+            self.avconv,
+            self.ffprobe,
+            buffers=self.get_frame_buffers(),
+        ) as vcs:
+            # Decoding runs ahead of filtering and encoding by at most
+            # queue_depth frames, so memory does not grow with clip length
+            with BufferedIterator(
+                self.get_video_data(vcs),
+                self.queue_depth,
+            ) as frames:
+                frames = self.filter_video(frames, pool)
+                if audio is not None:
+                    frames = self.watch_audio(frames, audio)
+
+                if self.direct:
+                    self.stream_videos(
+                        frames,
+                        vcs.width,
+                        vcs.height,
+                        outputs,
+                    )
+                    return None
+
+                video_files = [
+                    os.path.join(work_dir, 'video%d.avi' % i)
+                    for i in range(len(self.variants))
+                ]
+
+                return self.build_videos(
+                    frames,
+                    vcs.width,
+                    vcs.height,
+                    video_files,
+                )
+
+    def run(self):
         print('Running videoconv operation')
-        if self.brighten:
-            frames = self.brighten_video(frames)
 
-        elif self.blur:
-            frames = self.blur_video(frames)
+        # Start the workers before spawning avconv so they don't inherit its
+        # pipes
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+
+        # Audio is extracted while the video is converted, so the wall time
+        # is the longer of the two rather than their sum. In direct mode the
+        # encoder reads the audio from the input itself.
+        # Intermediate files go in a private directory so that concurrent runs
+        # don't overwrite each other's
+        work_dir = tempfile.mkdtemp(prefix='videoconv-')
+        audio = None
+        partials = [
+            self.get_partial_output(output) for _, _, output in self.variants
+        ]
+        try:
+            if not self.direct:
+                audio = self.start_audio_extraction(
+                    os.path.join(work_dir, 'audio.wav')
+                )
+
+            video_files = self.convert_video(pool, audio, work_dir, partials)
+
+            if audio is not None:
+                audio.wait()
+                for video_file, partial in zip(video_files, partials):
+                    self.combine_video_and_audio(
+                        video_file,
+                        audio.out_filename,
+                        partial,
+                    )
+
+            # Outputs only appear once every variant has been written
+            for partial, (_, _, output) in zip(partials, self.variants):
+                os.rename(partial, output)
 
-        elif self.sharpen:
-            frames = self.sharpen_video(frames)
+        finally:
+            if audio is not None:
+                audio.close()
 
-        elif self.contrast:
-            frames = self.contrast_video(frames)
+            for partial in partials:
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-        video_file = self.build_video(frames, width, height)
-        self.combine_video_and_audio(video_file, audio_file)
         print('Completed videoconv operation')
+
+
+def run_batch_job(job):
+    """
+    Run a single videoconv job inside a batch worker process and report how
+    it went rather than raising
+
+    Arguments:
+    job <dict> --- Options for VideoConv
+    """
+
+    start = time.time()
+    error = None
+    try:
+        VideoConv(job).run()
+    except SystemExit as e:
+        error = str(e) or 'Exited with status %s' % e.code
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+
+    # Whatever output a failed job wrote can't be trusted, and would be
+    # skipped as up to date by later runs
+    output = job['--out']
+    if (error and os.path.exists(output) and
+            os.path.getmtime(output) >= int(start)):
+        os.remove(output)
+
+    return job, error, time.time() - start
+
+
+class VideoConvBatch(BaseCommand):
+    """
+    Run many videoconv jobs, listed in a manifest or matched by a glob, from
+    a single process with a bounded number running at once.
+    """
+
+    MANIFEST_FIELDS = ('input', 'operation', 'factor', 'output')
+
+    def __init__(self, options, *args, **kwargs):
+        super(VideoConvBatch, self).__init__(options, *args, **kwargs)
+
+        self.manifest = options.get('<manifest>')
+        self.pattern = options.get('--glob')
+        self.out_dir = options.get('--out-dir')
+        self.factor = options.get('<factor>')
+        self.operation = None
+        for operation in OPERATIONS:
+            if options.get(operation):
+                self.operation = operation
+
+        self.jobs = int(options.get('--jobs') or multiprocessing.cpu_count())
+        if self.jobs < 1:
+            raise SystemExit('--jobs must be at least 1')
+
+        self.force = options.get('--force')
+
+        # Passed through to every job
+        self.job_options = {}
+        for option in ('--avconv', '--ffprobe', '--queue-depth',
+                       '--chunk-size', '--engine', '--direct'):
+            self.job_options[option] = options.get(option)
+
+    def read_manifest(self):
+        """
+        Read jobs from a CSV (with a header row) or JSON lines manifest
+        """
+
+        if not os.path.exists(self.manifest):
+            raise SystemExit('Manifest does not exist - "%s"' % self.manifest)
+
+        with open(self.manifest, 'r') as f:
+            if self.manifest.endswith(('.jsonl', '.json')):
+                rows = [json.loads(line) for line in f if line.strip()]
+            else:
+                rows = list(csv.DictReader(f))
+
+        for i, row in enumerate(rows):
+            missing = [k for k in self.MANIFEST_FIELDS if not row.get(k)]
+            if missing:
+                raise SystemExit('Manifest entry %d is missing %s' % (
+                    i + 1,
+                    ', '.join(missing),
+                ))
+
+            if row['operation'] not in OPERATIONS:
+                raise SystemExit('Manifest entry %d has unknown operation '
+                                 '"%s"' % (i + 1, row['operation']))
+
+        return rows
+
+    def glob_manifest(self):
+        """
+        Build jobs applying the same operation to every file matching the
+        glob, writing e.g. auth.mov to <out-dir>/auth_blur1.5.mov
+        """
+
+        rows = []
+        for path in sorted(glob.glob(self.pattern)):
+            name, ext = os.path.splitext(os.path.basename(path))
+            output = '%s_%s%s%s' % (name, self.operation, self.factor, ext)
+            rows.append({
+                'input': path,
+                'operation': self.operation,
+                'factor': self.factor,
+                'output': os.path.join(self.out_dir, output),
+            })
+
+        return rows
+
+    def is_up_to_date(self, row):
+        if not os.path.exists(row['output']):
+            return False
+
+        # Let the job itself report a missing input
+        if not os.path.exists(row['input']):
+            return False
+
+        return os.path.getmtime(row['output']) >= os.path.getmtime(
+            row['input']
+        )
+
+    def get_job(self, row):
+        job = dict(self.job_options)
+        job.update({
+            '--in': row['input'],
+            '--out': row['output'],
+            '<factor>': str(row['factor']),
+            row['operation']: True,
+        })
+
+        return job
+
+    def run(self):
+        rows = self.read_manifest() if self.manifest else self.glob_manifest()
+        if not rows:
+            raise SystemExit('No videoconv jobs to run')
+
+        jobs = []
+        skipped = 0
+        for row in rows:
+            if not self.force and self.is_up_to_date(row):
+                skipped += 1
+                print('[skipped][%s] up to date' % row['output'])
+                continue
+
+            jobs.append(self.get_job(row))
+
+        failed = []
+        start = time.time()
+        if jobs:
+            pool = multiprocessing.Pool(min(self.jobs, len(jobs)))
+            try:
+                results = pool.imap_unordered(run_batch_job, jobs)
+                for job, error, elapsed in results:
+                    status = 'failed' if error else 'ok'
+                    print('[%s][%.2fs] %s -> %s%s' % (
+                        status,
+                        elapsed,
+                        job['--in'],
+                        job['--out'],
+                        ': %s' % error if error else '',
+                    ))
+
+                    if error:
+                        failed.append((job, error))
+
+            finally:
+                pool.terminate()
+                pool.join()
+
+        print('\n%d ok, %d skipped, %d failed in %.2fs' % (
+            len(jobs) - len(failed),
+            skipped,
+            len(failed),
+            time.time() - start,
+        ))
+
+        for job, error in failed:
+            print('  %s: %s' % (job['--in'], error))
+
+        if failed:
+            raise SystemExit('%d videoconv jobs failed' % len(failed))
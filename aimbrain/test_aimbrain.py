@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import json
+import os
+import subprocess
+import sys
+
+import unittest2
+
+from aimbrain.aimbrain import COMMANDS
+from aimbrain.aimbrain import __doc__ as USAGE
+from aimbrain.aimbrain import get_command
+from aimbrain.aimbrain import get_usage
+
+
+# Seconds an API command may spend importing and parsing its arguments
+# before it sends a request
+IMPORT_BUDGET = 0.25
+
+HEAVY_MODULES = ('cv2', 'numpy', 'PIL', 'scipy')
+
+# Runs an API command in a fresh interpreter against a closed port, timing
+# each module imported on the way like python -X importtime, and reports
+# what it imported and how long importing and parsing took in all
+IMPORT_SCRIPT = '''
+import __builtin__
+import json
+import sys
+import time
+
+imports = []
+# Imports in progress, so that only the outermost count towards the total
+depth = [0]
+total = [0.0]
+original_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return original_import(name, *args, **kwargs)
+
+    start = time.time()
+    depth[0] += 1
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        elapsed = time.time() - start
+        imports.append((name, elapsed))
+        if not depth[0]:
+            total[0] += elapsed
+
+
+__builtin__.__import__ = timed_import
+
+import aimbrain.aimbrain
+from aimbrain.aimbrain import main
+
+original_docopt = aimbrain.aimbrain.docopt
+
+
+def timed_docopt(*args, **kwargs):
+    start = time.time()
+    try:
+        return original_docopt(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        imports.append(('docopt', elapsed))
+        total[0] += elapsed
+
+
+aimbrain.aimbrain.docopt = timed_docopt
+
+sys.argv = ['aimbrain-cli', 'session', '--user-id=user', '--api-key=key',
+            '--secret=secret', '--api-url=http://127.0.0.1:1']
+try:
+    main()
+except SystemExit:
+    pass
+
+json.dump({
+    'modules': sorted(sys.modules),
+    'imports': sorted(imports, key=lambda i: -i[1])[:10],
+    'total': total[0],
+}, sys.stdout)
+'''
+
+
+class TestCommands(unittest2.TestCase):
+
+    def test_get_command(self):
+        self.assertEquals(get_command({'session': True}).__name__, 'Session')
+        self.assertEquals(
+            get_command({'enroll': False, 'enroll-batch': True}).__name__,
+            'EnrollBatch',
+        )
+        self.assertIsNone(get_command({}))
+
+        # Every command named in the table exists
+        for name, _, cls in COMMANDS:
+            self.assertEquals(get_command({name: True}).__name__, cls)
+
+    def test_get_usage(self):
+        usage = get_usage(['session', '--user-id=user'])
+        patterns = usage.split('Usage:\n')[1].split('\n\n')[0]
+        self.assertEquals(
+            [pattern.split()[1] for pattern in patterns.split('\n')],
+            ['session'],
+        )
+        # Options are kept, so they parse the same as against the full usage
+        self.assertIn('--pool-size=<n>  ', usage)
+        self.assertIs(get_usage(['session']), usage)
+
+        for argv in ([], ['unknown']):
+            self.assertEquals(get_usage(argv), USAGE)
+
+    def test_api_imports(self):
+        process = subprocess.Popen(
+            [sys.executable, '-c', IMPORT_SCRIPT],
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        output, _ = process.communicate()
+        report = json.loads(output)
+
+        heavy = [
+            module for module in report['modules']
+            if module.split('.')[0] in HEAVY_MODULES
+        ]
+        self.assertEquals(heavy, [])
+
+        self.assertLess(report['total'], IMPORT_BUDGET, 'Slowest: %s' % (
+            ', '.join('%s %.3fs' % (n, t) for n, t in report['imports']),
+        ))
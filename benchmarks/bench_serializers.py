@@ -0,0 +1,85 @@
+"""
+Microbenchmark of JSON backends.
+
+Times serializing and parsing request bodies of the sizes the CLI sends,
+from a session request to batches of behavioural events and media, with
+each installed backend.
+
+Usage:
+  python benchmarks/bench_serializers.py [<repeat>]
+"""
+
+import base64
+import os
+import sys
+import timeit
+
+# Run from a checkout, so import the aimbrain package beside benchmarks/
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+)
+
+from aimbrain.commands.utils import serializer
+
+
+def get_events(count):
+    return {
+        'session': 'orange',
+        'mouseEvents': [
+            {'t': 1500000000000 + i, 'x': i % 1920, 'y': i % 1080,
+             'type': 'move', 'pressure': 0.5}
+            for i in range(count)
+        ],
+    }
+
+
+PAYLOADS = (
+    ('session', {'userId': 'user', 'device': 'Generic Phone',
+                 'system': 'Generic OS'}),
+    ('1k events', get_events(1000)),
+    ('10k events', get_events(10000)),
+    ('1MB face', {'session': 'orange',
+                  'faces': [base64.b64encode(os.urandom(768 * 1024))]}),
+)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    backends = serializer.get_available_backends()
+
+    print('%12s %8s %12s %14s %14s' % (
+        'payload', 'backend', 'bytes', 'dumps', 'loads',
+    ))
+    for label, payload in PAYLOADS:
+        size = len(serializer.get_backend('json').dumps(payload))
+
+        # Enough calls per run to take a measurable time at every size
+        number = max(1, 20 * 1024 * 1024 // (size * 10))
+        for name in backends:
+            backend = serializer.get_backend(name)
+            encoded = backend.dumps(payload)
+            assert backend.loads(encoded) == payload
+
+            dumps = min(timeit.repeat(
+                lambda: backend.dumps(payload),
+                repeat=repeat,
+                number=number,
+            )) / number
+            loads = min(timeit.repeat(
+                lambda: backend.loads(encoded),
+                repeat=repeat,
+                number=number,
+            )) / number
+
+            print('%12s %8s %12d %12.2fus %12.2fus' % (
+                label,
+                name,
+                len(encoded),
+                dumps * 1e6,
+                loads * 1e6,
+            ))
+
+
+if __name__ == '__main__':
+    main()
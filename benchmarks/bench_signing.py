@@ -0,0 +1,77 @@
+"""
+Microbenchmark of request signing.
+
+Compares building the whole message to sign, as requests used to be
+signed, with Signer feeding the pieces into a copy of an HMAC keyed once.
+
+Usage:
+  python benchmarks/bench_signing.py [<repeat>]
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import timeit
+
+# Run from a checkout, so import the aimbrain package beside benchmarks/
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+)
+
+from aimbrain.commands.utils.signing import Signer
+
+
+SECRET = 'bannanaman'
+ENDPOINT = '/v1/face/auth'
+SIZES = (100, 10 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+
+
+def sign_message(method, endpoint, payload):
+    message = '%s\n%s\n%s' % (method.upper(), endpoint.lower(), payload)
+
+    return base64.b64encode(hmac.new(
+        SECRET.encode('utf-8'),
+        bytes(message).encode('utf-8'),
+        digestmod=hashlib.sha256,
+    ).digest())
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    signer = Signer(SECRET)
+
+    print('%12s %14s %14s %8s' % ('payload', 'message', 'signer', 'speedup'))
+    for size in SIZES:
+        payload = 'x' * size
+        assert signer.sign('POST', ENDPOINT, payload) == sign_message(
+            'POST',
+            ENDPOINT,
+            payload,
+        )
+
+        # Enough calls per run to take a measurable time at every size
+        number = max(1, 50 * 1024 * 1024 // (size * 10))
+        old = min(timeit.repeat(
+            lambda: sign_message('POST', ENDPOINT, payload),
+            repeat=repeat,
+            number=number,
+        )) / number
+        new = min(timeit.repeat(
+            lambda: signer.sign('POST', ENDPOINT, payload),
+            repeat=repeat,
+            number=number,
+        )) / number
+
+        print('%12d %12.2fus %12.2fus %7.2fx' % (
+            size,
+            old * 1e6,
+            new * 1e6,
+            old / new,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,9 @@ setup(
         'pytest==3.4.2',
         'mock==2.0.0',
     ],
-    extras_require={'test': ['coverage', 'pytest', 'pytest-cov']},
+    extras_require={
+        'test': ['coverage', 'pytest', 'pytest-cov'],
+    },
     entry_points='''
         [console_scripts]
         aimbrain-cli=aimbrain.aimbrain:main